@@ -0,0 +1,239 @@
+"""
+JWT authentication with the user read through the shared cache.
+
+simplejwt's JWTAuthentication loads the user row on every request. Here its
+CACHED_FIELDS are cached for JWT_USER_CACHE['TIMEOUT'] seconds under a per-user version
+that User writes increment, the same scheme as api.caching.ProductCache, so
+a save, a password change or a deactivation is seen by the next request.
+With JWT_USER_CACHE['TRUST_TOKEN_CLAIMS'], read-only requests skip the
+lookup and build the user from the claims the token was issued with.
+"""
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from drf_spectacular.contrib.rest_framework_simplejwt import SimpleJWTScheme
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from api.routers import after_replica_lag
+
+# User fields copied into issued tokens, what the read-only views need of request.user
+USER_CLAIMS = ('username', 'is_staff')
+# User fields kept in the shared cache, with the md5 of the password hash for CHECK_REVOKE_TOKEN,
+# is_superuser so has_perm() answers for superusers without the permission tables
+CACHED_FIELDS = ('pk', 'username', 'is_active', 'is_staff', 'is_superuser')
+
+
+def get_options():
+    return {
+        # seconds a cached user is used, writes invalidate it before that
+        'TIMEOUT': 60,
+        # read-only requests use the token's claims, a change to the user is only seen
+        # by tokens issued after it, so up to ACCESS_TOKEN_LIFETIME late
+        'TRUST_TOKEN_CLAIMS': False,
+        **getattr(settings, 'JWT_USER_CACHE', {}),
+    }
+
+
+def trusts_claims(method):
+    return method in SAFE_METHODS and get_options()['TRUST_TOKEN_CLAIMS']
+
+
+def request_user_id(request):
+    """
+    The id of the user making the request, before any view runs.
+
+    From the token for JWT requests, DRF only authenticates those in the view, and from
+    the session otherwise, request.user would load the user. Neither is looked up.
+    """
+    has_token, user_id = token_user_id(request)
+    if has_token:
+        return user_id
+    session = getattr(request, 'session', None)
+    return _session_user_id(session.get(SESSION_KEY) if session is not None else None)
+
+
+async def arequest_user_id(request):
+    has_token, user_id = token_user_id(request)
+    if has_token:
+        return user_id
+    session = getattr(request, 'session', None)
+    return _session_user_id(await session.aget(SESSION_KEY) if session is not None else None)
+
+
+def _session_user_id(value):
+    # sessions keep the pk as a string
+    return get_user_model()._meta.pk.to_python(value) if value is not None else None
+
+
+def token_user_id(request):
+    # (whether the request has a token, the user id in it)
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    if header is None:
+        return False, None
+    try:
+        return True, authentication.user_id(authentication.get_validated_token(authentication.get_raw_token(header)))
+    except Exception:
+        # an invalid token, the view answers it with a 401
+        return True, None
+
+
+def _key(user_id):
+    return f'jwt_user:{user_id}'
+
+
+def _version_key(user_id):
+    return f'jwt_user:{user_id}:version'
+
+
+def invalidate_user(user_id):
+    # after commit, a reader that loaded the old row caches it under the old version
+    def bump():
+        try:
+            cache.incr(_version_key(user_id))
+        except ValueError:
+            cache.add(_version_key(user_id), 1, timeout=None)
+        cache.delete(_key(user_id))
+
+    def bump_now_and_after_replica_lag():
+        bump()
+        after_replica_lag(_version_key(user_id), bump)
+    transaction.on_commit(bump_now_and_after_replica_lag)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication with get_user() served from the cache, aget_user() for the async views.
+    """
+    trust_claims = False
+
+    def authenticate(self, request):
+        # get_user() is only handed the token
+        self.trust_claims = trusts_claims(request.method)
+        return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        user_id = self.user_id(validated_token)
+        if self.has_user_claims(validated_token):
+            return self.claims_user(validated_token)
+
+        shared = cache.get_many([_key(user_id), _version_key(user_id)])
+        entry, version = self.cached_entry(user_id, shared)
+        if entry is None:
+            entry = self.entry(self.user_model.objects.filter(**{jwt_settings.USER_ID_FIELD: user_id}).first(), version)
+            cache.set(_key(user_id), entry, get_options()['TIMEOUT'])
+        return self.check_user(entry, validated_token)
+
+    async def aget_user(self, validated_token):
+        user_id = self.user_id(validated_token)
+        if self.has_user_claims(validated_token):
+            return self.claims_user(validated_token)
+
+        shared = await cache.aget_many([_key(user_id), _version_key(user_id)])
+        entry, version = self.cached_entry(user_id, shared)
+        if entry is None:
+            entry = self.entry(
+                await self.user_model.objects.filter(**{jwt_settings.USER_ID_FIELD: user_id}).afirst(), version)
+            await cache.aset(_key(user_id), entry, get_options()['TIMEOUT'])
+        return self.check_user(entry, validated_token)
+
+    @staticmethod
+    def user_id(validated_token):
+        try:
+            return validated_token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+    @staticmethod
+    def cached_entry(user_id, shared):
+        # (entry, version), the entry only when it was cached under the current version,
+        # with the current CACHED_FIELDS
+        version = shared.get(_version_key(user_id), 0)
+        entry = shared.get(_key(user_id))
+        if entry is not None and entry['version'] == version and entry['fields'].keys() == set(CACHED_FIELDS):
+            return entry, version
+        return None, version
+
+    @staticmethod
+    def entry(user, version):
+        # what the checks and request.user's readers need, not the pickled row with its password hash
+        if user is None:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        return {
+            'version': version,
+            'fields': {field: getattr(user, field) for field in CACHED_FIELDS},
+            'password_hash': get_md5_hash_password(user.password),
+        }
+
+    def has_user_claims(self, validated_token):
+        # tokens issued before the claims were added still get a lookup
+        return self.trust_claims and all(claim in validated_token for claim in USER_CLAIMS)
+
+    def claims_user(self, validated_token):
+        # never saved, it only has the fields in the token
+        user = self.user_model(
+            is_active=True,
+            **{jwt_settings.USER_ID_FIELD: validated_token[jwt_settings.USER_ID_CLAIM]},
+            **{claim: validated_token[claim] for claim in USER_CLAIMS},
+        )
+        user._state.adding = False
+        return user
+
+    def check_user(self, entry, validated_token):
+        # JWTAuthentication.get_user()'s checks, then the user of a cache entry
+        if jwt_settings.CHECK_USER_IS_ACTIVE and not entry['fields']['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        if jwt_settings.CHECK_REVOKE_TOKEN and (
+                validated_token.get(jwt_settings.REVOKE_TOKEN_CLAIM) != entry['password_hash']):
+            raise AuthenticationFailed("The user's password has been changed.", code='password_changed')
+        # never saved, it only has CACHED_FIELDS
+        user = self.user_model(**entry['fields'])
+        user._state.adding = False
+        return user
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Tokens carrying USER_CLAIMS, refreshed access tokens copy them from the refresh token.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for claim in USER_CLAIMS:
+            token[claim] = getattr(user, claim)
+        return token
+
+
+class ClaimsRefreshToken(RefreshToken):
+    """
+    A refresh token whose access tokens get USER_CLAIMS from the user as it is now.
+
+    RefreshToken.access_token copies every claim of the refresh token, a demoted
+    user would keep is_staff for REFRESH_TOKEN_LIFETIME.
+    """
+
+    @property
+    def access_token(self):
+        access = super().access_token
+        user = get_user_model().objects.filter(**{jwt_settings.USER_ID_FIELD: self[jwt_settings.USER_ID_CLAIM]}).first()
+        if user is not None:
+            for claim in USER_CLAIMS:
+                access[claim] = getattr(user, claim)
+        return access
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = ClaimsRefreshToken
+
+
+class CachedJWTScheme(SimpleJWTScheme):
+    # the OpenAPI security scheme of JWTAuthentication, drf-spectacular doesn't match subclasses
+    target_class = CachedJWTAuthentication
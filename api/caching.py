@@ -0,0 +1,410 @@
+import copy
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Min, Q
+from django.middleware.cache import CacheMiddleware
+from django.utils.decorators import decorator_from_middleware_with_args
+
+from api.models import Product
+from api.routers import after_replica_lag
+
+PRODUCT_LIST_NAMESPACE = 'product_list'
+ORDER_LIST_NAMESPACE = 'order_list'
+# product saves and deletes, not stock moves, the order rows embed the product name and price
+PRODUCT_NAMESPACE = 'product'
+# product writes bump the generation, older entries are never read again
+PRODUCT_LIST_CACHE_TIMEOUT = 60 * 15
+# order writes invalidate the affected user and product writes every user, so entries can live for a long time
+ORDER_LIST_CACHE_TIMEOUT = 60 * 60 * 6
+
+_state = threading.local()
+
+
+def _generation_key(namespace):
+    return f'{namespace}:generation'
+
+
+def _modified_key(namespace):
+    return f'{namespace}:modified'
+
+
+def get_generation(namespace):
+    generation = cache.get(_generation_key(namespace))
+    if generation is None:
+        # start from the clock, so a counter that was evicted never reuses an old generation
+        cache.add(_generation_key(namespace), time.time_ns(), timeout=None)
+        generation = cache.get(_generation_key(namespace), 0)
+    return generation
+
+
+def get_version(namespace):
+    """
+    (generation, last modified unix time) of `namespace`, in one cache call.
+
+    The collection-level version used for conditional GETs.
+    """
+    values = cache.get_many([_generation_key(namespace), _modified_key(namespace)])
+    generation = values.get(_generation_key(namespace))
+    modified = values.get(_modified_key(namespace))
+    if generation is None:
+        generation = get_generation(namespace)
+    if modified is None:
+        # unknown, the safe answer is "just now"
+        modified = time.time()
+        cache.add(_modified_key(namespace), modified, timeout=None)
+    return generation, modified
+
+
+async def aget_generation(namespace):
+    generation = await cache.aget(_generation_key(namespace))
+    if generation is None:
+        await cache.aadd(_generation_key(namespace), time.time_ns(), timeout=None)
+        generation = await cache.aget(_generation_key(namespace), 0)
+    return generation
+
+
+async def aget_version(namespace):
+    values = await cache.aget_many([_generation_key(namespace), _modified_key(namespace)])
+    generation = values.get(_generation_key(namespace))
+    modified = values.get(_modified_key(namespace))
+    if generation is None:
+        generation = await aget_generation(namespace)
+    if modified is None:
+        modified = time.time()
+        await cache.aadd(_modified_key(namespace), modified, timeout=None)
+    return generation, modified
+
+
+def bump_generation(namespace):
+    """
+    Invalidate every cached entry of `namespace` with one INCR.
+
+    Entries from older generations are never read again and expire on their own.
+    """
+    _bump_generation(namespace)
+    after_replica_lag(_generation_key(namespace), lambda: _bump_generation(namespace))
+
+
+def _bump_generation(namespace):
+    try:
+        cache.incr(_generation_key(namespace))
+    except ValueError:
+        cache.add(_generation_key(namespace), time.time_ns(), timeout=None)
+    cache.set(_modified_key(namespace), time.time(), timeout=None)
+
+
+def invalidate_product_list():
+    # inside a bulk_product_changes() block the bump happens once at the end
+    if getattr(_state, 'bulk_depth', 0):
+        return
+    bump_generation(PRODUCT_LIST_NAMESPACE)
+
+
+def invalidate_products():
+    # the order lists and order details that show product fields
+    if getattr(_state, 'bulk_depth', 0):
+        return
+    bump_generation(PRODUCT_NAMESPACE)
+
+
+@contextmanager
+def bulk_product_changes():
+    """
+    Batch product writes (imports, bulk updates) without one invalidation per row.
+
+    Product signals inside the block are ignored and the generations are bumped once
+    on exit, which also covers bulk_create() and update() that send no signals.
+    """
+    _state.bulk_depth = getattr(_state, 'bulk_depth', 0) + 1
+    try:
+        yield
+    finally:
+        _state.bulk_depth -= 1
+        if not _state.bulk_depth:
+            bump_generation(PRODUCT_LIST_NAMESPACE)
+            bump_generation(PRODUCT_NAMESPACE)
+
+
+CATALOG_STATS = {
+    'count': Count('pk'),
+    'in_stock_count': Count('pk', filter=Q(stock__gt=0)),
+    'max_price': Max('price'),
+    'min_price': Min('price'),
+    'avg_price': Avg('price'),
+}
+
+
+def get_catalog_stats():
+    """
+    Count, in-stock count and min/max/avg price of the catalog, in one aggregate query.
+
+    Cached under the product list generation, so any product write (including stock
+    reservations) recomputes it on the next read and every other read is one cache get.
+    """
+    key = f'{PRODUCT_LIST_NAMESPACE}:{get_generation(PRODUCT_LIST_NAMESPACE)}:stats'
+    stats = cache.get(key)
+    if stats is None:
+        stats = Product.objects.aggregate(**CATALOG_STATS)
+        cache.set(key, stats, PRODUCT_LIST_CACHE_TIMEOUT)
+    return stats
+
+
+async def aget_catalog_stats():
+    key = f'{PRODUCT_LIST_NAMESPACE}:{await aget_generation(PRODUCT_LIST_NAMESPACE)}:stats'
+    stats = await cache.aget(key)
+    if stats is None:
+        stats = await Product.objects.aaggregate(**CATALOG_STATS)
+        await cache.aset(key, stats, PRODUCT_LIST_CACHE_TIMEOUT)
+    return stats
+
+
+def versioned_cache_page(timeout, namespace):
+    """
+    Same as cache_page, with the namespace generation folded into the key prefix.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key_prefix = f'{namespace}.{get_generation(namespace)}'
+            cached_view = decorator_from_middleware_with_args(CacheMiddleware)(
+                page_timeout=timeout,
+                key_prefix=key_prefix,
+            )(view_func)
+            return cached_view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def order_list_namespace(user=None, user_id=None):
+    # staff see every order, they share one namespace that any order write invalidates
+    if user is not None and user.is_staff:
+        return f'{ORDER_LIST_NAMESPACE}:staff'
+    return f'{ORDER_LIST_NAMESPACE}:user:{user.pk if user is not None else user_id}'
+
+
+def get_order_list_version(user):
+    """
+    (generation, last modified unix time) of `user`'s order lists.
+
+    The rows embed the product name and price, so product writes move the version too.
+    """
+    generation, modified = get_version(order_list_namespace(user))
+    product_generation, product_modified = get_version(PRODUCT_NAMESPACE)
+    return f'{generation}.{product_generation}', max(modified, product_modified)
+
+
+async def aget_order_list_version(user):
+    generation, modified = await aget_version(order_list_namespace(user))
+    product_generation, product_modified = await aget_version(PRODUCT_NAMESPACE)
+    return f'{generation}.{product_generation}', max(modified, product_modified)
+
+
+def order_list_cache_key(request):
+    """
+    Cache key for one user's order list with one set of filters.
+
+    Keyed on the user id rather than the Authorization header, so a refreshed token
+    keeps hitting the same entries, and on the sorted query params so `?a=1&b=2`
+    and `?b=2&a=1` share an entry.
+    """
+    generation, _ = get_order_list_version(request.user)
+    return f'{order_list_namespace(request.user)}:{generation}:{_params_digest(request)}'
+
+
+async def aorder_list_cache_key(request):
+    generation, _ = await aget_order_list_version(request.user)
+    return f'{order_list_namespace(request.user)}:{generation}:{_params_digest(request)}'
+
+
+def _params_digest(request):
+    params = urlencode(sorted(
+        (name, value) for name, values in request.query_params.lists() for value in values
+    ))
+    return hashlib.md5(params.encode('utf-8')).hexdigest()
+
+
+def invalidate_order_list(user_id):
+    # inside a bulk_order_changes() block each user is invalidated once at the end
+    users = getattr(_state, 'order_users', None)
+    if users is not None:
+        users.add(user_id)
+        return
+
+    # after commit, so a concurrent reader can't cache the old rows again
+    def bump():
+        bump_generation(order_list_namespace(user_id=user_id))
+        bump_generation(f'{ORDER_LIST_NAMESPACE}:staff')
+    transaction.on_commit(bump)
+
+
+@contextmanager
+def bulk_order_changes():
+    """
+    Batch order item writes without one invalidation per row.
+
+    Invalidations inside the block only collect the users, each of them is
+    invalidated once on exit.
+    """
+    outermost = getattr(_state, 'order_users', None) is None
+    if outermost:
+        _state.order_users = set()
+    try:
+        yield
+    finally:
+        if outermost:
+            users, _state.order_users = _state.order_users, None
+            for user_id in users:
+                invalidate_order_list(user_id)
+
+
+class ProductCache:
+    """
+    Read-through product cache, a bounded per-process LRU in front of the shared cache.
+
+    Every product has a version counter in the shared cache that writes increment.
+    Shared entries carry the version they were loaded under and only count when it
+    still matches, so a reader racing a writer can't put an old row back. Local entries
+    are trusted for PRODUCT_CACHE['LOCAL_TIMEOUT'] seconds, then revalidated.
+    """
+
+    def __init__(self):
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def options(self):
+        return {
+            'LOCAL_MAX_ENTRIES': 1024,
+            'LOCAL_TIMEOUT': 5,
+            'TIMEOUT': 60 * 15,
+            'JITTER': 0.1,
+            **getattr(settings, 'PRODUCT_CACHE', {}),
+        }
+
+    @staticmethod
+    def _key(pk):
+        return f'product:{pk}'
+
+    @staticmethod
+    def _version_key(pk):
+        return f'product:{pk}:version'
+
+    def _jitter(self, timeout):
+        # spread expiries so hot products loaded together don't all expire together
+        jitter = self.options['JITTER']
+        return timeout * random.uniform(1 - jitter, 1 + jitter)
+
+    def get(self, pk):
+        return self.get_many([pk]).get(int(pk))
+
+    def get_many(self, pks):
+        """
+        {pk: product} for the products that exist, one shared cache call and at most
+        one query for everything the local tier doesn't have.
+        """
+        now = time.monotonic()
+        found, missing = self._local_hits(pks, now)
+        if missing:
+            shared = cache.get_many(self._shared_keys(missing))
+            loaded, versions = self._shared_hits(missing, shared)
+
+            from_db = Product.objects.in_bulk(missing - loaded.keys())
+            if from_db:
+                cache.set_many(self._shared_entries(from_db, versions), self._jitter(self.options['TIMEOUT']))
+            loaded.update(from_db)
+            found.update(self._remember(loaded, versions, now))
+
+        # copies, callers are free to change what they get back
+        return {pk: copy.copy(product) for pk, product in found.items()}
+
+    async def aget(self, pk):
+        return (await self.aget_many([pk])).get(int(pk))
+
+    async def aget_many(self, pks):
+        # get_many() for the async views, async cache and ORM calls
+        now = time.monotonic()
+        found, missing = self._local_hits(pks, now)
+        if missing:
+            shared = await cache.aget_many(self._shared_keys(missing))
+            loaded, versions = self._shared_hits(missing, shared)
+
+            from_db = {product.pk: product async for product in Product.objects.filter(pk__in=missing - loaded.keys())}
+            if from_db:
+                await cache.aset_many(self._shared_entries(from_db, versions), self._jitter(self.options['TIMEOUT']))
+            loaded.update(from_db)
+            found.update(self._remember(loaded, versions, now))
+
+        return {pk: copy.copy(product) for pk, product in found.items()}
+
+    def _local_hits(self, pks, now):
+        pks = {int(pk) for pk in pks}
+        found = {}
+        with self._lock:
+            for pk in pks:
+                entry = self._local.get(pk)
+                if entry is not None and entry[2] > now:
+                    self._local.move_to_end(pk)
+                    found[pk] = entry[1]
+        return found, pks - found.keys()
+
+    def _shared_keys(self, pks):
+        return [self._key(pk) for pk in pks] + [self._version_key(pk) for pk in pks]
+
+    def _shared_hits(self, pks, shared):
+        versions = {pk: shared.get(self._version_key(pk), 0) for pk in pks}
+        loaded = {}
+        for pk in pks:
+            entry = shared.get(self._key(pk))
+            if entry is not None and entry['version'] == versions[pk]:
+                loaded[pk] = entry['product']
+        return loaded, versions
+
+    def _shared_entries(self, products, versions):
+        return {self._key(pk): {'version': versions[pk], 'product': product} for pk, product in products.items()}
+
+    def _remember(self, loaded, versions, now):
+        with self._lock:
+            for pk, product in loaded.items():
+                fresh_until = now + self._jitter(self.options['LOCAL_TIMEOUT'])
+                self._local[pk] = (versions[pk], product, fresh_until)
+                self._local.move_to_end(pk)
+            while len(self._local) > self.options['LOCAL_MAX_ENTRIES']:
+                self._local.popitem(last=False)
+        return loaded
+
+    def invalidate(self, pk):
+        self.invalidate_many([pk])
+
+    def invalidate_many(self, pks):
+        self._invalidate_many(pks)
+        pks = list(pks)
+        after_replica_lag(('product', *sorted(pks)), lambda: self._invalidate_many(pks))
+
+    def _invalidate_many(self, pks):
+        for pk in pks:
+            try:
+                cache.incr(self._version_key(pk))
+            except ValueError:
+                cache.add(self._version_key(pk), 1, timeout=None)
+        cache.delete_many([self._key(pk) for pk in pks])
+        self.clear_local(pks)
+
+    def clear_local(self, pks=None):
+        with self._lock:
+            if pks is None:
+                self._local.clear()
+            for pk in pks or ():
+                self._local.pop(int(pk), None)
+
+
+product_cache = ProductCache()
@@ -0,0 +1,103 @@
+from datetime import datetime, timezone
+
+from django.core.exceptions import ValidationError
+from django.views.decorators.http import condition
+
+from api.caching import (PRODUCT_LIST_NAMESPACE, PRODUCT_NAMESPACE, get_order_list_version, get_version,
+                         order_list_namespace, product_cache)
+from api.models import Order
+
+# ETag / Last-Modified for the API, answered from a cache lookup so a 304 never
+# runs the main query or the serializer
+
+
+def _memoize(request, key, func):
+    # condition() asks for the etag and last modified separately, look the version up once
+    versions = request.__dict__.setdefault('_conditional_versions', {})
+    if key not in versions:
+        versions[key] = func()
+    return versions[key]
+
+
+def _collection(request, namespace):
+    return _memoize(request, namespace, lambda: get_version(namespace))
+
+
+def _as_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def product_list_etag(request, *args, **kwargs):
+    generation, _ = _collection(request, PRODUCT_LIST_NAMESPACE)
+    return f'W/"{PRODUCT_LIST_NAMESPACE}-{generation}"'
+
+
+def product_list_last_modified(request, *args, **kwargs):
+    _, modified = _collection(request, PRODUCT_LIST_NAMESPACE)
+    return _as_datetime(modified)
+
+
+def _order_list(request):
+    return _memoize(request, 'order_list', lambda: get_order_list_version(request.user))
+
+
+def order_list_etag(request, *args, **kwargs):
+    generation, _ = _order_list(request)
+    return f'W/"{order_list_namespace(request.user)}-{generation}"'
+
+
+def order_list_last_modified(request, *args, **kwargs):
+    _, modified = _order_list(request)
+    return _as_datetime(modified)
+
+
+def _product(request, product_id):
+    # the two-tier product cache, usually a local hit
+    return _memoize(request, f'product:{product_id}', lambda: product_cache.get(product_id))
+
+
+def product_etag(request, product_id, *args, **kwargs):
+    product = _product(request, product_id)
+    if product is None:
+        return None
+    return f'"product-{product.pk}-{product.updated_at.timestamp()}"'
+
+
+def product_last_modified(request, product_id, *args, **kwargs):
+    product = _product(request, product_id)
+    return product.updated_at if product is not None else None
+
+
+def _order_updated_at(request, pk):
+    def lookup():
+        orders = Order.objects.filter(pk=pk)
+        if not request.user.is_staff:
+            orders = orders.filter(user=request.user)
+        try:
+            return orders.values_list('updated_at', flat=True).first()
+        except (ValidationError, ValueError):
+            return None
+    return _memoize(request, f'order:{pk}', lookup)
+
+
+def order_etag(request, pk, *args, **kwargs):
+    updated_at = _order_updated_at(request, pk)
+    if updated_at is None:
+        return None
+    # the items show the product name and price, product writes change the order too
+    product_generation, _ = _collection(request, PRODUCT_NAMESPACE)
+    return f'"order-{pk}-{updated_at.timestamp()}-{product_generation}"'
+
+
+def order_last_modified(request, pk, *args, **kwargs):
+    updated_at = _order_updated_at(request, pk)
+    if updated_at is None:
+        return None
+    _, product_modified = _collection(request, PRODUCT_NAMESPACE)
+    return max(updated_at, _as_datetime(product_modified))
+
+
+product_list_condition = condition(etag_func=product_list_etag, last_modified_func=product_list_last_modified)
+product_condition = condition(etag_func=product_etag, last_modified_func=product_last_modified)
+order_list_condition = condition(etag_func=order_list_etag, last_modified_func=order_list_last_modified)
+order_condition = condition(etag_func=order_etag, last_modified_func=order_last_modified)
@@ -0,0 +1,59 @@
+import csv
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from api.fast_serializers import iter_order_rows
+
+# orders fetched per query, their items are loaded once per chunk
+EXPORT_CHUNK_SIZE = 500
+
+CSV_HEADER = (
+    'order_id',
+    'created_at',
+    'user',
+    'status',
+    'product_name',
+    'product_price',
+    'quantity',
+    'item_subtotal',
+)
+
+
+class Echo:
+    # file-like object for csv.writer, hands the line back instead of buffering it
+    def write(self, value):
+        return value
+
+
+def iter_orders(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    # OrderSerializer output, one chunk of orders in memory at a time
+    return iter_order_rows(queryset, chunk_size)
+
+
+def stream_ndjson(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    encoder = JSONEncoder(ensure_ascii=False)
+    for data in iter_orders(queryset, chunk_size):
+        yield encoder.encode(data) + '\n'
+
+
+def stream_csv(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    # one line per order item, orders without items still get a line
+    for data in iter_orders(queryset, chunk_size):
+        order = (data['order_id'], data['created_at'], data['user'], data['status'])
+        if not data['items']:
+            yield writer.writerow(order + ('', '', '', ''))
+        for item in data['items']:
+            yield writer.writerow(order + (
+                item['product_name'],
+                item['product_price'],
+                item['quantity'],
+                item['item_subtotal'],
+            ))
+
+
+EXPORT_FORMATS = {
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+    'csv': (stream_csv, 'text/csv'),
+}
@@ -0,0 +1,128 @@
+"""
+Read-only rows for the list endpoints, built from values_list() tuples.
+
+Same output as ProductSerializer and OrderSerializer without instantiating a model
+or running DRF's per-field to_representation(), checked by FastSerializerTestCase.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+
+from django.utils import timezone
+
+from api.images import rendition_urls
+from api.mirror import local_url
+from api.models import OrderItem, item_subtotal
+
+CENT = Decimal('0.01')
+# orders whose items are loaded per query
+ORDER_ITEMS_CHUNK_SIZE = 500
+
+PRODUCT_FIELDS = ('name', 'description', 'price', 'stock', 'external_image_url', 'external_image_mirror',
+                  'image_width', 'image_height', 'image_renditions')
+ORDER_FIELDS = ('order_id', 'created_at', 'user_id', 'status', 'total_price')
+ORDER_ITEM_FIELDS = ('order_id', 'product__name', 'product__price', 'quantity', 'subtotal')
+
+
+def decimal_string(value):
+    # DecimalField(decimal_places=2) with COERCE_DECIMAL_TO_STRING
+    if value is None:
+        return None
+    return format(value.quantize(CENT), 'f')
+
+
+def datetime_string(value):
+    # DateTimeField with the default ISO 8601 format
+    if value is None:
+        return None
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.get_current_timezone())
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def product_values(queryset):
+    # keeps pk and the annotations (search_rank) around for the keyset cursor
+    return queryset.values(*PRODUCT_FIELDS, 'pk', *queryset.query.annotations)
+
+
+def product_rows(rows):
+    """ProductSerializer(many=True).data for dicts from product_values()."""
+    return [
+        {
+            'name': row['name'],
+            'description': row['description'],
+            'price': decimal_string(row['price']),
+            'stock': row['stock'],
+            'external_image_url': local_url(row['external_image_url'], row['external_image_mirror']),
+            'image_width': row['image_width'],
+            'image_height': row['image_height'],
+            'images': rendition_urls(row['image_renditions']),
+        }
+        for row in rows
+    ]
+
+
+def _order_items_query(order_ids):
+    return (
+        OrderItem.objects
+        .filter(order__in=order_ids)
+        .annotate(subtotal=item_subtotal())
+        .order_by('pk')
+        .values_list(*ORDER_ITEM_FIELDS)
+    )
+
+
+def _order_rows(orders, items):
+    by_order = defaultdict(list)
+    for order_id, product_name, product_price, quantity, subtotal in items:
+        by_order[order_id].append({
+            'product_name': product_name,
+            'product_price': decimal_string(product_price),
+            'quantity': quantity,
+            'item_subtotal': subtotal,
+        })
+    return [
+        {
+            'order_id': str(order_id),
+            'created_at': datetime_string(created_at),
+            'user': user_id,
+            'status': status,
+            'items': by_order[order_id],
+            'total_price': total_price,
+        }
+        for order_id, created_at, user_id, status, total_price in orders
+    ]
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def iter_order_rows(queryset, chunk_size=ORDER_ITEMS_CHUNK_SIZE):
+    """
+    OrderSerializer data for every order of `queryset` (Order.objects.with_totals()),
+    a chunk of orders and one query for their items at a time.
+    """
+    orders = queryset.prefetch_related(None).values_list(*ORDER_FIELDS).iterator(chunk_size=chunk_size)
+    for chunk in _chunks(orders, chunk_size):
+        items = _order_items_query([order[0] for order in chunk])
+        yield from _order_rows(chunk, items)
+
+
+def order_rows(queryset):
+    return list(iter_order_rows(queryset))
+
+
+async def aorder_rows(queryset):
+    # order_rows() for the async views
+    rows = []
+    orders = [order async for order in queryset.prefetch_related(None).values_list(*ORDER_FIELDS)]
+    for chunk in _chunks(orders, ORDER_ITEMS_CHUNK_SIZE):
+        items = [item async for item in _order_items_query([order[0] for order in chunk])]
+        rows += _order_rows(chunk, items)
+    return rows
@@ -1,4 +1,8 @@
+from datetime import datetime, time, timedelta
+
 import django_filters
+from django.utils import timezone
+from api import search
 from api.models import Product, Order
 from rest_framework import filters
 
@@ -8,6 +12,16 @@ class InStockFilterBackend(filters.BaseFilterBackend):
         return queryset.filter(stock__gt=0)
 
 
+class FullTextSearchFilter(filters.SearchFilter):
+    # FTS5 index on SQLite, ranked best match first unless ?ordering= is given
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        if not search_terms or not search.is_available(queryset.db):
+            return super().filter_queryset(request, queryset, view)
+
+        return search.search(queryset, search_terms).order_by('search_rank', 'pk')
+
+
 class ProductFilter(django_filters.FilterSet):
     class Meta:
         model = Product
@@ -20,10 +34,21 @@ class ProductFilter(django_filters.FilterSet):
 
 
 class OrderFilter(django_filters.FilterSet):
-    created_at = django_filters.DateFilter(field_name='created_at__date')
+    created_at = django_filters.DateFilter(method='filter_created_on')
+    # total_price is an annotation from Order.objects.with_totals()
+    total_price__gt = django_filters.NumberFilter(field_name='total_price', lookup_expr='gt')
+    total_price__lt = django_filters.NumberFilter(field_name='total_price', lookup_expr='lt')
+    ordering = django_filters.OrderingFilter(fields=('created_at', 'total_price'))
+
     class Meta:
         model = Order
         fields = {
             'status': ['exact'],
             'created_at': ['gt', 'lt', 'exact'],
         }
+
+    def filter_created_on(self, queryset, name, value):
+        # a range on the column rather than created_at__date, which no index can serve
+        start = timezone.make_aware(datetime.combine(value, time.min))
+        end = timezone.make_aware(datetime.combine(value + timedelta(days=1), time.min))
+        return queryset.filter(created_at__gte=start, created_at__lt=end)
@@ -0,0 +1,195 @@
+"""
+Resized WebP and JPEG copies of Product.image, made off the request thread.
+
+A saved product whose image changed is queued on commit, a small thread pool
+(Pillow releases the GIL while it decodes, resizes and encodes) writes one file
+per size and format next to the original and records them, with the original's
+width and height, on the row. The API and the templates then link the size they
+need instead of the multi-MB upload.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Now
+from PIL import ExifTags, Image, ImageOps
+
+from api.caching import invalidate_product_list, product_cache
+from api.models import Product
+
+logger = logging.getLogger(__name__)
+
+# longest edge in pixels, smaller originals are never scaled up
+RENDITION_SIZES = {'thumbnail': 160, 'card': 480, 'full': 1600}
+# (Pillow format, extension, save() options)
+RENDITION_FORMATS = {
+    'webp': ('WEBP', '.webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', '.jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_options():
+    return {
+        # background threads, 0 makes the renditions inline when the transaction commits
+        'WORKERS': 2,
+        'SIZES': RENDITION_SIZES,
+        **getattr(settings, 'PRODUCT_IMAGES', {}),
+    }
+
+
+def rendition_urls(renditions):
+    """
+    {size: {'width', 'height', 'webp', 'jpeg'}} with URLs for `Product.image_renditions`,
+    None until the renditions exist.
+    """
+    sizes = (renditions or {}).get('sizes')
+    if not sizes:
+        return None
+    return {
+        size: {
+            'width': rendition['width'],
+            'height': rendition['height'],
+            **{fmt: default_storage.url(rendition[fmt]) for fmt in RENDITION_FORMATS},
+        }
+        for size, rendition in sizes.items()
+    }
+
+
+def is_stale(product):
+    # renditions are recorded with the image they were made from
+    return (product.image.name or None) != (product.image_renditions or {}).get('source')
+
+
+def make_renditions(pk, name, sizes=None):
+    """
+    Write every size and format of the image `name`, returns (width, height, renditions).
+
+    No database access, so bulk regeneration can run it in worker processes.
+    """
+    sizes = sizes or get_options()['SIZES']
+    directory, filename = os.path.split(name)
+    stem = os.path.splitext(filename)[0]
+
+    with default_storage.open(name) as f, Image.open(f) as image:
+        width, height = image.size
+        if image.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        # JPEGs decode straight at a fraction of their size when that is still big enough
+        image.draft('RGB', (max(sizes.values()),) * 2)
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+        renditions = {}
+        # largest first, each size is scaled down from the one before
+        for size, edge in sorted(sizes.items(), key=lambda item: -item[1]):
+            image = image.copy()
+            image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            rendition = {'width': image.width, 'height': image.height}
+            for fmt, (pillow_format, extension, options) in RENDITION_FORMATS.items():
+                content = image
+                if pillow_format == 'JPEG' and image.mode == 'RGBA':
+                    # no alpha in JPEG, flatten onto white
+                    content = Image.new('RGB', image.size, 'white')
+                    content.paste(image, mask=image.getchannel('A'))
+                buffer = BytesIO()
+                content.save(buffer, pillow_format, **options)
+                path = os.path.join(directory, 'renditions', str(pk), f'{stem}-{size}{extension}')
+                rendition[fmt] = default_storage.save(path, ContentFile(buffer.getvalue()))
+            renditions[size] = rendition
+    return width, height, renditions
+
+
+def store_renditions(pk, name, result):
+    """
+    Record the result of make_renditions() for the image `name` and remove the files
+    it replaces, None for both clears them.
+
+    Nothing is recorded when the product's image changed in the meantime, the newer
+    image has its own run queued.
+    """
+    width, height, renditions = result or (None, None, {})
+    old = Product.objects.filter(pk=pk).values_list('image_renditions', flat=True).first()
+    current = Q(image=name) if name else Q(image='') | Q(image__isnull=True)
+    updated = Product.objects.filter(current, pk=pk).update(
+        image_width=width,
+        image_height=height,
+        image_renditions={'source': name, 'sizes': renditions} if name else {},
+        updated_at=Now(),
+    )
+    if not updated:
+        _delete(renditions)
+        return False
+
+    _delete((old or {}).get('sizes', {}), keep=renditions)
+    # update() sends no post_save
+    invalidate_product_list()
+    product_cache.invalidate(pk)
+    return True
+
+
+def _delete(renditions, keep=None):
+    kept = {path for rendition in (keep or {}).values() for path in _paths(rendition)}
+    for rendition in renditions.values():
+        for path in _paths(rendition):
+            if path not in kept:
+                default_storage.delete(path)
+
+
+def _paths(rendition):
+    return [rendition[fmt] for fmt in RENDITION_FORMATS if fmt in rendition]
+
+
+def delete_renditions(product):
+    # for a deleted product, once the delete is committed
+    renditions = (product.image_renditions or {}).get('sizes', {})
+    if renditions:
+        transaction.on_commit(lambda: _delete(renditions))
+
+
+def process_product_image(pk):
+    """
+    Bring one product's renditions in line with its current image.
+    """
+    try:
+        name = Product.objects.filter(pk=pk).values_list('image', flat=True).first() or None
+        store_renditions(pk, name, make_renditions(pk, name) if name else None)
+    except Exception:
+        logger.exception('Image renditions failed for product %s', pk)
+
+
+def schedule_renditions(product):
+    # after commit, the worker must see the new image name
+    pk = product.pk
+    transaction.on_commit(lambda: _submit(pk))
+
+
+def _submit(pk):
+    global _executor
+    workers = get_options()['WORKERS']
+    if not workers:
+        process_product_image(pk)
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='product-images')
+    _executor.submit(_run_in_worker, pk)
+
+
+def _run_in_worker(pk):
+    try:
+        process_product_image(pk)
+    finally:
+        # pool threads outlive the request, don't leave their connection open
+        connection.close()
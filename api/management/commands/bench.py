@@ -0,0 +1,304 @@
+import json
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import (CaptureQueriesContext, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from django.utils import lorem_ipsum
+from django.utils.http import urlencode
+from rest_framework.throttling import SimpleRateThrottle
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.caching import bulk_product_changes, product_cache
+from api.metrics import get_options as metrics_options
+from api.models import Order, OrderItem, Product, User
+
+BENCH_PASSWORD = 'bench-password'
+# every throttle scope the views use, high enough to never kick in
+UNTHROTTLED = {scope: '1000000/second' for scope in ('anon', 'user', 'products', 'orders')}
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# cold: the shared cache and the local product cache are emptied before every request
+MODES = ('cold', 'warm')
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway database and reports latency, queries and memory for every endpoint, as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--orders', type=int, default=500, help='orders of the user that makes the order requests')
+        parser.add_argument('--items-per-order', type=int, default=3)
+        parser.add_argument('--requests', type=int, default=50, help='timed requests per endpoint and mode')
+        parser.add_argument('--warmup', type=int, default=2, help='untimed requests per endpoint before the warm run')
+        parser.add_argument('--endpoint', action='append', dest='endpoints', help='only run these endpoints')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--locmem-cache', action='store_true', help='use a local memory cache instead of CACHES')
+        parser.add_argument('--with-silk', action='store_true', help='keep the silk middleware in the chain')
+        parser.add_argument('--output', help='write the JSON report to this file')
+        parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='fraction a p95 may grow over the baseline before it counts as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['locmem_cache']:
+            overrides['CACHES'] = LOCMEM_CACHE
+        # query budgets are checked by the tests, here they would only add overhead
+        overrides['QUERY_BUDGET'] = {**getattr(settings, 'QUERY_BUDGET', {}), 'ENABLED': False}
+        if not options['with_silk']:
+            overrides['MIDDLEWARE'] = [name for name in settings.MIDDLEWARE if 'SilkyMiddleware' not in name]
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(**overrides), mock.patch.dict(SimpleRateThrottle.THROTTLE_RATES, UNTHROTTLED):
+                cache.clear()
+                product_cache.clear_local()
+                fixtures = self.seed(options)
+                results = self.run(self.endpoints(fixtures), fixtures, options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'vendor': connection.vendor,
+                'cache': (LOCMEM_CACHE if options['locmem_cache'] else settings.CACHES)['default']['BACKEND'],
+                'silk': options['with_silk'],
+            },
+            'dataset': {name: options[name] for name in ('products', 'users', 'orders', 'items_per_order', 'seed')},
+            'requests': options['requests'],
+            'endpoints': results,
+        }
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                report['regressions'] = self.compare(json.load(f), results, options['threshold'])
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if report.get('regressions') and options['fail_on_regression']:
+            raise CommandError(f'{len(report["regressions"])} endpoint(s) regressed')
+
+    def seed(self, options):
+        rng = random.Random(options['seed'])
+        description = lorem_ipsum.paragraph()
+
+        with bulk_product_changes():
+            Product.objects.bulk_create([
+                Product(
+                    name=f'{rng.choice(lorem_ipsum.WORDS).title()} {i}',
+                    description=description,
+                    price=Decimal(rng.randint(100, 50000)) / 100,
+                    stock=rng.choice((0, rng.randint(1, 500))),
+                )
+                for i in range(options['products'])
+            ], batch_size=1000)
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+
+        admin = User.objects.create_superuser(username='bench-admin', password=BENCH_PASSWORD)
+        users = User.objects.bulk_create([User(username=f'bench-user-{i}') for i in range(options['users'])])
+        user = User.objects.create_user(username='bench-user', password=BENCH_PASSWORD)
+        users.append(user)
+
+        orders = Order.objects.bulk_create([
+            Order(user=owner, status=rng.choice(Order.StatusChoices.values))
+            for owner in users
+            for _ in range(options['orders'] if owner is user else max(1, options['orders'] // 10))
+        ], batch_size=1000)
+
+        # the delete routes use up one row per request, out of stock and owned by
+        # another user so they stay out of the lists being measured
+        disposable = options['warmup'] + len(MODES) * (options['requests'] + 1)
+        with bulk_product_changes():
+            disposable_products = Product.objects.bulk_create([
+                Product(name=f'Disposable {i}', description=description, price=Decimal('1.00'), stock=0)
+                for i in range(disposable)
+            ], batch_size=1000)
+        disposable_orders = Order.objects.bulk_create(
+            [Order(user=users[0], status=Order.StatusChoices.PENDING) for _ in range(disposable)], batch_size=1000
+        )
+
+        items_per_order = min(options['items_per_order'], len(product_ids))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=product_id, quantity=rng.randint(1, 5))
+            for order in orders + disposable_orders
+            for product_id in rng.sample(product_ids, items_per_order)
+        ], batch_size=1000)
+
+        return {
+            'rng': rng,
+            'admin': admin,
+            'user': user,
+            'product_ids': product_ids,
+            # a confirmed order reserves its new items, they have to be in stock
+            'in_stock_ids': list(Product.objects.filter(stock__gte=10).values_list('pk', flat=True)),
+            'names': list(Product.objects.values_list('name', flat=True)[:100]),
+            'order_ids': [order.pk for order in orders if order.user_id == user.pk],
+            'search_word': rng.choice(lorem_ipsum.WORDS),
+            'disposable_product_ids': [product.pk for product in disposable_products],
+            'disposable_order_ids': [order.pk for order in disposable_orders],
+        }
+
+    def endpoints(self, fixtures):
+        """
+        (name, method, path or callable returning one, body, auth) for every route.
+        """
+        rng = fixtures['rng']
+        product = lambda: rng.choice(fixtures['product_ids'])
+        order = lambda: rng.choice(fixtures['order_ids'])
+
+        def by_name():
+            return '/api/products/?' + urlencode({'name__iexact': rng.choice(fixtures['names']).lower()})
+
+        def new_order(status='Pending'):
+            return {
+                'status': status,
+                'items': [{'product': pk, 'quantity': 1} for pk in rng.sample(fixtures['in_stock_ids'], 2)],
+            }
+
+        def new_product():
+            return {'name': f'New {rng.random()}', 'description': 'new', 'price': '9.99', 'stock': 10}
+
+        def refresh():
+            return {'refresh': str(RefreshToken.for_user(fixtures['user']))}
+
+        return [
+            ('product_list', 'get', '/api/products/', None, None),
+            ('product_list_price_range', 'get', '/api/products/?price__range=10,100', None, None),
+            ('product_list_name', 'get', by_name, None, None),
+            ('product_list_search', 'get', f'/api/products/?search={fixtures["search_word"]}', None, None),
+            ('product_list_ordering', 'get', '/api/products/?ordering=-price&page_size=100', None, None),
+            ('product_detail', 'get', lambda: f'/api/products/{product()}/', None, None),
+            ('product_create', 'post', '/api/products/', new_product, 'admin'),
+            ('product_update', 'patch', lambda: f'/api/products/{product()}/', {'description': 'updated'}, 'admin'),
+            ('product_delete', 'delete', lambda: f'/api/products/{fixtures["disposable_product_ids"].pop()}/', None, 'admin'),
+            ('product_info', 'get', '/api/products/info/?include_products=false', None, None),
+            ('product_info_page', 'get', '/api/products/info/?page_size=20', None, None),
+            ('product_list_html', 'get', '/products/', None, None),
+            ('product_detail_html', 'get', lambda: f'/products/{product()}/', None, None),
+            ('order_list', 'get', '/orders/', None, 'user'),
+            ('order_list_status', 'get', '/orders/?status=Confirmed', None, 'user'),
+            ('order_detail', 'get', lambda: f'/orders/{order()}/', None, 'user'),
+            ('order_create', 'post', '/orders/', new_order, 'user'),
+            ('order_update', 'patch', lambda: f'/orders/{order()}/', {'status': 'Canceled'}, 'user'),
+            ('order_replace', 'put', lambda: f'/orders/{order()}/', lambda: new_order('Canceled'), 'user'),
+            ('order_delete', 'delete', lambda: f'/orders/{fixtures["disposable_order_ids"].pop()}/', None, 'admin'),
+            ('order_batch', 'post', '/orders/batch/', lambda: [new_order() for _ in range(10)], 'user'),
+            ('order_export', 'get', '/orders/export/?export_format=ndjson', None, 'user'),
+            ('user_list', 'get', '/users/', None, None),
+            ('token_obtain', 'post', '/api/token/', {'username': 'bench-user', 'password': BENCH_PASSWORD}, None),
+            ('token_refresh', 'post', '/api/token/refresh/', refresh, None),
+            ('metrics', 'get', '/metrics', None, 'metrics'),
+            ('schema', 'get', '/api/schema/', None, None),
+        ]
+
+    def run(self, endpoints, fixtures, options):
+        client = Client()
+        tokens = {role: f'Bearer {RefreshToken.for_user(fixtures[role]).access_token}' for role in ('admin', 'user')}
+        if metrics_options()['TOKEN']:
+            tokens['metrics'] = f'Bearer {metrics_options()["TOKEN"]}'
+
+        results = {}
+        for name, method, path, body, auth in endpoints:
+            if options['endpoints'] and name not in options['endpoints']:
+                continue
+
+            def request():
+                url = path() if callable(path) else path
+                data = body() if callable(body) else body
+                headers = {'Authorization': tokens[auth]} if auth in tokens else {}
+                if data is None:
+                    response = getattr(client, method)(url, headers=headers)
+                else:
+                    response = getattr(client, method)(url, data, content_type='application/json', headers=headers)
+                # streamed responses only do their work while being read
+                if response.streaming:
+                    for _ in response.streaming_content:
+                        pass
+                return response
+
+            results[name] = {'cold': self.measure(request, options, cold=True)}
+            for _ in range(options['warmup']):
+                request()
+            results[name]['warm'] = self.measure(request, options, cold=False)
+            self.stderr.write(f'{name}: ' + ', '.join(
+                f'{mode} p95 {results[name][mode]["p95_ms"]} ms, {results[name][mode]["queries"]} queries'
+                for mode in MODES
+            ))
+        return results
+
+    def measure(self, request, options, cold):
+        def timed():
+            if cold:
+                # the caches are emptied outside of the timing
+                cache.clear()
+                product_cache.clear_local()
+            started = time.perf_counter()
+            response = request()
+            return response, time.perf_counter() - started
+
+        latencies = []
+        statuses = set()
+        for _ in range(options['requests']):
+            response, latency = timed()
+            statuses.add(response.status_code)
+            latencies.append(latency)
+
+        # queries and memory from one more request, tracing would skew the timings
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                timed()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'status': sorted(statuses),
+            'requests_per_second': round(len(latencies) / sum(latencies), 1),
+            'p50_ms': self.percentile(latencies, 50),
+            'p95_ms': self.percentile(latencies, 95),
+            'p99_ms': self.percentile(latencies, 99),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+            'queries': len(queries),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+
+    @staticmethod
+    def percentile(latencies, percent):
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, round(percent / 100 * (len(ordered) - 1)))
+        return round(ordered[index] * 1000, 3)
+
+    @staticmethod
+    def compare(baseline, results, threshold):
+        regressions = []
+        for name, modes in results.items():
+            for mode, result in modes.items():
+                before = baseline.get('endpoints', {}).get(name, {}).get(mode)
+                if before is None:
+                    continue
+                if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                    regressions.append({'endpoint': name, 'mode': mode, 'metric': 'p95_ms',
+                                        'baseline': before['p95_ms'], 'current': result['p95_ms']})
+                if result['queries'] > before['queries']:
+                    regressions.append({'endpoint': name, 'mode': mode, 'metric': 'queries',
+                                        'baseline': before['queries'], 'current': result['queries']})
+        return regressions
@@ -0,0 +1,123 @@
+import json
+import random
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.utils import lorem_ipsum, timezone
+from rest_framework.renderers import JSONRenderer
+
+from api.fast_serializers import datetime_string, decimal_string
+from api.models import Order
+from api.renderers import MessagePackRenderer, ORJSONRenderer
+
+RENDERERS = {
+    'drf_json': JSONRenderer,
+    'orjson': ORJSONRenderer,
+    'msgpack': MessagePackRenderer,
+}
+
+
+class Command(BaseCommand):
+    help = 'Encode time and payload size of the JSON and MessagePack renderers on large list payloads, as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--items-per-order', type=int, default=3)
+        parser.add_argument('--repeat', type=int, default=5, help='encodes per renderer, the fastest one counts')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        payloads = {
+            'products': self.products(rng, options['products']),
+            'orders': self.orders(rng, options['orders'], options['items_per_order'], native=False),
+            # uuids and datetimes as the model has them, the way the export and cached rows hold them
+            'orders_native': self.orders(rng, options['orders'], options['items_per_order'], native=True),
+        }
+
+        results = {}
+        for name, data in payloads.items():
+            results[name] = {}
+            for renderer_name, renderer_class in RENDERERS.items():
+                renderer = renderer_class()
+                timings = []
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    content = renderer.render(data)
+                    timings.append(time.perf_counter() - started)
+                results[name][renderer_name] = {
+                    'encode_ms': round(min(timings) * 1000, 3),
+                    'bytes': len(content),
+                }
+                if renderer_name == 'drf_json':
+                    expected = content
+                elif renderer.media_type == 'application/json':
+                    results[name][renderer_name]['same_bytes'] = content == expected
+            baseline = results[name]['drf_json']['encode_ms']
+            for renderer_name, result in results[name].items():
+                result['speedup'] = round(baseline / result['encode_ms'], 2) if result['encode_ms'] else None
+            self.stderr.write(', '.join(
+                f'{name} {renderer_name}: {result["encode_ms"]} ms, {result["bytes"]} bytes'
+                for renderer_name, result in results[name].items()
+            ))
+
+        report = {
+            'dataset': {name: options[name] for name in ('products', 'orders', 'items_per_order', 'seed')},
+            'repeat': options['repeat'],
+            'payloads': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    @staticmethod
+    def products(rng, count):
+        # the product list rows, prices already strings
+        return {
+            'next': None,
+            'previous': None,
+            'results': [
+                {
+                    'name': f'{rng.choice(lorem_ipsum.WORDS).title()} {i}',
+                    'description': ' '.join(rng.choices(lorem_ipsum.WORDS, k=rng.randint(8, 40))),
+                    'price': decimal_string(Decimal(rng.randint(50, 100000)) / 100),
+                    'stock': rng.randint(0, 500),
+                    'external_image_url': None,
+                }
+                for i in range(count)
+            ],
+        }
+
+    @staticmethod
+    def orders(rng, count, items_per_order, native):
+        # the order list rows, totals and subtotals are Decimals as order_rows() returns them
+        now = timezone.now()
+        rows = []
+        for _ in range(count):
+            items = []
+            for _ in range(items_per_order):
+                price, quantity = Decimal(rng.randint(50, 100000)) / 100, rng.randint(1, 5)
+                items.append({
+                    'product_name': rng.choice(lorem_ipsum.WORDS).title(),
+                    'product_price': decimal_string(price),
+                    'quantity': quantity,
+                    'item_subtotal': price * quantity,
+                })
+            order_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+            created_at = now - timedelta(seconds=rng.uniform(0, 365 * 24 * 3600))
+            rows.append({
+                'order_id': order_id if native else str(order_id),
+                'created_at': created_at if native else datetime_string(created_at),
+                'user': rng.randint(1, 1000),
+                'status': rng.choice(Order.StatusChoices.values),
+                'items': items,
+                'total_price': sum(item['item_subtotal'] for item in items),
+            })
+        return rows
@@ -0,0 +1,120 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+
+from api.caching import bulk_product_changes
+from api.models import Order, OrderItem, Product, User
+from api.stock import InsufficientStock, order_quantities, set_status
+
+
+class Command(BaseCommand):
+    help = 'Confirms orders from many threads at once and checks that no product is oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--orders', type=int, default=400)
+        parser.add_argument('--products', type=int, default=10)
+        parser.add_argument('--stock', type=int, default=100, help='starting stock of every product')
+        parser.add_argument('--items-per-order', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='keep the generated rows')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+                journal_mode = cursor.fetchone()[0]
+        else:
+            journal_mode = None
+
+        user, _ = User.objects.get_or_create(username='bench-reservations')
+        products = Product.objects.bulk_create([
+            Product(name=f'bench-reservation-{i}', description='', price=Decimal('1.00'), stock=options['stock'])
+            for i in range(options['products'])
+        ])
+        orders = Order.objects.bulk_create([Order(user=user) for _ in range(options['orders'])])
+        items_per_order = min(options['items_per_order'], len(products))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=rng.randint(1, 5))
+            for order in orders
+            for product in rng.sample(products, items_per_order)
+        ], batch_size=500)
+
+        pending = list(orders)
+        lock = threading.Lock()
+        results = Counter()
+        latencies = []
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        order = pending.pop()
+                    started = time.perf_counter()
+                    try:
+                        set_status(order, Order.StatusChoices.CONFIRMED)
+                        outcome = 'confirmed'
+                    except InsufficientStock:
+                        outcome = 'rejected'
+                    except OperationalError:
+                        outcome = 'errors'
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        results[outcome] += 1
+                        latencies.append(elapsed)
+            finally:
+                # every thread has its own connection
+                connections.close_all()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        # the stock left must equal the starting stock minus every confirmed quantity
+        confirmed = Order.objects.filter(pk__in=[order.pk for order in orders], status=Order.StatusChoices.CONFIRMED)
+        sold = order_quantities(list(confirmed))
+        stock = dict(Product.objects.filter(pk__in=[product.pk for product in products]).values_list('pk', 'stock'))
+        oversold = sum(1 for product in products if sold[product.pk] > options['stock'])
+        mismatched = sum(1 for product in products if stock[product.pk] != options['stock'] - sold[product.pk])
+
+        latencies.sort()
+        report = {
+            'vendor': connection.vendor,
+            'journal_mode': journal_mode,
+            'threads': options['threads'],
+            'orders': options['orders'],
+            'confirmed': results['confirmed'],
+            'rejected': results['rejected'],
+            'errors': results['errors'],
+            'seconds': round(elapsed, 3),
+            'orders_per_second': round(len(orders) / elapsed, 1) if elapsed else None,
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+            'oversold_products': oversold,
+            'stock_mismatches': mismatched,
+        }
+
+        if not options['keep']:
+            Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+            with bulk_product_changes():
+                Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+
+        self.stdout.write(json.dumps(report, indent=2))
+        if oversold or mismatched:
+            self.stderr.write(self.style.ERROR('Stock invariant violated'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No oversell'))
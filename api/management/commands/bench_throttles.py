@@ -0,0 +1,140 @@
+import json
+import multiprocessing
+import pickle
+import statistics
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.throttling import SimpleRateThrottle
+
+from api.throttles import SlidingWindowRateThrottle
+
+# requests already in the window for the per-request cost runs
+HISTORIES = (100, 1000, 10000, 100000)
+
+
+class BenchThrottleMixin:
+    # one client, the key is fixed so no request object is needed
+    def __init__(self, rate, key):
+        self.rate = rate
+        self.num_requests, self.duration = self.parse_rate(rate)
+        self.bench_key = key
+
+    def get_cache_key(self, request, view):
+        return self.bench_key
+
+
+class DRFThrottle(BenchThrottleMixin, SimpleRateThrottle):
+    pass
+
+
+class SlidingWindowThrottle(BenchThrottleMixin, SlidingWindowRateThrottle):
+    pass
+
+
+THROTTLES = {
+    'drf': DRFThrottle,
+    'sliding_window': SlidingWindowThrottle,
+}
+
+
+class Command(BaseCommand):
+    help = ('Per-request cost of the DRF and sliding-window throttles as the window fills up, and the requests '
+            'they let through when several processes share one limit, as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=200, help='timed requests per history size')
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=500, help='requests per process against the shared limit')
+        parser.add_argument('--limit', type=int, default=100, help='requests per hour allowed to the shared client')
+        parser.add_argument('--output', help='write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        report = {
+            'cache': settings.CACHES['default']['BACKEND'],
+            'per_request': self.per_request(options['samples']),
+        }
+        if options['processes'] > 1:
+            if 'locmem' in report['cache'] or 'dummy' in report['cache']:
+                raise CommandError('the multi-process run needs a cache shared between processes, '
+                                   'CACHES["default"] is per process')
+            report['shared_limit'] = self.shared_limit(options['processes'], options['requests'], options['limit'])
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def per_request(self, samples):
+        results = {}
+        for history in HISTORIES:
+            # high enough that no sample is denied, both throttles do their full work
+            rate = f'{history * 2 + samples}/hour'
+            results[history] = {}
+            for name, throttle_class in THROTTLES.items():
+                key = f'bench-throttle:{uuid.uuid4().hex}'
+                throttle = throttle_class(rate, key)
+                timings = []
+                for _ in range(samples):
+                    # back to `history` requests in the window before each one, untimed
+                    state = self.fill(throttle, history)
+                    started = time.perf_counter()
+                    throttle.allow_request(None, None)
+                    timings.append(time.perf_counter() - started)
+                state = self.fill(throttle, history)
+                results[history][name] = {
+                    'us_per_request': round(statistics.median(timings) * 1e6, 1),
+                    'state_bytes': sum(len(pickle.dumps(value)) for value in state.values()),
+                }
+                cache.delete_many(list(state))
+            self.stderr.write(f'{history} in window: ' + ', '.join(
+                f'{name} {result["us_per_request"]} us, {result["state_bytes"]} bytes'
+                for name, result in results[history].items()
+            ))
+        return results
+
+    @staticmethod
+    def fill(throttle, history):
+        now = throttle.timer()
+        if isinstance(throttle, SlidingWindowRateThrottle):
+            window = int(now // throttle.duration)
+            state = {f'{throttle.bench_key}:{window}': history, f'{throttle.bench_key}:{window - 1}': 0}
+        else:
+            # newest first, spread over the last half of the window
+            step = throttle.duration / 2 / history
+            state = {throttle.bench_key: [now - i * step for i in range(history)]}
+        cache.set_many(state, throttle.duration * 2)
+        return state
+
+    def shared_limit(self, processes, requests, limit):
+        results = {}
+        for name in THROTTLES:
+            key = f'bench-throttle:{uuid.uuid4().hex}'
+            # children open their own cache connections
+            cache.close()
+            started = time.perf_counter()
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                allowed = sum(pool.map(hammer, [(name, f'{limit}/hour', key, requests)] * processes))
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                'limit': limit,
+                'allowed': allowed,
+                'requests': processes * requests,
+                'requests_per_s': round(processes * requests / elapsed),
+            }
+            window = int(time.time() // 3600)
+            cache.delete_many([key, f'{key}:{window}', f'{key}:{window - 1}'])
+            self.stderr.write(f'{name}: {allowed} of {processes * requests} allowed by {processes} processes, '
+                              f'limit {limit}')
+        return results
+
+
+def hammer(task):
+    # module level, so worker processes can be handed tasks
+    name, rate, key, requests = task
+    throttle = THROTTLES[name](rate, key)
+    return sum(bool(throttle.allow_request(None, None)) for _ in range(requests))
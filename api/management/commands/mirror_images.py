@@ -0,0 +1,69 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+from django.db.models.fields.json import KT
+from django.utils import timezone
+
+from api.caching import bulk_product_changes
+from api.mirror import FAILED, MIRRORED, NOT_MODIFIED, get_options, mirror_products
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = ('Fetches a local copy of every external product image that has none, failed or is due '
+            'for revalidation, with bounded concurrency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help='only these products')
+        parser.add_argument('--concurrency', type=int, help='requests in flight at once, EXTERNAL_IMAGE_MIRROR by default')
+        parser.add_argument('--max-age', type=int,
+                            help='seconds after which a mirrored copy is revalidated, EXTERNAL_IMAGE_MIRROR by default')
+        parser.add_argument('--all', action='store_true', help='revalidate every copy, however recent')
+
+    def handle(self, *args, **options):
+        max_age = options['max_age'] if options['max_age'] is not None else get_options()['MAX_AGE']
+        checked_before = timezone.now() - timedelta(seconds=max_age)
+
+        products = (
+            Product.objects
+            .filter(external_image_url__isnull=False)
+            .exclude(external_image_url='')
+            .annotate(mirrored_url=KT('external_image_mirror__url'))
+        )
+        if options['product_ids']:
+            products = products.filter(pk__in=options['product_ids'])
+        if not options['all']:
+            products = products.filter(
+                ~Q(external_image_status=Product.MirrorStatus.MIRRORED)
+                | Q(external_image_checked_at__isnull=True)
+                | Q(external_image_checked_at__lt=checked_before)
+                # urls changed by update() or an import have no background fetch queued
+                | Q(mirrored_url__isnull=True)
+                | ~Q(mirrored_url=F('external_image_url'))
+            )
+        rows = list(products.order_by('pk').values_list('pk', 'external_image_url', 'external_image_mirror'))
+
+        started = time.perf_counter()
+        done = 0
+
+        def progress(pk, url, outcome, mirror):
+            nonlocal done
+            done += 1
+            if outcome == FAILED:
+                self.stderr.write(f'\nproduct {pk} ({url}): {mirror["error"]}')
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'\rimages: {done}/{len(rows)} ({done * 100 // len(rows)}%), {done / elapsed if elapsed else 0:,.1f}/s',
+                ending='',
+            )
+            self.stdout.flush()
+
+        with bulk_product_changes():
+            counts = mirror_products(rows, options['concurrency'], on_result=progress)
+
+        self.stdout.write(
+            f'\n{counts[MIRRORED]} fetched, {counts[NOT_MODIFIED]} not modified, {counts[FAILED]} failed '
+            f'in {time.perf_counter() - started:.1f}s'
+        )
@@ -1,20 +1,57 @@
+import multiprocessing
 import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
 from decimal import Decimal
 
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
 from django.utils import lorem_ipsum
-from api.models import User, Product, Order, OrderItem
+
+from api.caching import bulk_product_changes, invalidate_order_list
+from api.models import Order, OrderItem, Product, User
+
+# rows written per transaction, also the unit of work handed to a worker process
+DEFAULT_BATCH_SIZE = 20000
+ORDER_STATUSES = (
+    (Order.StatusChoices.CONFIRMED, 0.7),
+    (Order.StatusChoices.PENDING, 0.2),
+    (Order.StatusChoices.CANCELED, 0.1),
+)
+# generated timestamps count back from here, not from the clock, so a seed always gives the same rows
+EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
 
 class Command(BaseCommand):
-    help = 'Creates application data'
+    help = 'Creates application data, a small demo set or, with --products/--users/--orders, a generated one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=0)
+        parser.add_argument('--users', type=int, default=0)
+        parser.add_argument('--orders', type=int, default=0)
+        parser.add_argument('--items-per-order', type=int, default=5, help='average items per generated order')
+        parser.add_argument('--seed', type=int, default=0, help='same seed, same rows')
+        parser.add_argument('--epoch', type=_aware_datetime, default=EPOCH,
+                            help='ISO datetime the generated created_at/date_joined/updated_at count back from')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='processes writing batches in parallel, SQLite always uses one')
 
-    def handle(self, *args, **kwargs):
+    def handle(self, *args, **options):
         # get or create superuser
         user = User.objects.filter(username='admin').first()
         if not user:
             user = User.objects.create_superuser(username='admin', password='test')
 
+        if options['products'] or options['users'] or options['orders']:
+            self.generate(user, options)
+        else:
+            self.create_demo_data(user)
+
+    def create_demo_data(self, user):
         # create products - name, desc, price, stock, image
         products = [
             Product(name="A Scanner Darkly", description=lorem_ipsum.paragraph(), price=Decimal('12.99'), stock=4),
@@ -25,8 +62,9 @@ class Command(BaseCommand):
             Product(name="Watch", description=lorem_ipsum.paragraph(), price=Decimal('500.05'), stock=0),
         ]
 
-        # create products & re-fetch from DB
-        Product.objects.bulk_create(products)
+        # create products & re-fetch from DB, bulk_create sends no signals so bump the cache once
+        with bulk_product_changes():
+            Product.objects.bulk_create(products)
         products = Product.objects.all()
 
 
@@ -37,4 +75,170 @@ class Command(BaseCommand):
             for product in random.sample(list(products), 2):
                 OrderItem.objects.create(
                     order=order, product=product, quantity=random.randint(1,3)
-                )
\ No newline at end of file
+                )
+
+    def generate(self, admin, options):
+        """
+        Batched multi-row inserts, one transaction per batch.
+
+        Every batch draws from its own Random(seed, kind, offset) and new rows get
+        explicit ids after the current maximum, so the same seed on the same database
+        gives the same rows however many workers write them.
+        """
+        workers = options['workers']
+        if workers > 1 and connection.vendor == 'sqlite':
+            self.stderr.write('SQLite has a single writer, using one worker')
+            workers = 1
+
+        context = {
+            'seed': options['seed'],
+            'user_base': (User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1,
+            'product_base': (Product.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1,
+            'users': options['users'],
+            'products': options['products'] or Product.objects.count(),
+            'items_per_order': options['items_per_order'],
+            'admin_id': admin.pk,
+            'now': options['epoch'],
+            'password': make_password('test'),
+        }
+        if options['orders'] and not (options['products'] or Product.objects.exists()):
+            self.stderr.write('No products to order, skipping orders')
+            options['orders'] = 0
+        if not options['products']:
+            # orders over the products that are already there
+            context['product_ids'] = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+
+        with bulk_product_changes():
+            # users and products first, orders point at both
+            self.run('users', options['users'], context, options['batch_size'], workers)
+            self.run('products', options['products'], context, options['batch_size'], workers)
+            self.run('orders', options['orders'], context, options['batch_size'] // max(1, options['items_per_order']),
+                     workers)
+
+        # explicit ids leave sequences behind on backends that have them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Product]):
+                cursor.execute(sql)
+        if options['orders']:
+            # new users have nothing cached, the admin and the staff list may
+            invalidate_order_list(admin.pk)
+
+    def run(self, kind, total, context, batch_size, workers):
+        if not total:
+            return
+        batch_size = max(1, batch_size)
+        batches = [(kind, start, min(batch_size, total - start), context) for start in range(0, total, batch_size)]
+
+        started = time.perf_counter()
+        done = rows = 0
+        if workers > 1:
+            # children must not share the parent's connection
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for count, written in pool.imap_unordered(write_batch, batches):
+                    done, rows = done + count, rows + written
+                    self.progress(kind, done, total, rows, started)
+        else:
+            for batch in batches:
+                count, written = write_batch(batch)
+                done, rows = done + count, rows + written
+                self.progress(kind, done, total, rows, started)
+        self.stdout.write(f'\n{kind}: {done} in {time.perf_counter() - started:.1f}s')
+
+    def progress(self, kind, done, total, rows, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'\r{kind}: {done}/{total} ({done * 100 // total}%), {rows / elapsed if elapsed else 0:,.0f} rows/s',
+            ending='',
+        )
+        self.stdout.flush()
+
+
+def _aware_datetime(value):
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=dt_timezone.utc)
+
+
+def write_batch(batch):
+    # module level, so worker processes can be handed batches
+    kind, start, count, context = batch
+    rng = random.Random(f'{context["seed"]}:{kind}:{start}')
+    tables = GENERATORS[kind](rng, start, count, context)
+    with transaction.atomic():
+        for model, fields, rows in tables:
+            _insert(model, fields, rows)
+    return count, sum(len(rows) for _, _, rows in tables)
+
+
+def _insert(model, names, rows):
+    # the proxy behind django.db.connection costs a lookup per call, resolve it once
+    db = connections[DEFAULT_DB_ALIAS]
+    fields = [model._meta.get_field(name) for name in names]
+    quote = db.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    # the same conversions the ORM applies, without building model instances
+    rows = [[field.get_db_prep_save(value, db) for field, value in zip(fields, row)] for row in rows]
+    with db.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def _users(rng, start, count, context):
+    now = context['now']
+    rows = []
+    for pk in range(context['user_base'] + start, context['user_base'] + start + count):
+        joined = now - timedelta(days=rng.uniform(0, 3 * 365))
+        rows.append((pk, f'user{pk}', f'user{pk}@example.com', context['password'], joined))
+    fields = ('id', 'username', 'email', 'password', 'date_joined')
+    defaults = {'first_name': '', 'last_name': '', 'is_superuser': False, 'is_staff': False, 'is_active': True}
+    return [(User, fields + tuple(defaults), [row + tuple(defaults.values()) for row in rows])]
+
+
+def _products(rng, start, count, context):
+    words = lorem_ipsum.WORDS
+    rows = []
+    for pk in range(context['product_base'] + start, context['product_base'] + start + count):
+        # prices are log-normal, most under 100 with a long tail
+        price = Decimal(min(max(rng.lognormvariate(3.3, 1.1), 0.5), 99999)).quantize(Decimal('0.01'))
+        # about one product in ten is sold out
+        stock = 0 if rng.random() < 0.1 else int(rng.expovariate(1 / 40)) + 1
+        name = f'{rng.choice(words).title()} {rng.choice(words)} {pk}'
+        description = ' '.join(rng.choices(words, k=rng.randint(8, 40))).capitalize() + '.'
+        rows.append((pk, name, description, price, stock, context['now']))
+    fields = ('id', 'name', 'description', 'price', 'stock', 'updated_at')
+    defaults = {'image_renditions': {}, 'external_image_mirror': {}, 'external_image_status': ''}
+    return [(Product, fields + tuple(defaults), [row + tuple(defaults.values()) for row in rows])]
+
+
+def _orders(rng, start, count, context):
+    statuses, weights = zip(*ORDER_STATUSES)
+    products, items_per_order = context['products'], context['items_per_order']
+    product_ids = context.get('product_ids')
+    orders, items = [], []
+    for _ in range(count):
+        order_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+        if context['users']:
+            user_id = context['user_base'] + rng.randrange(context['users'])
+        else:
+            user_id = context['admin_id']
+        created_at = context['now'] - timedelta(seconds=rng.uniform(0, 365 * 24 * 3600))
+        orders.append((order_id, user_id, rng.choices(statuses, weights)[0], created_at, created_at))
+
+        # a few products sell far more than the rest
+        wanted = min(products, rng.randint(1, 2 * items_per_order - 1))
+        chosen = set()
+        while len(chosen) < wanted:
+            chosen.add(int(products * rng.random() ** 3))
+        for index in sorted(chosen):
+            product_id = product_ids[index] if product_ids else context['product_base'] + index
+            items.append((order_id, product_id, rng.randint(1, 5)))
+    return [
+        (Order, ('order_id', 'user', 'status', 'created_at', 'updated_at'), orders),
+        (OrderItem, ('order', 'product', 'quantity'), items),
+    ]
+
+
+GENERATORS = {'users': _users, 'products': _products, 'orders': _orders}
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product full-text search index from the product table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        search.forget(options['database'])
+        if not search.is_available(options['database']):
+            raise CommandError('Full-text search needs SQLite with migration api.0004 applied')
+
+        search.rebuild(options['database'])
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
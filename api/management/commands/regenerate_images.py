@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Q
+
+from api.caching import bulk_product_changes
+from api.images import get_options, make_renditions, store_renditions
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Regenerates the resized copies of product images, in parallel worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help='only these products')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--stale', action='store_true',
+                            help='only products whose renditions are missing or made from an older image')
+
+    def handle(self, *args, **options):
+        products = Product.objects.filter(~Q(image='') & Q(image__isnull=False) | ~Q(image_renditions={}))
+        if options['product_ids']:
+            products = products.filter(pk__in=options['product_ids'])
+
+        sizes = get_options()['SIZES']
+        tasks, cleared = [], []
+        for pk, name, renditions in products.order_by('pk').values_list('pk', 'image', 'image_renditions'):
+            if options['stale'] and (name or None) == (renditions or {}).get('source'):
+                continue
+            if name:
+                tasks.append((pk, name, sizes))
+            else:
+                # the image was removed, only its renditions are left
+                cleared.append(pk)
+
+        started = time.perf_counter()
+        done = failed = 0
+        # one product list invalidation at the end, not one per product
+        with bulk_product_changes():
+            for pk in cleared:
+                store_renditions(pk, None, None)
+
+            if options['workers'] > 1 and len(tasks) > 1:
+                # children must not share the parent's connection, they never use one
+                connections.close_all()
+                with multiprocessing.get_context('fork').Pool(options['workers']) as pool:
+                    for pk, name, result, error in pool.imap_unordered(render, tasks):
+                        done, failed = self.store(pk, name, result, error, done, failed, len(tasks), started)
+            else:
+                for task in tasks:
+                    done, failed = self.store(*render(task), done, failed, len(tasks), started)
+
+        self.stdout.write(
+            f'\n{done} images, {failed} failed, {len(cleared)} cleared in {time.perf_counter() - started:.1f}s'
+        )
+
+    def store(self, pk, name, result, error, done, failed, total, started):
+        if error:
+            self.stderr.write(f'\nproduct {pk} ({name}): {error}')
+            failed += 1
+        else:
+            store_renditions(pk, name, result)
+        done += 1
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'\rimages: {done}/{total} ({done * 100 // total}%), {done / elapsed if elapsed else 0:,.1f}/s',
+            ending='',
+        )
+        self.stdout.flush()
+        return done, failed
+
+
+def render(task):
+    # module level, so worker processes can be handed tasks
+    pk, name, sizes = task
+    try:
+        return pk, name, make_renditions(pk, name, sizes), None
+    except Exception as exc:
+        return pk, name, None, f'{type(exc).__name__}: {exc}'
@@ -0,0 +1,309 @@
+"""
+Always-on request metrics, cheap enough for production.
+
+Every request adds to counters kept in process memory: a latency histogram per
+view, its query count and query time, and the hits and misses of the cache
+backends below. A background thread of each worker copies its counters to the
+shared cache every METRICS['FLUSH_INTERVAL'] seconds, under a slot of its own,
+and `/metrics` adds up all the slots in the Prometheus text format. Requests
+never wait for the copy.
+
+A slot expires a few intervals after its worker stops flushing, and the next
+worker to start takes it over. The totals of a worker that exited drop out
+of the sums, Prometheus reads that as a counter reset.
+"""
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache as BaseLocMemCache
+from django.db import connections
+from django_redis.cache import RedisCache as BaseRedisCache
+
+logger = logging.getLogger(__name__)
+
+# seconds, the upper bounds of the latency histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+
+# name: (type, help), histograms have _bucket, _sum and _count series
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by view, method and status code.'),
+    'http_request_duration_seconds': ('histogram', 'Time to the response, by view and method.'),
+    'db_queries_total': ('counter', 'Queries run by requests, by view.'),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in queries run by requests, by view.'),
+    'cache_lookups_total': ('counter', 'Cache keys looked up, by hit or miss.'),
+}
+
+# the highest slot taken so far, collect() reads the slots up to it
+SLOTS_KEY = 'metrics:slots'
+# flush intervals a slot outlives its worker's last flush
+SLOT_INTERVALS = 3
+
+# the execute wrappers of the request running in this context, see observe_queries()
+_query_observers = ContextVar('query_observers', default=())
+
+
+def get_options():
+    return {
+        # seconds between copies of a worker's counters to the shared cache
+        'FLUSH_INTERVAL': 10,
+        # the alias the workers' counters are shared in
+        'CACHE': 'default',
+        # start the flusher thread with the first request, off for the test suite
+        'FLUSH_THREAD': True,
+        # when set, `/metrics` wants an "Authorization: Bearer <token>" header
+        'TOKEN': None,
+        **getattr(settings, 'METRICS', {}),
+    }
+
+
+def _slot_key(slot):
+    return f'metrics:worker:{slot}'
+
+
+class Metrics:
+    """
+    Counters of one process, {(name, labels): value}.
+    """
+
+    def __init__(self):
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        # the flusher thread and `/metrics` both flush, one at a time, so they can't
+        # both claim a slot; it guards _pid, _slot and _owner
+        self._slot_lock = threading.Lock()
+        self._pid = None
+        self._slot = None
+        self._owner = None
+        self._flusher = None
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self._values[name, labels] += amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            for bound in DURATION_BUCKETS:
+                if value <= bound:
+                    self._values[f'{name}_bucket', labels + (('le', bound),)] += 1
+            self._values[f'{name}_sum', labels] += value
+            self._values[f'{name}_count', labels] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def maybe_flush(self):
+        # only makes sure the flusher runs, the request doesn't wait on the cache;
+        # a thread started before a fork isn't alive in the child
+        if (self._flusher is not None and self._flusher.is_alive()) or not get_options()['FLUSH_THREAD']:
+            return
+        with self._slot_lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_forever(self):
+        # an idle worker's slot doesn't expire
+        while True:
+            time.sleep(get_options()['FLUSH_INTERVAL'])
+            self.flush()
+
+    def flush(self):
+        # totals, not deltas, a flush that fails is made up by the next one
+        options = get_options()
+        cache = caches[options['CACHE']]
+        timeout = options['FLUSH_INTERVAL'] * SLOT_INTERVALS
+        with self._slot_lock:
+            try:
+                if self._pid != os.getpid():
+                    # a forked worker starts its own series, the parent's are the parent's
+                    with self._lock:
+                        if self._pid is not None:
+                            self._values.clear()
+                        self._pid = os.getpid()
+                    self._slot = None
+                entry = {'owner': self._owner, 'values': self.snapshot()}
+                if self._slot is not None:
+                    current = cache.get(_slot_key(self._slot))
+                    if current is None or current['owner'] == self._owner:
+                        cache.set(_slot_key(self._slot), entry, timeout)
+                        return
+                # expired and taken over while this worker didn't flush, or never had one
+                self._owner = entry['owner'] = uuid.uuid4().hex
+                self._slot = _claim_slot(cache, entry, timeout)
+            except Exception:
+                logger.warning('Copying the metrics of worker %s to the cache failed', os.getpid(), exc_info=True)
+
+    def reset(self):
+        # a new worker as far as the shared cache is concerned
+        with self._slot_lock, self._lock:
+            self._values.clear()
+            self._pid = self._slot = self._owner = None
+
+
+metrics = Metrics()
+
+
+def _claim_slot(cache, entry, timeout):
+    # the lowest free one, slots stay as many as the workers running at once
+    slot = 1
+    while not cache.add(_slot_key(slot), entry, timeout):
+        slot += 1
+    while (cache.get(SLOTS_KEY) or 0) < slot:
+        try:
+            cache.incr(SLOTS_KEY)
+        except ValueError:
+            cache.add(SLOTS_KEY, 0, timeout=None)
+    return slot
+
+
+def collect():
+    """
+    The counters of every worker, added up.
+    """
+    cache = caches[get_options()['CACHE']]
+    slots = cache.get(SLOTS_KEY) or 0
+    totals = defaultdict(float)
+    for entry in cache.get_many([_slot_key(slot) for slot in range(1, slots + 1)]).values():
+        for key, value in entry['values'].items():
+            totals[key] += value
+    return totals
+
+
+def render(values):
+    """
+    `values` in the Prometheus text exposition format.
+    """
+    series = defaultdict(list)
+    for (name, labels), value in values.items():
+        base = next((metric for metric in METRICS if name.startswith(metric)), name)
+        le = dict(labels).get('le', -math.inf)
+        series[base].append(((name, tuple(label for label in labels if label[0] != 'le'), le), name, labels, value))
+
+    lines = []
+    for base in sorted(series):
+        metric_type, description = METRICS.get(base, ('untyped', ''))
+        lines.append(f'# HELP {base} {description}')
+        lines.append(f'# TYPE {base} {metric_type}')
+        for _, name, labels, value in sorted(series[base], key=lambda entry: entry[0]):
+            lines.append(f'{name}{_labels(labels)} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = (f'{key}="{_escape(_number(value) if key == "le" else value)}"' for key, value in labels)
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+class QueryTimer:
+    """
+    Execute wrapper adding up a request's queries and the time they took.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+def _observe_query(execute, sql, params, many, context):
+    for observer in reversed(_query_observers.get()):
+        execute = partial(observer, execute)
+    return execute(sql, params, many, context)
+
+
+def install_query_hook(connection):
+    # every connection of every thread, api.signals installs it when one is opened
+    if _observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_observe_query)
+
+
+@contextmanager
+def observe_queries(observer):
+    """
+    Wrap the queries of the current context with `observer`, an execute wrapper.
+
+    Connections belong to a thread, under ASGI the queries run in the threads
+    sync_to_async hands them to. The context is copied there, so the observer
+    sees them wherever they run.
+    """
+    for connection in connections.all(initialized_only=True):
+        install_query_hook(connection)
+    token = _query_observers.set(_query_observers.get() + (observer,))
+    try:
+        yield observer
+    finally:
+        _query_observers.reset(token)
+
+
+def time_queries():
+    return observe_queries(QueryTimer())
+
+
+def record_request(request, response, duration, timer):
+    match = getattr(request, 'resolver_match', None)
+    # the route, not the path, one series per url pattern
+    view = match.route if match is not None else '<unresolved>'
+    labels = (('view', view), ('method', request.method))
+    metrics.inc('http_requests_total', labels + (('status', str(response.status_code)),))
+    metrics.observe('http_request_duration_seconds', labels, duration)
+    metrics.inc('db_queries_total', (('view', view),), timer.count)
+    metrics.inc('db_query_duration_seconds_total', (('view', view),), timer.duration)
+    metrics.maybe_flush()
+
+
+class CacheMetricsMixin:
+    """
+    Counts the hits and misses of get() and get_many(), the async variants call them.
+    """
+    _missing = object()
+
+    def get(self, key, default=None, version=None, **kwargs):
+        value = super().get(key, self._missing, version=version, **kwargs)
+        hit = value is not self._missing
+        metrics.inc('cache_lookups_total', (('result', 'hit' if hit else 'miss'),))
+        return value if hit else default
+
+    def get_many(self, keys, version=None, **kwargs):
+        keys = list(keys)
+        found = super().get_many(keys, version=version, **kwargs)
+        metrics.inc('cache_lookups_total', (('result', 'hit'),), len(found))
+        metrics.inc('cache_lookups_total', (('result', 'miss'),), len(keys) - len(found))
+        return found
+
+
+class RedisCache(CacheMetricsMixin, BaseRedisCache):
+    pass
+
+
+class LocMemCache(CacheMetricsMixin, BaseLocMemCache):
+    pass
@@ -0,0 +1,212 @@
+import time
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIRequest
+from silk.collector import DataCollector
+from silk.middleware import SilkyMiddleware as BaseSilkyMiddleware
+
+from api.authentication import arequest_user_id, request_user_id
+from api.metrics import record_request, time_queries
+from api.profiling import ashould_profile, install_sql_hook, should_profile
+from api.query_budget import check_budget, get_options, get_query_budget, record_queries
+from api.routers import (achoose_replica, afinish_request, choose_replica, end_request, finish_request, start_request,
+                         wants_replica)
+
+
+class ASGIURLConfMiddleware:
+    """
+    Resolve ASGI requests against settings.ASGI_ROOT_URLCONF.
+
+    That urlconf puts the async read views in front of the regular DRF ones, so the
+    same paths run natively on the event loop under uvicorn and unchanged under WSGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.route(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        self.route(request)
+        return await self.get_response(request)
+
+    def route(self, request):
+        urlconf = getattr(settings, 'ASGI_ROOT_URLCONF', None)
+        if urlconf and isinstance(request, ASGIRequest):
+            request.urlconf = urlconf
+
+
+class MetricsMiddleware:
+    """
+    Latency, query count and query time of every request, per view, see api/metrics.py.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with time_queries() as timer:
+            response = self.get_response(request)
+        record_request(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with time_queries() as timer:
+            response = await self.get_response(request)
+        record_request(request, response, time.perf_counter() - started, timer)
+        return response
+
+
+class DatabaseRoutingMiddleware:
+    """
+    Sends the reads of GET requests to views marked `read_from_replica` to a replica,
+    and keeps a user who wrote on the primary for a while, see api/routers.py.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Django runs a sync process_view in a thread
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        request._database_routing, token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        finish_request(request, request._database_routing)
+        return response
+
+    async def __acall__(self, request):
+        request._database_routing, token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        if request._database_routing.wrote:
+            await afinish_request(request._database_routing, await arequest_user_id(request))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if wants_replica(request, view_func):
+            request._database_routing.read_alias = choose_replica(request_user_id(request))
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if wants_replica(request, view_func):
+            request._database_routing.read_alias = await achoose_replica(await arequest_user_id(request))
+
+
+class SilkyMiddleware:
+    """
+    Only the requests api.profiling.should_profile() picks go through silk.
+
+    silk's middleware is sync only, in an async chain it would push every request
+    through a thread. Under ASGI only the sampled ones take that detour, like they
+    would through a chain adapted to sync, the rest stay on the event loop.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # silk runs in sync_to_async's thread, the rest of the chain back on the event loop
+            self.silk = BaseSilkyMiddleware(async_to_sync(get_response))
+        else:
+            self.silk = BaseSilkyMiddleware(get_response)
+        install_sql_hook()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if should_profile(request):
+            return self.silk(request)
+        # the thread may still hold the last captured request, its queries must not land there
+        DataCollector().clear()
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if await ashould_profile(request):
+            return await sync_to_async(self.profile)(request)
+        return await self.get_response(request)
+
+    def profile(self, request):
+        # the ORM calls of unsampled async requests run in this thread too
+        try:
+            return self.silk(request)
+        finally:
+            DataCollector().clear()
+
+
+class QueryBudgetMiddleware:
+    """
+    Fails a request that runs more queries than its view's `query_budget`, or the same
+    query over and over (an N+1), see api/query_budget.py.
+
+    Only part of the chain when settings.QUERY_BUDGET['ENABLED'], which defaults to DEBUG.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.options = get_options()
+        if not self.options['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        return self.check(request, response, recorder)
+
+    async def __acall__(self, request):
+        with record_queries() as recorder:
+            response = await self.get_response(request)
+        return self.check(request, response, recorder)
+
+    def check(self, request, response, recorder):
+        view = getattr(request, '_query_budget_view', None)
+        if view is not None:
+            budget = get_query_budget(view, request.method)
+            check_budget(recorder, budget, f'{request.method} {request.path}',
+                         self.options['REPEATED_QUERY_THRESHOLD'])
+        if not response.streaming:
+            response['X-Query-Count'] = str(recorder.count)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._query_budget_view = view_func
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+# FTS5 index over product name and description, an external content table kept
+# in sync by triggers so bulk_create() and update() are covered as well
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS api_product_fts USING fts5(
+        name,
+        description,
+        content='api_product',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_insert AFTER INSERT ON api_product BEGIN
+        INSERT INTO api_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_delete AFTER DELETE ON api_product BEGIN
+        INSERT INTO api_product_fts(api_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_update AFTER UPDATE OF name, description ON api_product BEGIN
+        INSERT INTO api_product_fts(api_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO api_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+    "INSERT INTO api_product_fts(api_product_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS api_product_fts_insert",
+    "DROP TRIGGER IF EXISTS api_product_fts_delete",
+    "DROP TRIGGER IF EXISTS api_product_fts_update",
+    "DROP TABLE IF EXISTS api_product_fts",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        # other backends keep using SearchFilter's icontains lookups
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_product_external_image_url_alter_order_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE_SQL), run(DROP_SQL)),
+    ]
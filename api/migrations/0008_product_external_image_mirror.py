@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_product_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='external_image_checked_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='external_image_mirror',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='external_image_status',
+            field=models.CharField(blank=True, choices=[('mirrored', 'Mirrored'), ('failed', 'Failed')], editable=False, max_length=10),
+        ),
+    ]
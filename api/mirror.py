@@ -0,0 +1,213 @@
+"""
+Local copies of Product.external_image_url.
+
+Fetches run on a bounded thread pool, at most CONCURRENCY requests in flight,
+revalidate with the ETag / Last-Modified of the last response and land in
+media/mirror/ under the SHA-256 of their content, so products that share an
+image share a file. The pool threads only fetch, the rows are written by the
+thread that submitted the work.
+"""
+import hashlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Now
+from PIL import Image
+
+from api.caching import invalidate_product_list, product_cache
+from api.models import Product
+
+logger = logging.getLogger(__name__)
+
+MIRROR_DIRECTORY = 'mirror'
+USER_AGENT = 'product-management-image-mirror/1.0'
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+# fetch() outcomes, NOT_MODIFIED keeps the copy a 304 confirmed
+MIRRORED, NOT_MODIFIED, FAILED = 'mirrored', 'not_modified', 'failed'
+
+_executor = None
+_executor_lock = threading.Lock()
+# exists() then save() of one content hash, two threads fetching the same image
+_storage_lock = threading.Lock()
+
+
+def get_options():
+    return {
+        # requests in flight at once, per mirror run
+        'CONCURRENCY': 8,
+        'TIMEOUT': 10,
+        'MAX_BYTES': 10 * 1024 * 1024,
+        # seconds, older copies are revalidated by `mirror_images`
+        'MAX_AGE': 24 * 60 * 60,
+        # background threads for products saved with a new url, 0 fetches inline on commit
+        'WORKERS': 2,
+        **getattr(settings, 'EXTERNAL_IMAGE_MIRROR', {}),
+    }
+
+
+def local_url(url, mirror):
+    # the copy of `url` when there is one, a failed revalidation keeps serving the last copy
+    if url and mirror and mirror.get('url') == url and mirror.get('path'):
+        return default_storage.url(mirror['path'])
+    return url
+
+
+def is_stale(product):
+    # the mirror state is recorded with the url it was made for
+    return (product.external_image_url or None) != (product.external_image_mirror or {}).get('url')
+
+
+def fetch(url, mirror, options=None):
+    """
+    GET `url` into the mirror directory, returns (outcome, new mirror state).
+
+    Conditional on the validators in `mirror` when it holds a copy of the same url.
+    No database access, runs on the pool threads.
+    """
+    options = options or get_options()
+    mirror = mirror or {}
+    previous = mirror if mirror.get('url') == url and mirror.get('path') else {'url': url}
+
+    if urlsplit(url).scheme not in ('http', 'https'):
+        return FAILED, {**previous, 'error': 'unsupported url scheme'}
+
+    headers = {'User-Agent': USER_AGENT, 'Accept': 'image/*'}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+
+    try:
+        with urlopen(Request(url, headers=headers), timeout=options['TIMEOUT']) as response:
+            content = response.read(options['MAX_BYTES'] + 1)
+            validators = {
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', ''),
+            }
+    except HTTPError as exc:
+        if exc.code == 304 and previous.get('path'):
+            return NOT_MODIFIED, {**previous, 'error': ''}
+        return FAILED, {**previous, 'error': f'HTTP {exc.code}'}
+    except (URLError, OSError, ValueError) as exc:
+        # timeouts and refused connections are OSErrors
+        return FAILED, {**previous, 'error': str(getattr(exc, 'reason', exc))}
+
+    if len(content) > options['MAX_BYTES']:
+        return FAILED, {**previous, 'error': f'larger than {options["MAX_BYTES"]} bytes'}
+    try:
+        with Image.open(BytesIO(content)) as image:
+            image.verify()
+            image_format = image.format
+    except Exception:
+        return FAILED, {**previous, 'error': 'not an image'}
+
+    digest = hashlib.sha256(content).hexdigest()
+    path = f'{MIRROR_DIRECTORY}/{digest[:2]}/{digest}{EXTENSIONS.get(image_format, "." + image_format.lower())}'
+    with _storage_lock:
+        if not default_storage.exists(path):
+            path = default_storage.save(path, ContentFile(content))
+    return MIRRORED, {'url': url, 'path': path, **validators, 'error': ''}
+
+
+def record(pk, url, old_mirror, outcome, mirror):
+    """
+    Save the result of fetch() on the product, unless its url changed in the meantime.
+    """
+    served = local_url(url, mirror) != local_url(url, old_mirror)
+    changes = {
+        'external_image_mirror': mirror,
+        'external_image_status': Product.MirrorStatus.FAILED if outcome == FAILED else Product.MirrorStatus.MIRRORED,
+        'external_image_checked_at': Now(),
+    }
+    if served:
+        # the API shows another url, conditional GETs must see a change
+        changes['updated_at'] = Now()
+    updated = Product.objects.filter(pk=pk, external_image_url=url).update(**changes)
+    if updated and served:
+        # update() sends no post_save
+        invalidate_product_list()
+        product_cache.invalidate(pk)
+    return bool(updated)
+
+
+def mirror_products(rows, concurrency=None, on_result=None):
+    """
+    Fetch and record (pk, url, mirror) rows, `concurrency` requests at a time.
+
+    Returns a Counter of outcomes, `on_result(pk, url, outcome, mirror)` is
+    called as each one is recorded.
+    """
+    options = get_options()
+    counts = Counter()
+    with ThreadPoolExecutor(max_workers=concurrency or options['CONCURRENCY'],
+                            thread_name_prefix='image-mirror') as pool:
+        futures = {pool.submit(fetch, url, mirror, options): (pk, url, mirror) for pk, url, mirror in rows}
+        for future in as_completed(futures):
+            pk, url, old_mirror = futures[future]
+            outcome, mirror = future.result()
+            record(pk, url, old_mirror, outcome, mirror)
+            counts[outcome] += 1
+            if on_result is not None:
+                on_result(pk, url, outcome, mirror)
+    return counts
+
+
+def mirror_product(pk):
+    """
+    Bring one product's mirror in line with its current url.
+    """
+    row = Product.objects.filter(pk=pk).values_list('external_image_url', 'external_image_mirror').first()
+    if row is None:
+        return
+    url, mirror = row
+    if url:
+        record(pk, url, mirror, *fetch(url, mirror))
+    elif mirror:
+        # the url was removed, the API already shows none
+        Product.objects.filter(Q(external_image_url__isnull=True) | Q(external_image_url=''), pk=pk).update(
+            external_image_mirror={}, external_image_status='', external_image_checked_at=None,
+        )
+
+
+def schedule_mirror(product):
+    # after commit, the worker must see the new url
+    pk = product.pk
+    transaction.on_commit(lambda: _submit(pk))
+
+
+def _submit(pk):
+    global _executor
+    workers = get_options()['WORKERS']
+    if not workers:
+        _mirror(pk)
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-mirror-worker')
+    _executor.submit(_run_in_worker, pk)
+
+
+def _mirror(pk):
+    try:
+        mirror_product(pk)
+    except Exception:
+        logger.exception('Mirroring the external image of product %s failed', pk)
+
+
+def _run_in_worker(pk):
+    try:
+        _mirror(pk)
+    finally:
+        # pool threads outlive the request, don't leave their connection open
+        connection.close()
@@ -1,7 +1,9 @@
 import uuid
+from decimal import Decimal
 
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Coalesce, Collate
 
 
 # Create your models here.
@@ -10,15 +12,40 @@ class User(AbstractUser):
 
 
 class Product(models.Model):
+    class MirrorStatus(models.TextChoices):
+        MIRRORED = 'mirrored'
+        FAILED = 'failed'
+
     name = models.CharField(max_length=100)
     description = models.TextField()
     price = models.DecimalField(decimal_places=2, max_digits=10)
     stock = models.PositiveIntegerField()
     image = models.ImageField(upload_to='products/', null=True, blank=True)
+    # set by the image pipeline (api/images.py), not width_field/height_field, those
+    # add a post_init handler to every Product and open the file when they are empty
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
     external_image_url = models.URLField(null=True, blank=True)
+    # local copy of external_image_url (api/mirror.py), {'url', 'path', 'etag', 'last_modified', 'error'}
+    external_image_mirror = models.JSONField(default=dict, blank=True, editable=False)
+    external_image_status = models.CharField(max_length=10, choices=MirrorStatus, blank=True, editable=False)
+    # last fetch or revalidation, failed ones included
+    external_image_checked_at = models.DateTimeField(null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = models.Manager()
 
+    class Meta:
+        indexes = [
+            # ?price__gt / __lt / __range
+            models.Index(fields=['price'], name='product_price_idx'),
+            # the list only shows products in stock, in pk order
+            models.Index(fields=['id'], condition=models.Q(stock__gt=0), name='product_in_stock_idx'),
+            # ?name__iexact, SQLite runs it as a LIKE which only a NOCASE index can serve
+            models.Index(Collate('name', 'NOCASE'), name='product_name_nocase_idx'),
+        ]
+
     @property
     def in_stock(self):
         return self.stock > 0
@@ -27,6 +54,36 @@ class Product(models.Model):
         return self.name
 
 
+def item_subtotal():
+    # quantity x price of an order item, in SQL
+    return models.ExpressionWrapper(
+        models.F('quantity') * models.F('product__price'),
+        output_field=models.DecimalField(max_digits=20, decimal_places=2),
+    )
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        # totals computed by the database, the serializers pick these up when present
+        items = OrderItem.objects.select_related('product').annotate(subtotal=item_subtotal())
+        # a correlated subquery rather than a join and GROUP BY, so filters on the
+        # order columns keep their indexes
+        total = (
+            OrderItem.objects
+            .filter(order=models.OuterRef('pk'))
+            .values('order')
+            .annotate(total=models.Sum(item_subtotal()))
+            .values('total')
+        )
+        return self.annotate(
+            total_price=Coalesce(
+                models.Subquery(total),
+                models.Value(Decimal('0.00')),
+                output_field=models.DecimalField(max_digits=20, decimal_places=2),
+            )
+        ).prefetch_related(models.Prefetch('items', queryset=items))
+
+
 class Order(models.Model):
     class StatusChoices(models.TextChoices):
         PENDING = "Pending"
@@ -36,6 +93,7 @@ class Order(models.Model):
     order_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(
         max_length=10,
         choices=StatusChoices.choices,
@@ -43,6 +101,17 @@ class Order(models.Model):
     )
     products = models.ManyToManyField(Product, through='OrderItem', related_name='orders')
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # a user's orders, optionally limited to a day or date range
+            models.Index(fields=['user', 'created_at'], name='order_user_created_idx'),
+            # ?status= and date filters on the staff list, the export order
+            models.Index(fields=['status'], name='order_status_idx'),
+            models.Index(fields=['created_at'], name='order_created_idx'),
+        ]
+
     def __str__(self):
         return f'Order {self.order_id} by {self.user.username}'
 
@@ -61,4 +130,5 @@ class OrderItem(models.Model):
         return self.product.price * self.quantity
 
     def __str__(self):
-        return f'{self.quantity} x {self.product.name} in Order {self.order.order_id}'
+        # order_id, not self.order.order_id, which would load the order
+        return f'{self.quantity} x {self.product.name} in Order {self.order_id}'
@@ -0,0 +1,192 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on the full ordering tuple.
+
+    The cursor holds the sort values of the last row that was sent, and the next
+    page is fetched with a `WHERE (a, b, pk) > (...)` style filter, so page 1000
+    costs the same as page 1. The pk is always appended to the ordering so rows
+    that share a name/price/stock value are never skipped or repeated.
+    """
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    # default ordering when no OrderingFilter choice is present on the request
+    ordering = ('pk',)
+    invalid_cursor_message = 'Invalid cursor'
+    # what encode_cursor can write for a sort value (anything else went through str)
+    _cursor_types = (str, int, float, type(None))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request, view)
+        return self.set_page(list(queryset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # same as paginate_queryset, for the async views
+        queryset = self.get_page_queryset(queryset, request, view)
+        return self.set_page([row async for row in queryset])
+
+    def get_page_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.position, self.reverse = self.decode_cursor(request)
+
+        # walking backwards means flipping every direction, then reversing the page
+        ordering = [self._flip(field) for field in self.ordering] if self.reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if self.position is not None:
+            queryset = queryset.filter(self._keyset_filter(ordering, self.position))
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+
+        if self.reverse:
+            self.has_next = self.position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.position is not None
+
+        return self.page
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_ordering(self, request, queryset, view):
+        ordering = None
+        # reuse the OrderingFilter choice so ?ordering= and the cursor agree
+        for backend in getattr(view, 'filter_backends', []):
+            if hasattr(backend, 'get_ordering'):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+
+        # then whatever the filters ordered by (search rank), then the default
+        ordering = list(ordering or queryset.query.order_by or self.ordering)
+        if not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+            # tiebreaker, the keyset must be unique for the cursor to be stable
+            ordering.append('pk')
+        return ordering
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+
+        try:
+            payload = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            position, reverse, ordering = payload['p'], bool(payload['r']), payload['o']
+            # a cursor only makes sense for the ordering it was created with,
+            # and the filter needs one plain value per ordering field
+            if ordering != self.ordering or len(position) != len(self.ordering):
+                raise ValueError(ordering)
+            if not isinstance(position, list) or not all(isinstance(value, self._cursor_types) for value in position):
+                raise ValueError(position)
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, instance, reverse):
+        position = [self._get_value(instance, field) for field in self.ordering]
+        payload = json.dumps({'p': position, 'r': int(reverse), 'o': self.ordering}, default=str)
+        encoded = urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+    def _keyset_filter(self, ordering, position):
+        # (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND pk > z)
+        conditions = []
+        for index, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            equal = {ordering[i].lstrip('-'): position[i] for i in range(index)}
+            conditions.append(Q(**equal, **{f'{name}__{lookup}': position[index]}))
+        return reduce(or_, conditions)
+
+    @staticmethod
+    def _flip(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def _get_value(instance, field):
+        name = field.lstrip('-')
+        if isinstance(instance, dict):
+            return instance[name]
+        return getattr(instance, name)
@@ -0,0 +1,71 @@
+"""
+Which requests silk captures.
+
+Capturing writes the request, the response body and every query with its
+EXPLAIN to the database, so outside DEBUG only a sample is taken:
+SILK_SAMPLING['RATE'] of all requests, plus every request to one of its PATHS
+or from one of its USER_IDS. The rest skip silk altogether, see
+api.middleware.SilkyMiddleware.
+"""
+import random
+
+from django.conf import settings
+from django.db.models.sql.compiler import SQLCompiler
+from silk.collector import DataCollector
+from silk.sql import execute_sql as silk_execute_sql
+
+from api.authentication import arequest_user_id, request_user_id
+
+
+def get_options():
+    return {
+        # fraction of requests captured, 1 captures all of them
+        'RATE': 1.0 if settings.DEBUG else 0.01,
+        # path prefixes always captured
+        'PATHS': [],
+        # users whose requests are always captured, session or JWT
+        'USER_IDS': [],
+        **getattr(settings, 'SILK_SAMPLING', {}),
+    }
+
+
+def should_profile(request):
+    options = get_options()
+    if sampled(request, options):
+        return True
+    if options['USER_IDS']:
+        return is_profiled_user(request_user_id(request), options)
+    return False
+
+
+async def ashould_profile(request):
+    options = get_options()
+    if sampled(request, options):
+        return True
+    if options['USER_IDS']:
+        return is_profiled_user(await arequest_user_id(request), options)
+    return False
+
+
+def sampled(request, options):
+    if options['RATE'] and random.random() < options['RATE']:
+        return True
+    return any(request.path.startswith(prefix) for prefix in options['PATHS'])
+
+
+def is_profiled_user(user_id, options):
+    return str(user_id) in {str(profiled) for profiled in options['USER_IDS']}
+
+
+def execute_sql(self, *args, **kwargs):
+    # silk's wrapper compiles every query a second time, only captured requests need it
+    if DataCollector().request is None:
+        return self._execute_sql(*args, **kwargs)
+    return silk_execute_sql(self, *args, **kwargs)
+
+
+def install_sql_hook():
+    # in place of the one silk installs on the first captured request
+    if not hasattr(SQLCompiler, '_execute_sql'):
+        SQLCompiler._execute_sql = SQLCompiler.execute_sql
+        SQLCompiler.execute_sql = execute_sql
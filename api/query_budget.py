@@ -0,0 +1,149 @@
+import traceback
+from collections import Counter
+
+from django.conf import settings
+from django.test.utils import override_settings
+from django.urls import URLPattern, URLResolver, get_resolver, resolve
+
+from api.metrics import observe_queries
+
+# queries that are not the view's own, silk's EXPLAINs and its bookkeeping
+IGNORED_PREFIXES = ('EXPLAIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_options():
+    return {
+        'ENABLED': settings.DEBUG,
+        # the same query shape this many times in one request is reported as an N+1
+        'REPEATED_QUERY_THRESHOLD': 3,
+        **getattr(settings, 'QUERY_BUDGET', {}),
+    }
+
+
+class QueryRecorder:
+    """
+    Execute wrapper counting a request's queries by shape, the SQL with its placeholders.
+
+    The stack of the second execution of a shape is kept, that is where a loop
+    issuing one query per row shows up.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.shapes = Counter()
+        self.stacks = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(IGNORED_PREFIXES) and '"silk_' not in sql:
+            self.count += 1
+            self.shapes[sql] += 1
+            if self.shapes[sql] == 2:
+                self.stacks[sql] = app_stack()
+        return execute(sql, params, many, context)
+
+    def repeated(self, threshold):
+        return {sql: count for sql, count in self.shapes.items() if count >= threshold}
+
+
+def app_stack():
+    # only the frames of this project, the ORM and DRF frames say nothing about the cause
+    base = str(settings.BASE_DIR)
+    frames = [
+        frame for frame in traceback.extract_stack()[:-2]
+        if frame.filename.startswith(base) and 'site-packages' not in frame.filename
+    ]
+    return ''.join(traceback.format_list(frames))
+
+
+def record_queries():
+    # the request's queries in whichever thread they run (api/metrics.py)
+    return observe_queries(QueryRecorder())
+
+
+def get_query_budget(view_func, method):
+    """
+    The `query_budget` a view declares for `method`, None when it has none.
+
+    A number applies to every method, a dict is keyed by viewset action or by
+    lowercase method name.
+    """
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    budget = getattr(view_class, 'query_budget', None)
+    if isinstance(budget, dict):
+        action = (getattr(view_func, 'actions', None) or {}).get(method.lower())
+        return budget.get(action, budget.get(method.lower()))
+    return budget
+
+
+def check_budget(recorder, budget, label, threshold):
+    problems = []
+    if budget is not None and recorder.count > budget:
+        problems.append(f'{label} ran {recorder.count} queries, its budget is {budget}')
+    for sql, count in recorder.repeated(threshold).items():
+        problems.append(f'{label} ran the same query {count} times (N+1?): {sql}\n{recorder.stacks[sql]}')
+    if problems:
+        raise QueryBudgetExceeded('\n'.join(problems))
+
+
+def budgeted_routes(urlconf=None):
+    """
+    {view: route} for every URL of this app's views, which must all declare a budget.
+    """
+    def walk(patterns, prefix):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                yield from walk(pattern.url_patterns, prefix + str(pattern.pattern))
+            elif isinstance(pattern, URLPattern):
+                yield prefix + str(pattern.pattern), pattern.callback
+
+    routes = {}
+    for route, view in walk(get_resolver(urlconf).url_patterns, ''):
+        view_class = getattr(view, 'cls', None) or getattr(view, 'view_class', None)
+        # format suffix routes share the view of the plain route
+        if view_class is not None and view_class.__module__.startswith('api.'):
+            routes.setdefault(view, route)
+    return routes
+
+
+def view_methods(view):
+    actions = getattr(view, 'actions', None)
+    if actions:
+        return list(actions)
+    view_class = getattr(view, 'cls', None) or view.view_class
+    return [method for method in view_class.http_method_names
+            if method not in ('head', 'options') and hasattr(view_class, method)]
+
+
+class QueryBudgetTestMixin:
+    """
+    TestCase mixin, assertQueryBudgets() makes requests with the budgets enforced.
+
+    It also fails when a view of this app declares no budget or is left out of
+    the requests, so a new endpoint can't skip the check.
+    """
+
+    def assertQueryBudgets(self, requests):
+        covered = set()
+        with override_settings(QUERY_BUDGET={**get_options(), 'ENABLED': True}):
+            # a new client, the middleware chain is built on the first request
+            client = self.client_class()
+            client.cookies = self.client.cookies
+            for method, path, *data in requests:
+                covered.add(resolve(path.split('?')[0]).func)
+                try:
+                    if data:
+                        getattr(client, method)(path, data[0], content_type='application/json')
+                    else:
+                        getattr(client, method)(path)
+                except QueryBudgetExceeded as exc:
+                    self.fail(f'{method.upper()} {path}: {exc}')
+
+        for view, route in budgeted_routes().items():
+            with self.subTest(route=route):
+                self.assertTrue(view in covered, f'{route} is not exercised')
+                for method in view_methods(view):
+                    self.assertIsNotNone(get_query_budget(view, method), f'{route} {method} declares no query budget')
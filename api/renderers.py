@@ -0,0 +1,66 @@
+"""
+orjson and MessagePack renderers, picked by content negotiation.
+
+ORJSONRenderer writes the same bytes as DRF's JSONRenderer for the API's data,
+MessagePackRenderer the same values in MessagePack, so a client can switch with
+`Accept: application/msgpack` (or `?format=msgpack`) and decode identical payloads.
+"""
+import decimal
+
+import msgpack
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# DRF escapes these two so the output stays a JavaScript subset, orjson doesn't
+LINE_SEPARATORS = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+# uuid, date and time are the same in orjson, datetimes go through default() for
+# DRF's `Z`, it is applied to any zero offset and orjson's OPT_UTC_Z only to UTC
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+_drf_encoder = JSONEncoder()
+
+
+def encode_default(obj):
+    # the conversions of DRF's encoder, Decimal included (a float, as json.dumps writes it)
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    return _drf_encoder.default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer on orjson.
+
+    Indented output (the browsable API, `; indent=`) and anything orjson can't
+    encode, integers over 64 bits or a lone surrogate, are left to JSONRenderer,
+    which also raises the same errors for data neither can encode.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            content = orjson.dumps(data, default=encode_default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        for separator, escaped in LINE_SEPARATORS:
+            if separator in content:
+                content = content.replace(separator, escaped)
+        return content
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # datetimes, Decimals and UUIDs as the JSON renderer writes them
+        return msgpack.packb(data, default=encode_default, use_bin_type=True, datetime=False)
@@ -0,0 +1,183 @@
+"""
+Read replicas for the read-only endpoints.
+
+A view opts in with a class attribute, `read_from_replica = True`. GET and HEAD
+requests to it read from one of DATABASE_ROUTING['REPLICAS'], picked by weighted
+round-robin. Writes, and every other request, use the primary. A user whose
+request wrote stays on the primary for STICKY_SECONDS, so they see their own
+changes.
+
+Cache invalidations run a second time REPLICA_LAG seconds after a write: an
+entry filled from a replica that hadn't caught up yet doesn't outlive the lag.
+"""
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+# always read from the primary, a session is read right after the request that wrote it
+PRIMARY_ONLY_APPS = {'sessions', 'silk'}
+
+_request_state = ContextVar('database_routing', default=None)
+
+
+def get_options():
+    return {
+        # {alias: weight}, empty sends every read to the primary
+        'REPLICAS': {},
+        # seconds a user's reads stay on the primary after their own write
+        'STICKY_SECONDS': 5,
+        # seconds the replicas may be behind the primary
+        'REPLICA_LAG': 2,
+        **getattr(settings, 'DATABASE_ROUTING', {}),
+    }
+
+
+def _sticky_key(user_id):
+    return f'db_primary:user:{user_id}'
+
+
+class RoutingState:
+    # one per request, the router reads it, the middleware fills it in
+    def __init__(self):
+        self.read_alias = None
+        self.wrote = False
+
+
+class WeightedRoundRobin:
+    """
+    Smooth weighted round-robin, {'a': 2, 'b': 1} gives a, b, a, a, b, a...
+    """
+
+    def __init__(self):
+        self._current = {}
+        self._lock = threading.Lock()
+
+    def choose(self, weights):
+        with self._lock:
+            for alias, weight in weights.items():
+                self._current[alias] = self._current.get(alias, 0) + weight
+            alias = max(weights, key=self._current.__getitem__)
+            self._current[alias] -= sum(weights.values())
+            return alias
+
+
+replicas = WeightedRoundRobin()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and state.read_alias and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            return state.read_alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the primary's rows
+        aliases = {DEFAULT_DB_ALIAS, *get_options()['REPLICAS']}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+def start_request():
+    state = RoutingState()
+    return state, _request_state.set(state)
+
+
+def end_request(token):
+    _request_state.reset(token)
+
+
+def wants_replica(request, view_func):
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    return (request.method in ('GET', 'HEAD') and getattr(view_class, 'read_from_replica', False)
+            and bool(get_options()['REPLICAS']))
+
+
+def choose_replica(user_id):
+    # None while the user's own write may not have reached the replicas
+    if user_id is not None and cache.get(_sticky_key(user_id)):
+        return None
+    return replicas.choose(get_options()['REPLICAS'])
+
+
+async def achoose_replica(user_id):
+    if user_id is not None and await cache.aget(_sticky_key(user_id)):
+        return None
+    return replicas.choose(get_options()['REPLICAS'])
+
+
+def finish_request(request, state):
+    if not state.wrote:
+        return
+    user = getattr(request, 'user', None)
+    # DRF sets request.user to the user it authenticated
+    if user is not None and user.is_authenticated:
+        cache.set(_sticky_key(user.pk), True, get_options()['STICKY_SECONDS'])
+
+
+async def afinish_request(state, user_id):
+    # the user from the token or the session, request.user may not have been loaded
+    if state.wrote and user_id is not None:
+        await cache.aset(_sticky_key(user_id), True, get_options()['STICKY_SECONDS'])
+
+
+class DelayedCalls:
+    """
+    A background thread making calls after a delay, once per key however often it is scheduled.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, key, func, delay):
+        with self._condition:
+            self._pending[key] = (time.monotonic() + delay, func)
+            # not alive in a forked child
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='replica-lag', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                due = [key for key, (when, _) in self._pending.items() if when <= now]
+                calls = [self._pending.pop(key)[1] for key in due]
+                if not calls:
+                    next_call = min((when for when, _ in self._pending.values()), default=None)
+                    self._condition.wait(None if next_call is None else next_call - now)
+                    continue
+            for func in calls:
+                try:
+                    func()
+                except Exception:
+                    logger.exception('Invalidating again after the replica lag failed')
+
+
+_delayed = DelayedCalls()
+
+
+def after_replica_lag(key, func):
+    """
+    Call `func` again once the replicas have caught up, nothing without replicas.
+    """
+    options = get_options()
+    if options['REPLICAS']:
+        _delayed.schedule(key, func, options['REPLICA_LAG'])
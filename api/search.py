@@ -0,0 +1,83 @@
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'api_product_fts'
+
+# same triggers as migration 0004, SQLite drops them whenever a migration rebuilds
+# api_product, so they are put back after every migrate
+TRIGGER_SQL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_insert AFTER INSERT ON api_product BEGIN
+        INSERT INTO api_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_delete AFTER DELETE ON api_product BEGIN
+        INSERT INTO api_product_fts(api_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_update AFTER UPDATE OF name, description ON api_product BEGIN
+        INSERT INTO api_product_fts(api_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO api_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+]
+# bm25 column weights, a hit in the name counts ten times a hit in the description
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+
+# {alias: has the index}, checked once per process, forget() after a migrate or rebuild
+_available = {}
+
+
+def is_available(using='default'):
+    if using not in _available:
+        connection = connections[using]
+        _available[using] = connection.vendor == 'sqlite' and SEARCH_TABLE in connection.introspection.table_names()
+    return _available[using]
+
+
+def forget(using=None):
+    # look the index up again, for one alias or all of them
+    if using is None:
+        _available.clear()
+    else:
+        _available.pop(using, None)
+
+
+def install_triggers(using='default'):
+    if not is_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        for statement in TRIGGER_SQL:
+            cursor.execute(statement)
+
+
+def build_match_query(terms):
+    # every term must match, as a prefix, in either column; quotes keep FTS syntax out of user input
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+def search(queryset, terms):
+    """
+    Restrict `queryset` to products matching `terms` and annotate a `search_rank`.
+
+    Lower ranks are better matches (bm25 is negative), so order by `search_rank`.
+    """
+    return queryset.extra(
+        tables=[SEARCH_TABLE],
+        where=[f'{SEARCH_TABLE}.rowid = api_product.id', f'{SEARCH_TABLE} MATCH %s'],
+        params=[build_match_query(terms)],
+    ).annotate(
+        search_rank=RawSQL(f'bm25({SEARCH_TABLE}, %s, %s)', (NAME_WEIGHT, DESCRIPTION_WEIGHT)),
+    )
+
+
+def rebuild(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')")
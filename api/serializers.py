@@ -1,19 +1,62 @@
+from collections import Counter
+from contextlib import contextmanager
+
 from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.db.models.functions import Now
 from rest_framework import serializers
 
+from .caching import bulk_order_changes, invalidate_order_list
+from .images import rendition_urls
+from .mirror import local_url
 from .models import Order, OrderItem, Product, User
+from .stock import InsufficientStock, StatusConflict, order_quantities, release, reserve, set_status
+
+# rows per INSERT statement, keeps large orders under the SQLite variable limit
+ORDER_BULK_BATCH_SIZE = 500
+
+
+@contextmanager
+def stock_errors():
+    # reservation failures surface as a normal 400 response
+    try:
+        yield
+    except InsufficientStock as exc:
+        raise serializers.ValidationError({'items': [str(exc)]})
+    except StatusConflict as exc:
+        raise serializers.ValidationError({'status': [str(exc)]})
+
+
+def item_quantities(orderitem_data):
+    quantities = Counter()
+    for item in orderitem_data:
+        quantities[item['product_id']] += item['quantity']
+    return quantities
 
 
 class UserSerializer(serializers.ModelSerializer):
+    # annotated by UserListView
+    order_count = serializers.IntegerField(read_only=True)
+
     class Meta:
         model = User
         # bad method because it can return sensitive data
         # fields = '__all__'
-        fields = ('email', 'username', 'get_full_name', 'orders')
+        fields = ('email', 'username', 'get_full_name', 'orders', 'order_count')
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # only serialize `fields` when given, the user list's ?fields=
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
 
 
 class ProductSerializer(serializers.ModelSerializer):
+    # resized copies of `image` per size, api/images.py
+    images = serializers.SerializerMethodField()
+
     class Meta:
         model = Product
         fields = (
@@ -22,8 +65,20 @@ class ProductSerializer(serializers.ModelSerializer):
             'price',
             'stock',
             'external_image_url',
+            'image_width',
+            'image_height',
+            'images',
         )
 
+    def get_images(self, obj):
+        return rendition_urls(obj.image_renditions)
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # the local copy of the external image once it is mirrored
+        data['external_image_url'] = local_url(data['external_image_url'], instance.external_image_mirror)
+        return data
+
     def validate_price(self, value):
         if value < 0:
             raise serializers.ValidationError('Price cannot be negative')
@@ -33,6 +88,7 @@ class ProductSerializer(serializers.ModelSerializer):
 class OrderItemSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
     product_price = serializers.DecimalField(source='product.price', max_digits=10, decimal_places=2, read_only=True)
+    item_subtotal = serializers.SerializerMethodField()
 
     class Meta:
         model = OrderItem
@@ -43,9 +99,68 @@ class OrderItemSerializer(serializers.ModelSerializer):
             'item_subtotal'
         )
 
+    # `subtotal` is annotated by Order.objects.with_totals(), otherwise do the math here
+    def get_item_subtotal(self, obj):
+        subtotal = getattr(obj, 'subtotal', None)
+        if subtotal is not None:
+            return subtotal
+        return obj.item_subtotal
+
+
+def _product_ids(orders):
+    # every integer product id referenced by a raw batch payload, bad values are left to field validation
+    ids = set()
+    for order in orders:
+        if not isinstance(order, dict):
+            continue
+        for item in order.get('items') or []:
+            try:
+                ids.add(int(item['product']))
+            except (KeyError, TypeError, ValueError):
+                pass
+    return ids
+
+
+class OrderCreateListSerializer(serializers.ListSerializer):
+    # validates and saves many orders at once, used by the orders batch endpoint
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            # one lookup for the products of the whole batch, shared with every child
+            self.context['products'] = Product.objects.in_bulk(_product_ids(data))
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        orders = []
+        orderitems = []
+        confirmed = Counter()
+        for attrs in validated_data:
+            orderitem_data = attrs.pop('items', None) or []
+            order = Order(**attrs)
+            orders.append(order)
+            orderitems += [OrderItem(order=order, **item) for item in orderitem_data]
+            if order.status == Order.StatusChoices.CONFIRMED:
+                confirmed += item_quantities(orderitem_data)
+
+        with stock_errors(), transaction.atomic():
+            Order.objects.bulk_create(orders, batch_size=ORDER_BULK_BATCH_SIZE)
+            OrderItem.objects.bulk_create(orderitems, batch_size=ORDER_BULK_BATCH_SIZE)
+            # stock for every confirmed order in the batch is taken in one go
+            reserve(confirmed)
+            # bulk_create sends no signals
+            for user_id in {order.user_id for order in orders}:
+                invalidate_order_list(user_id)
+
+        # one query to load the items back for the response
+        prefetch_related_objects(orders, 'items')
+        return orders
+
 
 class OrderCreateSerializer(serializers.ModelSerializer):
     class OrderItemCreateSerializer(serializers.ModelSerializer):
+        # plain id, existence is checked for all items at once in validate_items
+        product = serializers.IntegerField(source='product_id')
+
         class Meta:
             model = OrderItem
             fields = (
@@ -55,30 +170,73 @@ class OrderCreateSerializer(serializers.ModelSerializer):
 
     items = OrderItemCreateSerializer(many=True, required=False)
 
+    def validate_items(self, items):
+        # the batch endpoint already loaded its products, a single order does one in_bulk query
+        products = self.context.get('products')
+        if products is None:
+            products = Product.objects.in_bulk({item['product_id'] for item in items})
+
+        errors = [
+            {} if item['product_id'] in products
+            else {'product': [f'Invalid pk "{item["product_id"]}" - object does not exist.']}
+            for item in items
+        ]
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
     def update(self, instance, validated_data):
-        orderitem_data = validated_data.pop('items')
+        orderitem_data = validated_data.pop('items', None)
+        # status changes go through the stock reservation engine
+        status = validated_data.pop('status', None)
 
         # remove the existing items, and rewrites them, if it fails it will revert
-        with transaction.atomic():
-            instance = super().update(instance, validated_data)
+        # the item signals only collect the owner, the lists are invalidated once
+        with stock_errors(), transaction.atomic(), bulk_order_changes():
+            if validated_data:
+                instance = super().update(instance, validated_data)
 
             if orderitem_data is not None:
+                # a confirmed order swaps its reservation for the new items, the status
+                # is read under the row lock so a concurrent set_status can't slip in
+                instance.status = (
+                    Order.objects.select_for_update().filter(pk=instance.pk).values_list('status', flat=True).get()
+                )
+                confirmed = instance.status == Order.StatusChoices.CONFIRMED
+                if confirmed:
+                    release(order_quantities(instance))
+
                 # clear existing items (optional, depends on requirements)
                 instance.items.all().delete()
 
-                # recreate items with updated data
-                for item in orderitem_data:
-                    OrderItem.objects.create(order=instance, **item)
+                # recreate items with updated data, in one insert
+                OrderItem.objects.bulk_create(
+                    [OrderItem(order=instance, **item) for item in orderitem_data],
+                    batch_size=ORDER_BULK_BATCH_SIZE,
+                )
+                if confirmed:
+                    reserve(item_quantities(orderitem_data))
+
+            if status is not None:
+                set_status(instance, status)
+
+            # bulk_create sends no signals, and the order row itself may not have been saved
+            Order.objects.filter(pk=instance.pk).update(updated_at=Now())
+            invalidate_order_list(instance.user_id)
 
         return instance
 
     def create(self, validated_data):
-        orderitem_data = validated_data.pop('items')
+        orderitem_data = validated_data.pop('items', None) or []
 
-        with transaction.atomic():
+        with stock_errors(), transaction.atomic():
             order = Order.objects.create(**validated_data)
-            for item in orderitem_data:
-                OrderItem.objects.create(order=order, **item)
+            OrderItem.objects.bulk_create(
+                [OrderItem(order=order, **item) for item in orderitem_data],
+                batch_size=ORDER_BULK_BATCH_SIZE,
+            )
+            if order.status == Order.StatusChoices.CONFIRMED:
+                reserve(item_quantities(orderitem_data))
 
         return order
 
@@ -93,6 +251,7 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'user': {'read_only': True},
         }
+        list_serializer_class = OrderCreateListSerializer
 
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -103,8 +262,21 @@ class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     total_price = serializers.SerializerMethodField(method_name='total')
 
-    # get a list of order items loop through and get the sum
+    def update(self, instance, validated_data):
+        # status changes go through the stock reservation engine
+        status = validated_data.pop('status', None)
+        with stock_errors(), transaction.atomic():
+            if validated_data:
+                instance = super().update(instance, validated_data)
+            if status is not None:
+                set_status(instance, status)
+        return instance
+
+    # use the database total from Order.objects.with_totals(), else loop through the items and sum
     def total(self, obj):
+        total_price = getattr(obj, 'total_price', None)
+        if total_price is not None:
+            return total_price
         order_items = obj.items.all()
         return sum(order_item.item_subtotal for order_item in order_items)
 
@@ -114,7 +286,12 @@ class OrderSerializer(serializers.ModelSerializer):
 
 
 class ProductInfoSerializer(serializers.Serializer):
-    # get all products, count and max price of product
-    products = ProductSerializer(many=True)
+    # catalog summary, the products list is left out or paginated on request
+    products = ProductSerializer(many=True, required=False)
     count = serializers.IntegerField()
+    in_stock_count = serializers.IntegerField()
     max_price = serializers.FloatField()
+    min_price = serializers.FloatField()
+    avg_price = serializers.FloatField()
+    next = serializers.URLField(required=False)
+    previous = serializers.URLField(required=False)
@@ -1,14 +1,102 @@
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate, post_save, post_delete
 from django.dispatch import receiver
-from api.models import Product
-from django.core.cache import cache
+from api import images, metrics, mirror, search
+from api.authentication import invalidate_user
+from api.caching import invalidate_order_list, invalidate_product_list, invalidate_products, product_cache
+from api.models import Order, OrderItem, Product, User
 
 @receiver([post_save, post_delete], sender=Product)
 def invalidate_product_cache(sender, instance, **kwargs):
     """
-    GRTInvalidate when the product is created, updated or deleted
+    Invalidate when the product is created, updated or deleted, one INCR of the cache generation
     """
 
-    print("Deleting product cache")
+    # after commit, a reader racing the write can't cache the old row under the new version
+    pk = instance.pk
+    transaction.on_commit(invalidate_product_list)
+    transaction.on_commit(invalidate_products)
+    transaction.on_commit(lambda: product_cache.invalidate(pk))
 
-    cache.delete_pattern('*product_list*')
+
+@receiver(post_save, sender=Product)
+def queue_product_image(sender, instance, raw=False, **kwargs):
+    """
+    New or replaced image, resize it in the background (api/images.py)
+    """
+
+    if not raw and images.is_stale(instance):
+        images.schedule_renditions(instance)
+
+
+@receiver(post_save, sender=Product)
+def queue_external_image_mirror(sender, instance, raw=False, **kwargs):
+    """
+    New or changed external_image_url, fetch a local copy in the background (api/mirror.py)
+    """
+
+    if not raw and mirror.is_stale(instance):
+        mirror.schedule_mirror(instance)
+
+
+@receiver(post_delete, sender=Product)
+def delete_product_image_renditions(sender, instance, **kwargs):
+    images.delete_renditions(instance)
+
+
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_order_cache(sender, instance, **kwargs):
+    """
+    Invalidate the cached order lists of the order's owner (and staff)
+    """
+
+    invalidate_order_list(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def invalidate_order_item_cache(sender, instance, origin=None, **kwargs):
+    """
+    Invalidate the order lists of the item's owner, one lookup when the order isn't loaded
+    """
+
+    if origin is not None and origin is not instance and getattr(origin, 'model', None) is not OrderItem:
+        # cascaded from deleting the order (or its user), the order's own post_delete handles it
+        return
+    if OrderItem.order.is_cached(instance):
+        user_id = instance.order.user_id
+    else:
+        user_id = Order.objects.filter(pk=instance.order_id).values_list('user_id', flat=True).first()
+        if user_id is None:
+            return
+    invalidate_order_list(user_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """
+    Password changes and deactivations are saves too, the next JWT request loads the row again (api/authentication.py)
+    """
+
+    invalidate_user(instance.pk)
+
+
+@receiver(post_migrate)
+def restore_search_triggers(sender, using, **kwargs):
+    """
+    SQLite drops triggers when a migration rebuilds api_product, put the search index ones back
+    """
+
+    if sender.name == 'api':
+        # the migration may have just created (or dropped) the index
+        search.forget(using)
+        search.install_triggers(using)
+
+
+@receiver(connection_created)
+def install_query_hook(sender, connection, **kwargs):
+    """
+    Request metrics and query budgets see the queries of every thread (api/metrics.py)
+    """
+
+    metrics.install_query_hook(connection)
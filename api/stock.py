@@ -0,0 +1,133 @@
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db import connection, transaction
+from django.db.models import Case, F, Q, Sum, When
+from django.db.models.functions import Now
+
+from api.caching import invalidate_order_list, invalidate_product_list, product_cache
+from api.models import Order, OrderItem, Product
+
+# products updated per UPDATE statement
+RESERVATION_BATCH_SIZE = 200
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+        super().__init__(f'Not enough stock for products: {", ".join(map(str, product_ids))}')
+
+
+class StatusConflict(Exception):
+    pass
+
+
+class _Shortage(Exception):
+    # internal, raised to roll back a partially applied batch
+    pass
+
+
+def order_quantities(orders):
+    # {product_id: total quantity} for one or many orders, summed in SQL
+    if isinstance(orders, Order):
+        orders = [orders]
+    rows = (
+        OrderItem.objects
+        .filter(order__in=[order.pk for order in orders])
+        .values('product_id')
+        .annotate(quantity=Sum('quantity'))
+    )
+    return Counter({row['product_id']: row['quantity'] for row in rows})
+
+
+def _batches(product_ids):
+    for start in range(0, len(product_ids), RESERVATION_BATCH_SIZE):
+        yield product_ids[start:start + RESERVATION_BATCH_SIZE]
+
+
+def _lock(product_ids):
+    # row locks where the backend has them, always taken in pk order so two
+    # reservations over the same products can't deadlock each other
+    if connection.features.has_select_for_update:
+        list(Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk').values_list('pk'))
+
+
+def reserve(quantities):
+    """
+    Take `quantities` ({product_id: quantity}) out of stock, all or nothing.
+
+    Every batch is a single conditional UPDATE, a product only changes if it still
+    has enough stock, so two workers can never sell the same unit.
+    """
+    product_ids = sorted(pk for pk, quantity in quantities.items() if quantity)
+    try:
+        with transaction.atomic():
+            for batch in _batches(product_ids):
+                _lock(batch)
+                enough = reduce(or_, (Q(pk=pk, stock__gte=quantities[pk]) for pk in batch))
+                updated = Product.objects.filter(enough).update(
+                    stock=Case(*(When(pk=pk, then=F('stock') - quantities[pk]) for pk in batch)),
+                    updated_at=Now(),
+                )
+                if updated != len(batch):
+                    raise _Shortage
+            # update() sends no signals, the cached product list and details show stock
+            transaction.on_commit(invalidate_product_list)
+            transaction.on_commit(lambda: product_cache.invalidate_many(product_ids))
+    except _Shortage:
+        stock = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'stock'))
+        raise InsufficientStock([pk for pk in product_ids if stock.get(pk, 0) < quantities[pk]])
+
+
+def release(quantities):
+    # put `quantities` back into stock
+    product_ids = sorted(pk for pk, quantity in quantities.items() if quantity)
+    with transaction.atomic():
+        for batch in _batches(product_ids):
+            _lock(batch)
+            Product.objects.filter(pk__in=batch).update(
+                stock=Case(*(When(pk=pk, then=F('stock') + quantities[pk]) for pk in batch)),
+                updated_at=Now(),
+            )
+        transaction.on_commit(invalidate_product_list)
+        transaction.on_commit(lambda: product_cache.invalidate_many(product_ids))
+
+
+def set_status(order, status):
+    """
+    Move an order to `status`, reserving stock on Confirmed and giving it back
+    when a confirmed order is canceled (or moved back to pending).
+    """
+    with transaction.atomic():
+        previous = Order.objects.filter(pk=order.pk).values_list('status', flat=True).get()
+        if previous == status:
+            order.status = status
+            return order
+
+        # claim the transition, a concurrent request for the same order updates 0 rows
+        if not Order.objects.filter(pk=order.pk, status=previous).update(status=status, updated_at=Now()):
+            raise StatusConflict(f'Order {order.pk} changed status while it was being updated')
+
+        if status == Order.StatusChoices.CONFIRMED:
+            reserve(order_quantities(order))
+        elif previous == Order.StatusChoices.CONFIRMED:
+            release(order_quantities(order))
+
+        # update() sends no signals
+        invalidate_order_list(order.user_id)
+
+    order.status = status
+    return order
+
+
+def delete_order(order):
+    """
+    Delete an order, a confirmed one gives its reserved stock back.
+    """
+    with transaction.atomic():
+        # claimed like a status change, so a concurrent cancel can't release the same stock again
+        if Order.objects.filter(pk=order.pk, status=Order.StatusChoices.CONFIRMED).update(
+                status=Order.StatusChoices.CANCELED, updated_at=Now()):
+            release(order_quantities(order))
+        order.delete()
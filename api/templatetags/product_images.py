@@ -0,0 +1,31 @@
+from django import template
+
+from api.images import RENDITION_FORMATS, rendition_urls
+from api.mirror import local_url
+
+register = template.Library()
+
+
+@register.inclusion_tag('products/_picture.html')
+def product_picture(product, size='card', sizes='100vw', css_class='', lazy=True):
+    """
+    <picture> for a product, WebP with a JPEG fallback, `size` as the default source
+    and every rendition in the srcset so the browser picks by `sizes`.
+    """
+    context = {
+        'product': product,
+        'sizes': sizes,
+        'css_class': css_class,
+        'lazy': lazy,
+        'external_image_url': local_url(product.external_image_url, product.external_image_mirror),
+    }
+    images = rendition_urls(product.image_renditions)
+    if images:
+        # one entry per width, small originals give every size the same one
+        by_width = {image['width']: image for image in images.values()}
+        context['image'] = images.get(size) or by_width[max(by_width)]
+        context['srcset'] = {
+            fmt: ', '.join(f'{image[fmt]} {width}w' for width, image in sorted(by_width.items()))
+            for fmt in RENDITION_FORMATS
+        }
+    return context
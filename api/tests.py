@@ -1,7 +1,56 @@
-from django.test import TestCase
-from api.models import Order, User
+import csv
+import hashlib
+import json
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from base64 import urlsafe_b64encode
+from datetime import date, datetime, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from decimal import Decimal
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+import msgpack
+from PIL import ExifTags, Image
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from api.models import Order, OrderItem, Product, User
 from django.urls import reverse
+from django.utils.translation import gettext_lazy
 from rest_framework import status
+from rest_framework.exceptions import ErrorDetail, ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.throttling import ScopedRateThrottle
+from api.serializers import OrderCreateSerializer, OrderSerializer, ProductSerializer
+from api.fast_serializers import order_rows, product_rows, product_values
+from api.stock import InsufficientStock, set_status
+from api.caching import (PRODUCT_LIST_NAMESPACE, bulk_product_changes, bump_generation, get_generation,
+                         order_list_cache_key, order_list_namespace, product_cache)
+from django.http import QueryDict
+from silk.collector import DataCollector
+from silk.models import Request as SilkRequest
+from silk.profiling.profiler import silk_profile
+from api.middleware import DatabaseRoutingMiddleware, QueryBudgetMiddleware
+from api.query_budget import QueryBudgetExceeded, QueryBudgetTestMixin
+from api.parsers import MessagePackParser, ORJSONParser
+from api.renderers import MessagePackRenderer, ORJSONRenderer
+from api.authentication import ClaimsTokenObtainPairSerializer
+from rest_framework_simplejwt.tokens import AccessToken
+from api.metrics import Metrics, collect, metrics
+from api.throttles import LocalCounters, ScopedSlidingWindowThrottle, SlidingWindowRateThrottle
+from api.routers import WeightedRoundRobin
+from api import search as search_index
 
 # Create your tests here.
 class UserOrderTestCase(TestCase):
@@ -25,4 +74,1464 @@ class UserOrderTestCase(TestCase):
 
     def test_user_order_list_unauthenticated_user(self):
         response = self.client.get(reverse('user-orders'))
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ProductKeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # duplicated prices so the pk tiebreaker matters
+        Product.objects.bulk_create([
+            Product(name=f'Product {i}', description='desc', price=Decimal(10 + i % 3), stock=i % 4)
+            for i in range(12)
+        ])
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [row['name'] for row in response.json()['results']]
+            url = response.json()['next']
+        return ids
+
+    def test_pages_cover_every_product_once(self):
+        names = self.walk('/api/products/?page_size=5&ordering=-price')
+        expected = list(
+            Product.objects.filter(stock__gt=0).order_by('-price', 'pk').values_list('name', flat=True)
+        )
+        self.assertEqual(names, expected)
+
+    def test_previous_link_returns_the_earlier_page(self):
+        first = self.client.get('/api/products/?page_size=3&ordering=stock').json()
+        second = self.client.get(first['next']).json()
+        back = self.client.get(second['previous']).json()
+        self.assertEqual(back['results'], first['results'])
+
+    def test_cursor_with_different_ordering_is_rejected(self):
+        first = self.client.get('/api/products/?page_size=3&ordering=price').json()
+        cursor = first['next'].split('cursor=')[1].split('&')[0]
+        response = self.client.get(f'/api/products/?cursor={cursor}&ordering=name')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_tampered_cursor_is_rejected(self):
+        ordering = ['price', 'pk']
+        for position in (5, None, 'ab', {'a': 1, 'b': 2}, [[1], 2], [1]):
+            with self.subTest(position=position):
+                payload = json.dumps({'p': position, 'r': 0, 'o': ordering}).encode()
+                cursor = urlsafe_b64encode(payload).decode()
+                response = self.client.get(f'/api/products/?cursor={cursor}&ordering=price')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class OrderExportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        other = User.objects.create_user(username='other', password='test')
+        product, = Product.objects.bulk_create([
+            Product(name='Watch', description='desc', price=Decimal('2.50'), stock=3)
+        ])
+        for user, order_status in [(self.user, 'Pending'), (self.user, 'Confirmed'), (other, 'Pending')]:
+            order = Order.objects.create(user=user, status=order_status)
+            OrderItem.objects.create(order=order, product=product, quantity=2)
+        self.client.force_login(self.user)
+
+    def test_ndjson_streams_one_line_per_order(self):
+        response = self.client.get('/orders/export/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(row['user'] == self.user.id for row in rows))
+        self.assertEqual(rows[0]['items'][0]['product_price'], '2.50')
+
+    def test_csv_honours_order_filter(self):
+        response = self.client.get('/orders/export/?export_format=csv&status=Confirmed')
+        lines = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(lines[0][0], 'order_id')
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1][3], 'Confirmed')
+
+    def test_unknown_format_is_rejected(self):
+        response = self.client.get('/orders/export/?export_format=xml')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class OrderTotalsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        cheap, dear = Product.objects.bulk_create([
+            Product(name='Pen', description='desc', price=Decimal('1.25'), stock=10),
+            Product(name='Camera', description='desc', price=Decimal('350.99'), stock=2),
+        ])
+        self.small = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.small, product=cheap, quantity=3)
+        self.large = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.large, product=cheap, quantity=1)
+        OrderItem.objects.create(order=self.large, product=dear, quantity=2)
+        self.empty = Order.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_annotated_totals_match_python_totals(self):
+        for order in Order.objects.with_totals():
+            expected = sum(item.item_subtotal for item in Order.objects.get(pk=order.pk).items.all())
+            self.assertEqual(order.total_price, expected)
+            for item in order.items.all():
+                self.assertEqual(item.subtotal, item.item_subtotal)
+
+    def test_serializer_uses_annotations_without_extra_queries(self):
+        orders = list(Order.objects.with_totals())
+        with self.assertNumQueries(0):
+            data = OrderSerializer(orders, many=True).data
+        totals = {row['order_id']: row['total_price'] for row in data}
+        self.assertEqual(totals[str(self.large.pk)], Decimal('703.23'))
+        self.assertEqual(totals[str(self.empty.pk)], Decimal('0.00'))
+
+    def test_filter_and_order_by_total(self):
+        response = self.client.get('/orders/?total_price__gt=1&ordering=-total_price')
+        ids = [row['order_id'] for row in response.json()]
+        self.assertEqual(ids, [str(self.large.pk), str(self.small.pk)])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class OrderBulkWriteTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', description='desc', price=Decimal('1.00'), stock=5)
+            for i in range(5)
+        ])
+        self.client.force_login(self.user)
+
+    def test_create_inserts_items_in_one_statement(self):
+        items = [{'product': product.pk, 'quantity': 1} for product in self.products]
+        serializer = OrderCreateSerializer(data={'items': items})
+        with CaptureQueriesContext(connection) as queries:
+            serializer.is_valid(raise_exception=True)
+            serializer.save(user=self.user)
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        # products lookup, order insert, items insert
+        self.assertEqual(statements.count('SELECT'), 1)
+        self.assertEqual(statements.count('INSERT'), 2)
+        self.assertEqual(OrderItem.objects.count(), 5)
+
+    def test_batch_creates_many_orders(self):
+        payload = [
+            {'items': [{'product': self.products[i].pk, 'quantity': i + 1}]}
+            for i in range(5)
+        ]
+        response = self.client.post('/orders/batch/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 5)
+        self.assertEqual(OrderItem.objects.count(), 5)
+
+    def test_batch_rejects_unknown_product_and_saves_nothing(self):
+        payload = [
+            {'items': [{'product': self.products[0].pk, 'quantity': 1}]},
+            {'items': [{'product': 999999, 'quantity': 1}]},
+        ]
+        response = self.client.post('/orders/batch/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('product', response.json()[1]['items'][0])
+        self.assertFalse(Order.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class StockReservationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.pen, self.camera = Product.objects.bulk_create([
+            Product(name='Pen', description='desc', price=Decimal('1.00'), stock=5),
+            Product(name='Camera', description='desc', price=Decimal('300.00'), stock=1),
+        ])
+        self.order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.order, product=self.pen, quantity=2)
+        OrderItem.objects.create(order=self.order, product=self.camera, quantity=1)
+        self.client.force_login(self.user)
+
+    def stock(self):
+        return dict(Product.objects.values_list('name', 'stock'))
+
+    def test_confirm_reserves_and_cancel_restores(self):
+        set_status(self.order, Order.StatusChoices.CONFIRMED)
+        self.assertEqual(self.stock(), {'Pen': 3, 'Camera': 0})
+        set_status(self.order, Order.StatusChoices.CANCELED)
+        self.assertEqual(self.stock(), {'Pen': 5, 'Camera': 1})
+
+    def test_shortage_rolls_back_every_product(self):
+        Product.objects.filter(pk=self.camera.pk).update(stock=0)
+        with self.assertRaises(InsufficientStock) as raised:
+            set_status(self.order, Order.StatusChoices.CONFIRMED)
+        self.assertEqual(raised.exception.product_ids, [self.camera.pk])
+        self.assertEqual(self.stock(), {'Pen': 5, 'Camera': 0})
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.StatusChoices.PENDING)
+
+    def test_api_confirm_reports_shortage(self):
+        other = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=other, product=self.camera, quantity=1)
+        set_status(other, Order.StatusChoices.CONFIRMED)
+
+        response = self.client.patch(
+            f'/orders/{self.order.pk}/', {'status': 'Confirmed'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(), {'Pen': 5, 'Camera': 0})
+
+    def test_create_confirmed_order_reserves_stock(self):
+        serializer = OrderCreateSerializer(data={
+            'status': 'Confirmed',
+            'items': [{'product': self.pen.pk, 'quantity': 4}],
+        })
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=self.user)
+        self.assertEqual(self.stock()['Pen'], 1)
+
+    def test_item_update_uses_the_current_status(self):
+        # the instance was loaded while pending, another request confirmed it since
+        stale = Order.objects.get(pk=self.order.pk)
+        set_status(self.order, Order.StatusChoices.CONFIRMED)
+
+        serializer = OrderCreateSerializer(stale, data={'items': [{'product': self.pen.pk, 'quantity': 1}]}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.assertEqual(self.stock(), {'Pen': 4, 'Camera': 1})
+
+    @mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+    def test_deleting_confirmed_order_restores_stock(self):
+        set_status(self.order, Order.StatusChoices.CONFIRMED)
+        response = self.client.delete(f'/orders/{self.order.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.stock(), {'Pen': 5, 'Camera': 1})
+        self.assertFalse(Order.objects.filter(pk=self.order.pk).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ProductListCacheGenerationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+
+    def test_product_save_invalidates_cached_list(self):
+        first = self.client.get('/api/products/').json()
+        self.assertEqual(first['results'][0]['stock'], 5)
+
+        self.product.stock = 7
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        second = self.client.get('/api/products/').json()
+        self.assertEqual(second['results'][0]['stock'], 7)
+
+    def test_invalidation_waits_for_commit(self):
+        generation = get_generation(PRODUCT_LIST_NAMESPACE)
+        product_cache.get(self.product.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.product.stock = 7
+                self.product.save()
+                # a reader before the commit still gets the old row, under the old version
+                self.assertEqual(get_generation(PRODUCT_LIST_NAMESPACE), generation)
+                self.assertEqual(product_cache.get(self.product.pk).stock, 5)
+        self.assertEqual(get_generation(PRODUCT_LIST_NAMESPACE), generation + 1)
+        self.assertEqual(product_cache.get(self.product.pk).stock, 7)
+
+    def test_cached_list_is_served_until_a_product_changes(self):
+        self.client.get('/api/products/')
+        Product.objects.filter(pk=self.product.pk).update(stock=9)
+        self.assertEqual(self.client.get('/api/products/').json()['results'][0]['stock'], 5)
+
+    def test_bulk_changes_bump_the_generation_once(self):
+        generation = get_generation(PRODUCT_LIST_NAMESPACE)
+        with bulk_product_changes():
+            for i in range(10):
+                Product.objects.create(name=f'Bulk {i}', description='desc', price=Decimal('1.00'), stock=1)
+            self.assertEqual(get_generation(PRODUCT_LIST_NAMESPACE), generation)
+        self.assertEqual(get_generation(PRODUCT_LIST_NAMESPACE), generation + 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class OrderListCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.other = User.objects.create_user(username='other', password='test')
+        Order.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_own_write_invalidates_cached_list(self):
+        self.assertEqual(len(self.client.get('/orders/').json()), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.user)
+        self.assertEqual(len(self.client.get('/orders/').json()), 2)
+
+    def test_other_users_write_keeps_cache(self):
+        self.client.get('/orders/')
+        generation = get_generation(order_list_namespace(self.user))
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.other)
+        self.assertEqual(get_generation(order_list_namespace(self.user)), generation)
+
+    def test_item_writes_invalidate_once_per_order(self):
+        order = Order.objects.create(user=self.user)
+        product = Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=1) for _ in range(3)])
+        serializer = OrderCreateSerializer(order, data={'items': [{'product': product.pk, 'quantity': 2}]})
+        serializer.is_valid(raise_exception=True)
+        with mock.patch('api.caching.bump_generation') as bump, self.captureOnCommitCallbacks(execute=True):
+            serializer.save()
+        # the owner's namespace and the staff one
+        self.assertEqual(bump.call_count, 2)
+
+        # the cascade from the order leaves the items' owner to the order's own signal
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=1) for _ in range(3)])
+        order = Order.objects.get(pk=order.pk)
+        with CaptureQueriesContext(connection) as queries:
+            order.delete()
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('SELECT "api_order"."')])
+
+    def test_product_writes_invalidate_cached_list(self):
+        product = Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=product, quantity=2)
+        self.client.get('/orders/')
+
+        product.price = Decimal('3.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        row = next(row for row in self.client.get('/orders/').json() if row['items'])
+        self.assertEqual(row['items'][0]['product_price'], '3.00')
+        self.assertEqual(Decimal(row['total_price']), Decimal('6.00'))
+
+        # update() sends no signals, bulk_product_changes() covers it
+        with bulk_product_changes():
+            Product.objects.filter(pk=product.pk).update(name='Fountain pen')
+        row = next(row for row in self.client.get('/orders/').json() if row['items'])
+        self.assertEqual(row['items'][0]['product_name'], 'Fountain pen')
+
+    def test_cache_key_ignores_param_order(self):
+        self.client.get('/orders/?status=Pending&ordering=created_at')
+        key = order_list_cache_key(mock.Mock(
+            user=self.user,
+            query_params=QueryDict('ordering=created_at&status=Pending'),
+        ))
+        self.assertEqual(len(cache.get(key)), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ProductInfoTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Product.objects.bulk_create([
+            Product(name='Pen', description='desc', price=Decimal('1.00'), stock=5),
+            Product(name='Watch', description='desc', price=Decimal('500.00'), stock=0),
+            Product(name='Camera', description='desc', price=Decimal('299.00'), stock=2),
+        ])
+
+    def test_summary_without_products(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get('/api/products/info/?include_products=false').json()
+        product_queries = [q for q in queries.captured_queries if q['sql'].startswith('SELECT') and 'api_product' in q['sql']]
+        self.assertEqual(len(product_queries), 1)
+        self.assertNotIn('products', data)
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(data['in_stock_count'], 2)
+        self.assertEqual(data['max_price'], 500.0)
+        self.assertEqual(data['min_price'], 1.0)
+        self.assertAlmostEqual(data['avg_price'], 800 / 3, places=6)
+
+    def test_default_response_keeps_every_product(self):
+        data = self.client.get('/products/info/').json()
+        self.assertEqual(len(data['products']), 3)
+
+    def test_paginated_products(self):
+        data = self.client.get('/api/products/info/?page_size=2').json()
+        self.assertEqual([p['name'] for p in data['products']], ['Pen', 'Watch'])
+        self.assertEqual(len(self.client.get(data['next']).json()['products']), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ProductFullTextSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Product.objects.bulk_create([
+            Product(name='Coffee Machine', description='Brews espresso', price=Decimal('70.99'), stock=6),
+            Product(name='Espresso Cups', description='Set of four', price=Decimal('9.99'), stock=6),
+            Product(name='Watch', description='Leather strap', price=Decimal('500.05'), stock=1),
+        ])
+
+    def search(self, query):
+        return [row['name'] for row in self.client.get(f'/api/products/?search={query}').json()['results']]
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(self.search('espresso'), ['Espresso Cups', 'Coffee Machine'])
+
+    def test_prefix_and_multiple_terms(self):
+        self.assertEqual(self.search('coff brew'), ['Coffee Machine'])
+
+    def test_index_follows_updates_and_deletes(self):
+        Product.objects.filter(name='Watch').update(description='Espresso brown dial')
+        Product.objects.filter(name='Espresso Cups').delete()
+        self.assertEqual(self.search('espresso'), ['Coffee Machine', 'Watch'])
+
+    def test_ranked_results_paginate(self):
+        first = self.client.get('/api/products/?search=espresso&page_size=1').json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual([first['results'][0]['name'], second['results'][0]['name']], ['Espresso Cups', 'Coffee Machine'])
+        self.assertIsNone(second['next'])
+
+    def test_quotes_in_terms_are_not_fts_syntax(self):
+        response = self.client.get('/api/products/?search="watch OR')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_availability_is_looked_up_once_either_way(self):
+        self.addCleanup(search_index.forget)
+        search_index.forget()
+        introspection = connection.introspection
+        with mock.patch.object(introspection, 'table_names', return_value=[]) as table_names:
+            self.assertFalse(search_index.is_available())
+            self.assertFalse(search_index.is_available())
+        self.assertEqual(table_names.call_count, 1)
+
+        # until the next migrate or rebuild
+        search_index.forget('default')
+        self.assertTrue(search_index.is_available())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ProductCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        product_cache.clear_local()
+        # silk keeps the last request of the thread and EXPLAINs every query it sees
+        DataCollector().clear()
+        self.pen, self.cup = Product.objects.bulk_create([
+            Product(name='Pen', description='desc', price=Decimal('1.00'), stock=5),
+            Product(name='Cup', description='desc', price=Decimal('4.00'), stock=2),
+        ])
+
+    def test_local_hit_skips_database_and_shared_cache(self):
+        product_cache.get(self.pen.pk)
+        with self.assertNumQueries(0), mock.patch.object(cache, 'get_many') as get_many:
+            self.assertEqual(product_cache.get(self.pen.pk).name, 'Pen')
+        get_many.assert_not_called()
+
+    def test_get_many_loads_in_one_query(self):
+        with self.assertNumQueries(1):
+            products = product_cache.get_many([self.pen.pk, self.cup.pk, 999])
+        self.assertEqual(set(products), {self.pen.pk, self.cup.pk})
+        # another worker, empty local tier, served by the shared cache
+        product_cache.clear_local()
+        with self.assertNumQueries(0):
+            product_cache.get_many([self.pen.pk, self.cup.pk])
+
+    def test_save_invalidates_both_tiers(self):
+        product_cache.get(self.pen.pk)
+        self.pen.name = 'Fountain Pen'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pen.save()
+        self.assertEqual(product_cache.get(self.pen.pk).name, 'Fountain Pen')
+
+    def test_stale_shared_entry_is_ignored_after_version_bump(self):
+        product_cache.get(self.pen.pk)
+        Product.objects.filter(pk=self.pen.pk).update(stock=1)
+        # a write in another worker bumps the version, this worker's local copy has expired
+        cache.set(f'product:{self.pen.pk}:version', 1)
+        product_cache.clear_local()
+        self.assertEqual(product_cache.get(self.pen.pk).stock, 1)
+
+    def test_detail_views_read_through_cache(self):
+        self.assertEqual(self.client.get(f'/api/products/{self.pen.pk}/').json()['name'], 'Pen')
+        self.assertEqual(self.client.get(f'/products/{self.cup.pk}/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/products/999/').status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        product_cache.clear_local()
+        self.product = Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.order = Order.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def assertRevalidates(self, url, change):
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        since = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(since.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_product_list(self):
+        self.assertRevalidates('/api/products/', lambda: self.product.save())
+
+    def test_product_detail(self):
+        self.assertRevalidates(f'/api/products/{self.product.pk}/', lambda: self.product.save())
+
+    def test_order_list(self):
+        self.assertRevalidates('/orders/', lambda: Order.objects.create(user=self.user))
+
+    def test_order_detail(self):
+        self.assertRevalidates(f'/orders/{self.order.pk}/', lambda: set_status(self.order, 'Canceled'))
+
+    def test_order_detail_follows_product_changes(self):
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=2)
+
+        def change_price():
+            self.product.price = Decimal('2.00')
+            self.product.save()
+        self.assertRevalidates(f'/orders/{self.order.pk}/', change_price)
+
+    def test_not_modified_skips_the_query(self):
+        etag = self.client.get('/api/products/')['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertFalse([q for q in queries.captured_queries if 'api_product' in q['sql']])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class AsyncReadPathTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        product_cache.clear_local()
+        Product.objects.bulk_create([
+            Product(name=f'Product {i}', description='desc', price=Decimal(10 + i), stock=i % 3)
+            for i in range(5)
+        ])
+        self.product = Product.objects.first()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=2)
+        self.async_client = AsyncClient()
+
+    async def assertSameAsSync(self, url):
+        expected = await sync_to_async(lambda: self.client.get(url).json())()
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected)
+        return response
+
+    async def test_product_endpoints_match_sync_views(self):
+        response = await self.assertSameAsSync('/api/products/?page_size=2')
+        await self.assertSameAsSync(response.json()['next'].replace('http://testserver', ''))
+        await self.assertSameAsSync(f'/api/products/{self.product.pk}/')
+        await self.assertSameAsSync('/api/products/info/')
+        await self.assertSameAsSync('/api/products/info/?page_size=2')
+
+    async def test_order_endpoints_match_sync_views(self):
+        await sync_to_async(self.client.force_login)(self.user)
+        await self.async_client.aforce_login(self.user)
+        await self.assertSameAsSync('/orders/')
+        await self.assertSameAsSync(f'/orders/{self.order.pk}/')
+
+    async def test_orders_require_authentication(self):
+        response = await self.async_client.get('/orders/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_conditional_get(self):
+        response = await self.async_client.get('/api/products/')
+        not_modified = await self.async_client.get('/api/products/', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_writes_fall_back_to_drf_views(self):
+        response = await self.async_client.post('/api/products/', {'name': 'x'}, content_type='application/json')
+        # the DRF view answers, products can only be created by admins
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class QueryPlanTestCase(TestCase):
+    # a table read start to end, a pk index scan is no better
+    FULL_SCAN = re.compile(r'^SCAN (api_\w+|U\d+)( USING (COVERING )?INDEX sqlite_autoindex_\w+)?$')
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.staff = User.objects.create_user(username='staff', password='test', is_staff=True)
+        product = Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=product, quantity=1)
+
+    def plans(self, url):
+        DataCollector().clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        plans = []
+        for query in queries.captured_queries:
+            if query['sql'].startswith('SELECT') and re.search(r'"api_(product|order)"', query['sql']):
+                with connection.cursor() as cursor:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {query["sql"]}')
+                    plans.append([row[3] for row in cursor.fetchall()])
+        self.assertTrue(plans, url)
+        return plans
+
+    def assertNoFullScan(self, urls):
+        for url in urls:
+            with self.subTest(url=url):
+                for plan in self.plans(url):
+                    self.assertFalse([step for step in plan if self.FULL_SCAN.match(step)], plan)
+
+    def test_product_list(self):
+        self.assertNoFullScan([
+            '/api/products/',
+            '/api/products/?price=1',
+            '/api/products/?price__gt=1',
+            '/api/products/?price__lt=5',
+            '/api/products/?price__range=1,5',
+            '/api/products/?name__iexact=pen',
+            '/api/products/?ordering=price',
+            '/api/products/?search=pen',
+        ])
+
+    def test_user_orders(self):
+        self.client.force_login(self.user)
+        self.assertNoFullScan([
+            '/orders/',
+            '/orders/?status=Pending',
+            '/orders/?created_at=2026-01-01',
+            '/orders/?created_at__gt=2026-01-01T00:00:00Z',
+            '/orders/?created_at__lt=2026-01-01T00:00:00Z',
+            '/orders/?status=Pending&ordering=-created_at',
+        ])
+
+    def test_staff_orders(self):
+        self.client.force_login(self.staff)
+        self.assertNoFullScan([
+            '/orders/?status=Confirmed',
+            '/orders/?created_at=2026-01-01',
+            '/orders/?created_at__gt=2026-01-01T00:00:00Z',
+        ])
+
+    def test_created_at_date_is_a_range(self):
+        self.client.force_login(self.user)
+        order = Order.objects.get()
+        today = order.created_at.date().isoformat()
+        self.assertEqual(len(self.client.get(f'/orders/?created_at={today}').json()), 1)
+        self.assertEqual(self.client.get('/orders/?created_at=2001-01-01').json(), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PopulateDbTestCase(TestCase):
+    def populate(self, **options):
+        call_command('populate_db', stdout=StringIO(), stderr=StringIO(), batch_size=40, **options)
+
+    def test_generates_the_requested_rows(self):
+        self.populate(products=100, users=10, orders=30, items_per_order=3, seed=1)
+        self.assertEqual(Product.objects.count(), 100)
+        # the admin and the generated users
+        self.assertEqual(User.objects.count(), 11)
+        self.assertEqual(Order.objects.count(), 30)
+        self.assertFalse(Order.objects.filter(items__isnull=True).exists())
+        self.assertTrue(all(0 < price for price in Product.objects.values_list('price', flat=True)))
+
+    def test_same_seed_same_rows(self):
+        def generate():
+            with transaction.atomic():
+                self.populate(products=50, users=5, orders=20, seed=5)
+                rows = (
+                    list(Product.objects.order_by('pk').values_list('pk', 'name', 'price', 'stock', 'updated_at')),
+                    sorted(OrderItem.objects.values_list('order_id', 'product_id', 'quantity')),
+                    sorted(Order.objects.values_list('order_id', 'created_at', 'updated_at')),
+                    list(User.objects.exclude(username='admin').order_by('pk').values_list('pk', 'date_joined')),
+                )
+                # start the second run from the same empty tables
+                transaction.set_rollback(True)
+            return rows
+
+        self.assertEqual(generate(), generate())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class QueryBudgetTestCase(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        product_cache.clear_local()
+        self.admin = User.objects.create_superuser(username='admin', password='test')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', description='desc', price=Decimal('2.00'), stock=100) for i in range(5)
+        ])
+        # enough users, orders and items for a per-row query to stand out
+        for user in [self.admin] + [User.objects.create_user(username=f'user{i}') for i in range(5)]:
+            for _ in range(3):
+                order = Order.objects.create(user=user)
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=product, quantity=1) for product in self.products[:3]
+                ])
+        self.client.force_login(self.admin)
+
+    def test_every_route_stays_within_budget(self):
+        product = self.products[2].pk
+        order, other = Order.objects.filter(user=self.admin).values_list('pk', flat=True)[:2]
+        item = {'product': product, 'quantity': 1}
+        items = [{'product': row.pk, 'quantity': 1} for row in self.products[:3]]
+        self.assertQueryBudgets([
+            ('get', '/api/products/?price__gt=1&ordering=-price'),
+            ('get', '/api/products/?search=product'),
+            ('post', '/api/products/', {'name': 'New', 'description': 'desc', 'price': '1.00', 'stock': 1}),
+            ('get', f'/api/products/{product}/'),
+            ('put', f'/api/products/{product}/', {'name': 'Pen', 'description': 'desc', 'price': '1.00', 'stock': 50}),
+            ('patch', f'/api/products/{product}/', {'stock': 60}),
+            ('delete', f'/api/products/{self.products[4].pk}/'),
+            ('get', '/api/products/info/?page_size=2'),
+            ('get', '/products/info/'),
+            ('get', '/products/'),
+            ('get', f'/products/{product}/'),
+            ('get', '/users/'),
+            ('get', '/orders/?status=Pending'),
+            ('post', '/orders/', {'status': 'Confirmed', 'items': items}),
+            ('get', f'/orders/{order}/'),
+            ('put', f'/orders/{order}/', {'status': 'Pending', 'items': items}),
+            ('patch', f'/orders/{other}/', {'status': 'Confirmed'}),
+            ('get', '/orders/export/?export_format=csv'),
+            ('post', '/orders/batch/', [{'status': 'Pending', 'items': items}, {'status': 'Confirmed', 'items': items}]),
+            ('delete', f'/orders/{order}/'),
+        ])
+
+    @override_settings(QUERY_BUDGET={'ENABLED': True})
+    async def test_async_requests_are_counted_without_leaving_the_event_loop(self):
+        async def get_response(request):
+            pass
+        # the chain isn't adapted to sync around it
+        self.assertTrue(iscoroutinefunction(QueryBudgetMiddleware(get_response)))
+        response = await AsyncClient().get('/api/products/')
+        self.assertGreater(int(response['X-Query-Count']), 0)
+
+    def test_repeated_queries_are_reported(self):
+        with override_settings(QUERY_BUDGET={'ENABLED': True, 'REPEATED_QUERY_THRESHOLD': 3}):
+            client = self.client_class()
+            client.cookies = self.client.cookies
+            # what UserListView did before prefetching the order ids
+            with mock.patch('api.views.users.UserListView.get_queryset', lambda view: User.objects.order_by('pk')):
+                with self.assertRaisesRegex(QueryBudgetExceeded, 'same query 6 times'):
+                    client.get('/users/')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class UserListTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', first_name='Ann', last_name=f'{i}') for i in range(5)]
+        for count, user in enumerate(self.users):
+            Order.objects.bulk_create([Order(user=user) for _ in range(count)])
+
+    def test_pages_with_order_ids_and_counts(self):
+        page = self.client.get('/users/?page_size=2').json()
+        self.assertEqual([user['username'] for user in page['results']], ['user0', 'user1'])
+        self.assertEqual(page['results'][1]['order_count'], 1)
+        self.assertEqual(page['results'][1]['orders'], [str(self.users[1].orders.get().pk)])
+        self.assertEqual(page['results'][1]['get_full_name'], 'Ann 1')
+
+        rest = self.client.get(page['next']).json()
+        self.assertEqual([user['order_count'] for user in rest['results']], [2, 3])
+
+    def test_field_selection_skips_the_order_queries(self):
+        DataCollector().clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/users/?fields=username')
+        self.assertEqual(response.json()['results'][0], {'username': 'user0'})
+        selects = [q['sql'] for q in queries.captured_queries
+                   if q['sql'].startswith('SELECT') and 'silk_' not in q['sql']]
+        self.assertEqual(len(selects), 1)
+        self.assertNotIn('api_order', selects[0])
+        self.assertNotIn('password', selects[0])
+
+    def test_unknown_field(self):
+        response = self.client.get('/users/?fields=username,password')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FastSerializerTestCase(TestCase):
+    def setUp(self):
+        self.products = Product.objects.bulk_create([
+            Product(name='Pen', description='blue', price=Decimal('1.50'), stock=3),
+            Product(name='Ink', description='', price=Decimal('20'), stock=0, external_image_url='https://example.com/i.png'),
+            Product(name='Pad', description='lined', price=Decimal('0.05'), stock=7),
+        ])
+        user = User.objects.create_user(username='buyer', password='test')
+        orders = Order.objects.bulk_create([Order(user=user, status=status) for status in ('Pending', 'Confirmed')])
+        Order.objects.create(user=user)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=orders[0], product=self.products[0], quantity=3),
+            OrderItem(order=orders[0], product=self.products[2], quantity=1),
+            OrderItem(order=orders[1], product=self.products[1], quantity=2),
+        ])
+
+    def test_products_match_product_serializer(self):
+        queryset = Product.objects.order_by('pk')
+        self.assertEqual(product_rows(product_values(queryset)), ProductSerializer(queryset, many=True).data)
+
+    def test_orders_match_order_serializer(self):
+        queryset = Order.objects.with_totals().order_by('created_at', 'pk')
+        self.assertEqual(order_rows(queryset), OrderSerializer(queryset, many=True).data)
+
+    @override_settings(TIME_ZONE='Europe/Berlin')
+    def test_dates_in_the_current_time_zone(self):
+        queryset = Order.objects.with_totals().order_by('created_at', 'pk')
+        self.assertEqual(
+            [row['created_at'] for row in order_rows(queryset)],
+            [row['created_at'] for row in OrderSerializer(queryset, many=True).data],
+        )
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_list_endpoints(self):
+        cache.clear()
+        response = self.client.get('/api/products/?ordering=-price')
+        # the list only shows products in stock
+        expected = ProductSerializer(Product.objects.filter(stock__gt=0).order_by('-price'), many=True).data
+        self.assertEqual(response.json()['results'], json.loads(json.dumps(expected)))
+
+
+
+class RendererTestCase(TestCase):
+    DATA = {
+        'price': Decimal('12.50'),
+        'order_id': uuid.UUID('6f1c2a56-7d37-4e57-9a64-1bdfd2e1c0a1'),
+        'created_at': datetime(2024, 5, 1, 12, 30, 5, 250, tzinfo=dt_timezone.utc),
+        'in_london': datetime(2024, 1, 1, 9, tzinfo=ZoneInfo('Europe/London')),
+        'in_berlin': datetime(2024, 1, 1, 9, tzinfo=ZoneInfo('Europe/Berlin')),
+        'day': date(2024, 2, 29),
+        'text': 'caf\u00e9 \u2028 \u2029 "quoted" \x00\x1f',
+        'detail': ErrorDetail('Invalid cursor', code='invalid'),
+        'lazy': gettext_lazy('This field is required.'),
+        'nested': [{'a': 1, 'b': None, 'c': True, 'd': 0.1}, (1, 2), []],
+        1: 'int key',
+    }
+
+    def test_orjson_bytes_match_drf(self):
+        self.assertEqual(ORJSONRenderer().render(self.DATA), JSONRenderer().render(self.DATA))
+
+    def test_orjson_falls_back_to_drf(self):
+        for data in ({'big': 2 ** 70}, {'surrogate': '\ud800'}):
+            with self.subTest(data=data):
+                try:
+                    expected = JSONRenderer().render(data)
+                except UnicodeEncodeError:
+                    self.assertRaises(UnicodeEncodeError, ORJSONRenderer().render, data)
+                else:
+                    self.assertEqual(ORJSONRenderer().render(data), expected)
+        self.assertEqual(
+            ORJSONRenderer().render(self.DATA, 'application/json; indent=4'),
+            JSONRenderer().render(self.DATA, 'application/json; indent=4'),
+        )
+
+    def test_msgpack_values_match_json(self):
+        data = msgpack.unpackb(MessagePackRenderer().render(self.DATA), raw=False, strict_map_key=False)
+        expected = json.loads(JSONRenderer().render(self.DATA))
+        # JSON only has string keys
+        self.assertEqual({str(key): value for key, value in data.items()}, expected)
+
+    def test_parsers(self):
+        body = {'status': 'Pending', 'items': [{'product': 1, 'quantity': 2}]}
+        self.assertEqual(ORJSONParser().parse(BytesIO(json.dumps(body).encode())), body)
+        self.assertEqual(MessagePackParser().parse(BytesIO(msgpack.packb(body))), body)
+        for parser, content in ((ORJSONParser(), b'{"a": NaN}'), (MessagePackParser(), b'\xc1')):
+            with self.subTest(parser=parser):
+                self.assertRaises(ParseError, parser.parse, BytesIO(content))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class ContentNegotiationTestCase(TestCase):
+    MSGPACK = {'Accept': 'application/msgpack'}
+
+    def setUp(self):
+        cache.clear()
+        product_cache.clear_local()
+        self.product = Product.objects.create(name='Pen', description='blue', price=Decimal('1.50'), stock=30)
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.client.force_login(self.user)
+
+    def assertSameData(self, url):
+        # either format may be cached first, the cache varies on Accept
+        packed = self.client.get(url, headers=self.MSGPACK)
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(packed['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(packed.content), response.json())
+        self.assertEqual(msgpack.unpackb(self.client.get(url, headers=self.MSGPACK).content), response.json())
+
+    def test_read_endpoints(self):
+        self.client.post('/orders/', {'items': [{'product': self.product.pk, 'quantity': 2}]},
+                         content_type='application/json')
+        for url in ('/api/products/', f'/api/products/{self.product.pk}/', '/api/products/info/', '/orders/', '/users/'):
+            with self.subTest(url=url):
+                self.assertSameData(url)
+        self.assertEqual(self.client.get('/api/products/?format=msgpack')['Content-Type'], 'application/msgpack')
+
+    def test_msgpack_request_body(self):
+        body = msgpack.packb({'status': 'Pending', 'items': [{'product': self.product.pk, 'quantity': 2}]})
+        response = self.client.post('/orders/', body, content_type='application/msgpack', headers=self.MSGPACK)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(msgpack.unpackb(response.content)['items'][0]['quantity'], 2)
+
+        response = self.client.post('/orders/', b'\xc1', content_type='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('MessagePack parse error', response.json()['detail'])
+
+    async def test_async_views_negotiate(self):
+        response = await self.async_client.get('/api/products/', headers=self.MSGPACK)
+        json_response = await self.async_client.get('/api/products/')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), json_response.json())
+        self.assertIn('Accept', response['Vary'])
+        response = await self.async_client.get('/api/products/', headers={'Accept': 'text/csv'})
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+
+def image_file(size, mode='RGB', image_format='PNG', exif=None):
+    buffer = BytesIO()
+    Image.new(mode, size, 'red').save(buffer, image_format, **({'exif': exif} if exif else {}))
+    return ContentFile(buffer.getvalue())
+
+
+@override_settings(CACHES=LOCMEM_CACHE, PRODUCT_IMAGES={'WORKERS': 0})
+class ProductImageTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        cache.clear()
+        product_cache.clear_local()
+
+    def create_product(self, content, name='shot.png'):
+        product = Product(name='Camera', description='', price=Decimal('10'), stock=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image.save(name, content)
+        product.refresh_from_db()
+        return product
+
+    def test_renditions_and_dimensions_after_upload(self):
+        product = self.create_product(image_file((2000, 1000), 'RGBA'))
+        self.assertEqual((product.image_width, product.image_height), (2000, 1000))
+        self.assertEqual(product.image_renditions['source'], product.image.name)
+
+        sizes = product.image_renditions['sizes']
+        self.assertEqual(
+            {size: (rendition['width'], rendition['height']) for size, rendition in sizes.items()},
+            {'thumbnail': (160, 80), 'card': (480, 240), 'full': (1600, 800)},
+        )
+        for rendition in sizes.values():
+            for fmt, pillow_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                with default_storage.open(rendition[fmt]) as f, Image.open(f) as image:
+                    self.assertEqual(image.format, pillow_format)
+                    self.assertEqual(image.size, (rendition['width'], rendition['height']))
+
+    def test_exif_rotation_and_no_upscaling(self):
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        product = self.create_product(image_file((300, 200), image_format='JPEG', exif=exif), 'photo.jpg')
+        self.assertEqual((product.image_width, product.image_height), (200, 300))
+        sizes = product.image_renditions['sizes']
+        self.assertEqual((sizes['thumbnail']['width'], sizes['thumbnail']['height']), (107, 160))
+        self.assertEqual((sizes['full']['width'], sizes['full']['height']), (200, 300))
+
+    def test_new_image_replaces_renditions(self):
+        product = self.create_product(image_file((800, 800)))
+        old = [rendition['webp'] for rendition in product.image_renditions['sizes'].values()]
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image.save('other.png', image_file((600, 300)))
+        product.refresh_from_db()
+        self.assertEqual(product.image_width, 600)
+        self.assertFalse(any(default_storage.exists(path) for path in old))
+
+        # a product saved without touching the image queues nothing
+        with mock.patch('api.images.schedule_renditions') as schedule:
+            Product.objects.get(pk=product.pk).save()
+        schedule.assert_not_called()
+
+    def test_api_and_templates_link_renditions(self):
+        product = self.create_product(image_file((1200, 600)))
+        images = self.client.get(f'/api/products/{product.pk}/').json()['images']
+        self.assertEqual(set(images), {'thumbnail', 'card', 'full'})
+        self.assertTrue(images['card']['webp'].startswith('/media/products/renditions/'))
+        self.assertEqual(self.client.get('/api/products/').json()['results'][0]['images'], images)
+        self.assertEqual(
+            product_rows(product_values(Product.objects.all())),
+            ProductSerializer(Product.objects.all(), many=True).data,
+        )
+
+        html = self.client.get('/products/').content.decode()
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn(f'{images["card"]["jpeg"]}', html)
+        self.assertIn(f'{images["thumbnail"]["webp"]} 160w', html)
+
+    def test_regenerate_images_command(self):
+        product = self.create_product(image_file((900, 300)))
+        Product.objects.filter(pk=product.pk).update(image_renditions={})
+
+        call_command('regenerate_images', '--stale', '--workers=1', stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.image_renditions['sizes']['card']['width'], 480)
+
+        out = StringIO()
+        call_command('regenerate_images', '--stale', '--workers=1', stdout=out)
+        self.assertIn('0 images', out.getvalue())
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    # served by ImageMirrorTestCase, /slow/<name> answers after a pause
+    images = {}
+    requests = []
+    in_flight = max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        handler = type(self)
+        with handler.lock:
+            handler.requests.append((self.path, dict(self.headers)))
+            handler.in_flight += 1
+            handler.max_in_flight = max(handler.max_in_flight, handler.in_flight)
+        try:
+            name = self.path.removeprefix('/slow')
+            if name != self.path:
+                time.sleep(0.1)
+            content = handler.images.get(name)
+            if content is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            etag = f'"{hashlib.md5(content).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        finally:
+            with handler.lock:
+                handler.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(CACHES=LOCMEM_CACHE, EXTERNAL_IMAGE_MIRROR={'WORKERS': 0})
+class ImageMirrorTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        cache.clear()
+        product_cache.clear_local()
+
+        png = image_file((40, 30)).read()
+        StubImageHandler.images = {'/a.png': png, '/copy-of-a.png': png, '/page.html': b'<html></html>'}
+        StubImageHandler.requests = []
+        StubImageHandler.max_in_flight = 0
+
+    def product(self, path):
+        # bulk_create, no background fetch, the command is what's under test
+        return Product.objects.bulk_create([
+            Product(name=path, description='', price=Decimal('1'), stock=1, external_image_url=self.base_url + path),
+        ])[0]
+
+    def mirror(self, *args):
+        out = StringIO()
+        call_command('mirror_images', *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_mirrors_and_deduplicates(self):
+        a, copy, missing, page = (self.product(path) for path in ('/a.png', '/copy-of-a.png', '/missing.png', '/page.html'))
+        self.assertIn('2 fetched, 0 not modified, 2 failed', self.mirror())
+
+        a.refresh_from_db()
+        copy.refresh_from_db()
+        self.assertEqual(a.external_image_status, Product.MirrorStatus.MIRRORED)
+        self.assertIsNotNone(a.external_image_checked_at)
+        self.assertEqual(a.external_image_mirror['path'], copy.external_image_mirror['path'])
+        self.assertTrue(default_storage.exists(a.external_image_mirror['path']))
+
+        missing.refresh_from_db()
+        page.refresh_from_db()
+        self.assertEqual((missing.external_image_status, missing.external_image_mirror['error']), ('failed', 'HTTP 404'))
+        self.assertEqual(page.external_image_mirror['error'], 'not an image')
+
+        # the API prefers the local copy, failed ones keep the external url
+        data = {row['name']: row['external_image_url'] for row in self.client.get('/api/products/').json()['results']}
+        self.assertEqual(data['/a.png'], f'/media/{a.external_image_mirror["path"]}')
+        self.assertEqual(data['/missing.png'], self.base_url + '/missing.png')
+        self.assertEqual(self.client.get(f'/api/products/{a.pk}/').json()['external_image_url'], data['/a.png'])
+
+    def test_revalidates_with_etag(self):
+        product = self.product('/a.png')
+        self.mirror()
+        product.refresh_from_db()
+        path, updated_at = product.external_image_mirror['path'], product.updated_at
+
+        # recent copies are left alone until they are older than --max-age
+        self.assertIn('0 fetched, 0 not modified, 0 failed', self.mirror())
+        self.assertIn('0 fetched, 1 not modified', self.mirror('--max-age=0'))
+        self.assertEqual(StubImageHandler.requests[-1][1]['If-None-Match'], product.external_image_mirror['etag'])
+        product.refresh_from_db()
+        self.assertEqual((product.external_image_mirror['path'], product.updated_at), (path, updated_at))
+
+        # the last copy is still served when the origin goes away
+        del StubImageHandler.images['/a.png']
+        self.mirror('--max-age=0')
+        product.refresh_from_db()
+        self.assertEqual(product.external_image_status, Product.MirrorStatus.FAILED)
+        self.assertEqual(ProductSerializer(product).data['external_image_url'], f'/media/{path}')
+
+    def test_concurrency_limit(self):
+        for i in range(6):
+            StubImageHandler.images[f'/{i}.png'] = image_file((10 + i, 10)).read()
+            self.product(f'/slow/{i}.png')
+        self.assertIn('6 fetched', self.mirror('--concurrency=2'))
+        self.assertEqual(StubImageHandler.max_in_flight, 2)
+
+    def test_background_fetch_on_save(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name='x', description='', price=Decimal('1'), stock=1,
+                                             external_image_url=self.base_url + '/a.png')
+        product.refresh_from_db()
+        self.assertEqual(product.external_image_status, Product.MirrorStatus.MIRRORED)
+
+        product.external_image_url = self.base_url + '/missing.png'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.external_image_status, Product.MirrorStatus.FAILED)
+        self.assertEqual(ProductSerializer(product).data['external_image_url'], self.base_url + '/missing.png')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute', 'test': '10/minute'})
+class SlidingWindowThrottleTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = 6000.0
+        self.view = mock.Mock(throttle_scope='test')
+        self.request = mock.Mock(user=mock.Mock(is_authenticated=True, pk=1))
+
+    def requests(self, count):
+        allowed, throttle = 0, None
+        for _ in range(count):
+            throttle = ScopedSlidingWindowThrottle()
+            throttle.timer = lambda: self.now
+            allowed += throttle.allow_request(self.request, self.view)
+        return allowed, throttle
+
+    def test_limit_and_wait(self):
+        allowed, throttle = self.requests(15)
+        self.assertEqual(allowed, 10)
+        # the rest of this window, then until the 10 requests weigh 9
+        self.assertEqual(throttle.wait(), 66)
+
+    def test_previous_window_is_weighted(self):
+        self.requests(15)
+        # halfway through the next window, half of the previous one still counts, denied requests don't
+        self.now += 90
+        allowed, throttle = self.requests(10)
+        self.assertEqual(allowed, 5)
+        self.assertGreater(throttle.wait(), 0)
+        self.now += 120
+        self.assertEqual(self.requests(15)[0], 10)
+
+    async def test_async_requests_share_the_counters(self):
+        allowed = 0
+        for _ in range(8):
+            throttle = ScopedSlidingWindowThrottle()
+            throttle.timer = lambda: self.now
+            allowed += await throttle.aallow_request(self.request, self.view)
+        self.assertEqual(allowed, 8)
+        self.assertEqual((await sync_to_async(self.requests)(7))[0], 2)
+
+    def test_falls_back_to_local_counters(self):
+        broken = mock.Mock(get=mock.Mock(side_effect=ConnectionError), incr=mock.Mock(side_effect=ConnectionError))
+        with mock.patch.object(SlidingWindowRateThrottle, 'cache', broken), \
+                mock.patch('api.throttles.local_counters', LocalCounters()):
+            self.assertEqual(self.requests(15)[0], 10)
+
+    @mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '2/minute'})
+    def test_orders_scope(self):
+        self.client.force_login(User.objects.create_user(username='buyer', password='test'))
+        self.assertEqual(self.client.get('/orders/').status_code, 200)
+        self.assertEqual(self.client.get('/orders/').status_code, 200)
+        response = self.client.get('/orders/')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class CachedJWTAuthenticationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='test')
+        Order.objects.create(user=self.user)
+        token = ClaimsTokenObtainPairSerializer.get_token(self.user).access_token
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    def user_queries(self, method='get'):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)('/orders/', headers=self.headers)
+        # not the EXPLAINs of the query budget checks or silk's copies
+        return response, [q['sql'] for q in queries if q['sql'].startswith('SELECT "api_user"')]
+
+    def test_user_is_cached(self):
+        response, queries = self.user_queries()
+        self.assertEqual((response.status_code, len(queries)), (200, 1))
+        response, queries = self.user_queries()
+        self.assertEqual((response.status_code, len(queries)), (200, 0))
+
+    def test_cache_holds_no_password_hash(self):
+        self.user_queries()
+        entry = cache.get(f'jwt_user:{self.user.pk}')
+        self.assertEqual(entry['fields'], {
+            'pk': self.user.pk, 'username': 'buyer', 'is_active': True, 'is_staff': False, 'is_superuser': False,
+        })
+        self.assertNotIn(self.user.password, str(entry))
+        # the cached user is what the view sees
+        self.assertEqual(len(self.user_queries()[0].json()), 1)
+
+    def test_entries_missing_a_field_are_loaded_again(self):
+        self.user_queries()
+        # cached before is_superuser was added to CACHED_FIELDS
+        entry = cache.get(f'jwt_user:{self.user.pk}')
+        del entry['fields']['is_superuser']
+        cache.set(f'jwt_user:{self.user.pk}', entry)
+        self.assertEqual(len(self.user_queries()[1]), 1)
+        self.assertIn('is_superuser', cache.get(f'jwt_user:{self.user.pk}')['fields'])
+
+    def test_deactivation_and_password_change_invalidate(self):
+        self.user_queries()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password('changed')
+            self.user.save()
+        self.assertEqual(len(self.user_queries()[1]), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.user_queries()[0].status_code, 401)
+
+    @override_settings(JWT_USER_CACHE={'TRUST_TOKEN_CLAIMS': True})
+    def test_read_only_requests_trust_claims(self):
+        response, queries = self.user_queries()
+        self.assertEqual((response.status_code, len(response.json()), len(queries)), (200, 1, 0))
+        # writes still load the user
+        self.assertEqual(len(self.user_queries('post')[1]), 1)
+
+    def test_refreshed_tokens_carry_current_claims(self):
+        self.user.is_staff = True
+        self.user.save()
+        refresh = ClaimsTokenObtainPairSerializer.get_token(self.user)
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.post('/api/token/refresh/', {'refresh': str(refresh)}, content_type='application/json')
+        self.assertIs(AccessToken(response.json()['access'])['is_staff'], False)
+
+    @override_settings(JWT_USER_CACHE={'TRUST_TOKEN_CLAIMS': True})
+    async def test_async_views(self):
+        response = await AsyncClient().get('/orders/', headers=self.headers)
+        self.assertEqual((response.status_code, len(response.json())), (200, 1))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'api.metrics.LocMemCache'}})
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+
+    def test_requests_queries_and_cache_lookups(self):
+        self.client.get('/api/products/')
+        self.client.get('/api/products/')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('http_requests_total{view="api/products/",method="GET",status="200"} 2\n', body)
+        self.assertIn('http_request_duration_seconds_count{view="api/products/",method="GET"} 2\n', body)
+        self.assertIn('http_request_duration_seconds_bucket{view="api/products/",method="GET",le="+Inf"} 2\n', body)
+        self.assertRegex(body, r'db_queries_total\{view="api/products/"\} [1-9]')
+        self.assertRegex(body, r'cache_lookups_total\{result="hit"\} [1-9]')
+
+    async def test_async_requests_count_queries(self):
+        product = await Product.objects.afirst()
+        response = await AsyncClient().get(f'/api/products/{product.pk}/')
+        self.assertEqual(response.status_code, 200)
+        # run in sync_to_async's thread, not on the event loop
+        queries = {labels: value for (name, labels), value in metrics.snapshot().items() if name == 'db_queries_total'}
+        self.assertGreater(sum(queries.values()), 0)
+
+    def test_workers_are_added_up(self):
+        labels = (('view', 'x'), ('method', 'GET'), ('status', '200'))
+        metrics.inc('http_requests_total', labels, 2)
+        metrics.flush()
+        other = Metrics()
+        other.inc('http_requests_total', labels, 3)
+        other.flush()
+        self.assertEqual(collect()['http_requests_total', labels], 5)
+
+    @override_settings(METRICS={'FLUSH_INTERVAL': 0.1})
+    def test_slots_expire_and_are_reused(self):
+        labels = (('view', 'x'), ('method', 'GET'), ('status', '200'))
+        exited = Metrics()
+        exited.inc('http_requests_total', labels, 2)
+        exited.flush()
+        time.sleep(0.4)
+        self.assertEqual(collect(), {})
+        worker = Metrics()
+        worker.inc('http_requests_total', labels, 3)
+        worker.flush()
+        self.assertEqual((worker._slot, collect()['http_requests_total', labels]), (exited._slot, 3))
+
+    def test_requests_leave_the_flush_to_the_thread(self):
+        worker = Metrics()
+        # off for the test suite
+        worker.maybe_flush()
+        self.assertIsNone(worker._flusher)
+
+        with override_settings(METRICS={'FLUSH_THREAD': True}), \
+                mock.patch.object(Metrics, '_flush_forever') as flush_forever, \
+                mock.patch.object(Metrics, 'flush') as flush:
+            worker.maybe_flush()
+            worker._flusher.join()
+        flush_forever.assert_called_once_with()
+        flush.assert_not_called()
+
+    def test_concurrent_flushes_claim_one_slot(self):
+        worker = Metrics()
+        worker.inc('http_requests_total', (('view', 'x'),))
+        barrier = threading.Barrier(8)
+
+        def flush():
+            barrier.wait()
+            worker.flush()
+        threads = [threading.Thread(target=flush) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((worker._slot, cache.get('metrics:slots')), (1, 1))
+
+    @override_settings(METRICS={'TOKEN': 'secret'})
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+    def test_silk_profile_finds_the_middleware(self):
+        self.assertTrue(silk_profile()._silk_installed())
+
+    def test_silk_sampling(self):
+        user = User.objects.create_user(username='buyer', password='test')
+        token = ClaimsTokenObtainPairSerializer.get_token(user).access_token
+        with override_settings(SILK_SAMPLING={'RATE': 0}):
+            self.client.get('/api/products/')
+            self.assertEqual(SilkRequest.objects.count(), 0)
+        with override_settings(SILK_SAMPLING={'RATE': 0, 'PATHS': ['/api/products/']}):
+            self.client.get('/api/products/')
+            self.assertEqual(SilkRequest.objects.count(), 1)
+        with override_settings(SILK_SAMPLING={'RATE': 0, 'USER_IDS': [user.pk]}):
+            self.client.get('/orders/', headers={'Authorization': f'Bearer {token}'})
+            self.client.get('/orders/')
+            self.assertEqual(list(SilkRequest.objects.values_list('path', flat=True).order_by('start_time')),
+                             ['/api/products/', '/orders/'])
+
+    async def test_silk_sampling_under_asgi(self):
+        user = await sync_to_async(User.objects.create_user)(username='buyer', password='test')
+        token = ClaimsTokenObtainPairSerializer.get_token(user).access_token
+        with override_settings(SILK_SAMPLING={'RATE': 0, 'PATHS': ['/api/products/'], 'USER_IDS': [user.pk]}):
+            client = AsyncClient()
+            await client.get('/api/products/')
+            await client.get('/orders/', headers={'Authorization': f'Bearer {token}'})
+            await client.get('/orders/')
+        captured = [request async for request in SilkRequest.objects.order_by('start_time')]
+        self.assertEqual([request.path for request in captured], ['/api/products/', '/orders/'])
+        # the async view's queries ran in silk's thread
+        self.assertGreater(captured[0].num_sql_queries, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, DATABASE_ROUTING={'REPLICAS': {'replica': 1}, 'REPLICA_LAG': 0.05})
+@mock.patch.dict(ScopedRateThrottle.THROTTLE_RATES, {'orders': '1000/minute'})
+class ReplicaRoutingTestCase(TestCase):
+    # the test databases are separate, a row only on one of them shows where a read went
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Pen', description='desc', price=Decimal('1.00'), stock=5)
+        self.user = User.objects.create_user(username='buyer', password='test')
+        self.user.save(using='replica')
+
+    def test_reads_come_from_the_replica(self):
+        Product.objects.using('replica').create(
+            pk=self.product.pk, name='Replica', description='desc', price=Decimal('1.00'), stock=5)
+        names = [product['name'] for product in self.client.get('/api/products/').json()['results']]
+        self.assertEqual(names, ['Replica'])
+        self.assertEqual(self.client.get(f'/api/products/{self.product.pk}/').json()['name'], 'Replica')
+
+    def test_reads_after_a_write_come_from_the_primary(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/orders/').json(), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/orders/', {'items': [{'product': self.product.pk, 'quantity': 2}]},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.client.get('/orders/').json()), 1)
+
+    async def test_async_requests_are_routed_on_the_event_loop(self):
+        async def get_response(request):
+            pass
+        # a sync process_view would be run in a thread
+        self.assertTrue(iscoroutinefunction(DatabaseRoutingMiddleware(get_response).process_view))
+        await Product.objects.using('replica').acreate(
+            pk=self.product.pk, name='Replica', description='desc', price=Decimal('1.00'), stock=5)
+        response = await AsyncClient().get('/api/products/')
+        self.assertEqual([product['name'] for product in response.json()['results']], ['Replica'])
+
+    def test_weighted_round_robin(self):
+        replicas = WeightedRoundRobin()
+        self.assertEqual([replicas.choose({'a': 2, 'b': 1}) for _ in range(6)], ['a', 'b', 'a', 'a', 'b', 'a'])
+
+    def test_invalidated_again_after_the_replica_lag(self):
+        generation = get_generation(PRODUCT_LIST_NAMESPACE)
+        bump_generation(PRODUCT_LIST_NAMESPACE)
+        self.assertEqual(get_generation(PRODUCT_LIST_NAMESPACE), generation + 1)
+        time.sleep(0.3)
+        self.assertEqual(get_generation(PRODUCT_LIST_NAMESPACE), generation + 2)
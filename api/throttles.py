@@ -1,9 +1,180 @@
-from rest_framework.throttling import UserRateThrottle
+"""
+Throttles with O(1) state per client.
 
+DRF's SimpleRateThrottle keeps the timestamp of every request in the window in
+one cache entry and rewrites it on each request, so its cost grows with the
+rate, and two workers reading the same list lose each other's write. These
+count requests per fixed window with an atomic cache.incr(), and weight the
+previous window by how much of it the sliding window still covers.
+"""
+import threading
 
-class BurstRateThrottle(UserRateThrottle):
+from django.core.cache import cache as default_cache
+from rest_framework.throttling import AnonRateThrottle, ScopedRateThrottle, SimpleRateThrottle, UserRateThrottle
+
+# local counters kept before expired ones are swept
+LOCAL_MAX_KEYS = 10000
+
+
+class LocalCounters:
+    """
+    Per-process window counters, used while the shared cache can't be reached.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            count, expires = self._counts.get(key, (0, 0))
+            return count if expires > now else 0
+
+    def incr(self, key, delta, timeout, now):
+        with self._lock:
+            count, expires = self._counts.get(key, (0, 0))
+            if expires <= now:
+                count, expires = 0, now + timeout
+            self._counts[key] = (count + delta, expires)
+            if len(self._counts) > LOCAL_MAX_KEYS:
+                self._counts = {k: v for k, v in self._counts.items() if v[1] > now}
+            return count + delta
+
+
+local_counters = LocalCounters()
+
+
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    """
+    SimpleRateThrottle with a sliding-window counter instead of a request history.
+
+    Two integers per client, the current and the previous window's count, read
+    and bumped with one get and one incr. A request counts once its incr()
+    result, taken with the weighted previous window, is within the rate, so
+    concurrent workers can't admit more than the rate between them. Denied
+    requests are taken back and don't count, as with DRF.
+
+    aallow_request() is the same with the async cache API, for the async views.
+    """
+    cache = default_cache
+
+    def allow_request(self, request, view):
+        keys = self._window_keys(request, view)
+        if keys is None:
+            return True
+        current_key, previous_key = keys
+
+        try:
+            self.previous = self.cache.get(previous_key, 0)
+            self.current = self._incr(current_key, 1)
+            over = self._weighted() > self.num_requests
+            if over:
+                self.current = self._incr(current_key, -1)
+        except Exception:
+            over = self._count_locally(current_key, previous_key)
+
+        return self.throttle_failure() if over else self.throttle_success()
+
+    async def aallow_request(self, request, view):
+        keys = self._window_keys(request, view)
+        if keys is None:
+            return True
+        current_key, previous_key = keys
+
+        try:
+            self.previous = await self.cache.aget(previous_key, 0)
+            self.current = await self._aincr(current_key, 1)
+            over = self._weighted() > self.num_requests
+            if over:
+                self.current = await self._aincr(current_key, -1)
+        except Exception:
+            over = self._count_locally(current_key, previous_key)
+
+        return self.throttle_failure() if over else self.throttle_success()
+
+    def _window_keys(self, request, view):
+        # (current, previous) window keys, None when the request isn't throttled
+        if self.rate is None:
+            return None
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return None
+
+        self.now = self.timer()
+        window, offset = divmod(self.now, self.duration)
+        self.fraction = offset / self.duration
+        return f'{self.key}:{int(window)}', f'{self.key}:{int(window) - 1}'
+
+    def _count_locally(self, current_key, previous_key):
+        # any backend's connection error, throttle per process rather than not at all
+        self.previous = local_counters.get(previous_key, self.now)
+        self.current = local_counters.incr(current_key, 1, self.duration * 2, self.now)
+        over = self._weighted() > self.num_requests
+        if over:
+            self.current = local_counters.incr(current_key, -1, self.duration * 2, self.now)
+        return over
+
+    def _weighted(self):
+        return self.previous * (1 - self.fraction) + self.current
+
+    def _incr(self, key, delta):
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            # first request of the window, it is read as the previous one for a window more
+            if self.cache.add(key, delta, self.duration * 2):
+                return delta
+            return self.cache.incr(key, delta)
+
+    async def _aincr(self, key, delta):
+        try:
+            return await self.cache.aincr(key, delta)
+        except ValueError:
+            if await self.cache.aadd(key, delta, self.duration * 2):
+                return delta
+            return await self.cache.aincr(key, delta)
+
+    def throttle_success(self):
+        return True
+
+    def wait(self):
+        """
+        Seconds until the weighted count leaves room for one more request.
+        """
+        left_in_window = (1 - self.fraction) * self.duration
+        # inside this window the previous one's weight shrinks linearly
+        excess = self._weighted() + 1 - self.num_requests
+        if self.previous and excess <= self.previous * (1 - self.fraction):
+            return excess / self.previous * self.duration
+        # in the next one this window is the previous, with no requests of its own yet
+        if self.current and self.num_requests:
+            return left_in_window + max(0, 1 - (self.num_requests - 1) / self.current) * self.duration
+        return left_in_window
+
+
+class AnonSlidingWindowThrottle(AnonRateThrottle, SlidingWindowRateThrottle):
+    pass
+
+
+class UserSlidingWindowThrottle(UserRateThrottle, SlidingWindowRateThrottle):
+    pass
+
+
+class ScopedSlidingWindowThrottle(ScopedRateThrottle, SlidingWindowRateThrottle):
+    async def aallow_request(self, request, view):
+        # what ScopedRateThrottle.allow_request() does first, the rate comes from the view's scope
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return True
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return await super().aallow_request(request, view)
+
+
+class BurstRateThrottle(UserSlidingWindowThrottle):
     scope = 'burst'
 
 
-class SustainedRateThrottle(UserRateThrottle):
+class SustainedRateThrottle(UserSlidingWindowThrottle):
     scope = 'sustained'
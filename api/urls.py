@@ -1,6 +1,6 @@
 from django.urls import path
 
-from .views import products_views, users, order_views
+from .views import metrics_views, products_views, users, order_views
 
 from rest_framework.routers import DefaultRouter
 
@@ -15,6 +15,9 @@ urlpatterns = [
     path('products/', products_views.ProductListViewHTML.as_view(), name='product_list'),
     path('products/<int:product_id>/', products_views.ProductDetailViewHTML.as_view(), name='product_detail'),
     path('products/info/', products_views.ProductInfoAPIView.as_view()),
+
+    # Prometheus scrape target, the counters of every worker
+    path('metrics', metrics_views.prometheus_metrics),
 ]
 
 router = DefaultRouter()
@@ -0,0 +1,269 @@
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.request import Request
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from api import search
+from api.authentication import CachedJWTAuthentication, trusts_claims
+from api.caching import (ORDER_LIST_CACHE_TIMEOUT, PRODUCT_LIST_CACHE_TIMEOUT, PRODUCT_LIST_NAMESPACE,
+                         aget_catalog_stats, aget_order_list_version, aget_version,
+                         aorder_list_cache_key, order_list_namespace, product_cache)
+from api.fast_serializers import aorder_rows, product_rows, product_values
+from api.filter import OrderFilter
+from api.models import Order, Product
+from api.pagination import KeysetPagination
+from api.renderers import MessagePackRenderer, ORJSONRenderer
+from api.serializers import OrderSerializer, ProductInfoSerializer, ProductSerializer
+from api.throttles import AnonSlidingWindowThrottle
+from api.views.order_views import OrderViewSets
+from api.views.products_views import ProductDetailAPIView, ProductInfoAPIView, ProductListCreateAPIView
+
+
+class AsyncReadView(View):
+    """
+    Async GET handler for one of the DRF endpoints, served under ASGI.
+
+    GETs run on the event loop with the async ORM and cache, and render the same
+    bytes as the DRF view, in the format the Accept header or ?format= picks.
+    Every other method is handed to `fallback_view`, the regular DRF view, in a
+    worker thread. Subclasses implement an async `get`.
+    """
+    fallback_view = None
+    throttle_classes = [AnonSlidingWindowThrottle]
+    renderer_classes = [ORJSONRenderer, MessagePackRenderer]
+    throttle_scope = None
+    authentication_required = False
+    read_from_replica = True
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # same as the DRF views, JWT clients send no CSRF token
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await sync_to_async(self.fallback_view)(request, *args, **kwargs)
+
+        # errors, a 406 included, are rendered with the first renderer like in DRF
+        self.renderer = self.renderer_classes[0]()
+        try:
+            self.renderer = self.perform_content_negotiation(request)
+            request.user = await self.authenticate(request)
+            if self.authentication_required and not request.user.is_authenticated:
+                raise exceptions.NotAuthenticated()
+            await self.check_throttles(request)
+            return await self.get(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            return self.handle_exception(exc)
+
+    async def authenticate(self, request):
+        header = request.headers.get('Authorization', '').split()
+        if header and header[0] in jwt_settings.AUTH_HEADER_TYPES:
+            if len(header) != 2:
+                raise exceptions.AuthenticationFailed('Invalid Authorization header.')
+            # token checks are pure CPU, the user comes from the cache or the token's claims
+            authentication = CachedJWTAuthentication()
+            authentication.trust_claims = trusts_claims(request.method)
+            try:
+                token = authentication.get_validated_token(header[1].encode())
+            except InvalidToken as exc:
+                raise exceptions.AuthenticationFailed(exc.detail)
+            return await authentication.aget_user(token)
+        return await request.auser()
+
+    def perform_content_negotiation(self, request):
+        renderer, _ = DefaultContentNegotiation().select_renderer(
+            self.drf_request(request), [renderer_class() for renderer_class in self.renderer_classes],
+        )
+        return renderer
+
+    async def check_throttles(self, request):
+        # the sliding-window throttles talk to the cache without blocking the event loop
+        for throttle_class in self.throttle_classes:
+            throttle = throttle_class()
+            if not await throttle.aallow_request(request, self):
+                raise exceptions.Throttled(throttle.wait())
+
+    def handle_exception(self, exc):
+        response = self.render(exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail},
+                               status=exc.status_code)
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            response['WWW-Authenticate'] = f'{jwt_settings.AUTH_HEADER_TYPES[0]} realm="api"'
+        if getattr(exc, 'wait', None) is not None:
+            response['Retry-After'] = str(int(exc.wait))
+        return response
+
+    def render(self, data, status=200):
+        return self.response(self.renderer.render(data), status=status)
+
+    def response(self, content, status=200):
+        response = HttpResponse(content, status=status, content_type=self.renderer.media_type)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def drf_request(self, request):
+        # filter backends and the paginator only need query_params and the url
+        return Request(request)
+
+
+def _conditional(request, etag, last_modified, response=None):
+    return get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+
+
+def _timestamp(last_modified):
+    return int(last_modified.timestamp()) if last_modified else None
+
+
+class AsyncProductListView(AsyncReadView):
+    fallback_view = staticmethod(ProductListCreateAPIView.as_view())
+
+    async def get(self, request):
+        generation, modified = await aget_version(PRODUCT_LIST_NAMESPACE)
+        etag = f'W/"{PRODUCT_LIST_NAMESPACE}-{generation}"'
+        not_modified = _conditional(request, etag, int(modified))
+        if not_modified is not None:
+            return not_modified
+
+        key = f'{PRODUCT_LIST_NAMESPACE}.{generation}:async:{self.renderer.format}:' + hashlib.md5(
+            request.get_full_path().encode('utf-8')
+        ).hexdigest()
+        content = await cache.aget(key)
+        if content is None:
+            content = await self.get_content(request)
+            await cache.aset(key, content, PRODUCT_LIST_CACHE_TIMEOUT)
+
+        response = self.response(content)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(modified)
+        return response
+
+    async def get_content(self, request):
+        drf_request = self.drf_request(request)
+        view = ProductListCreateAPIView(request=drf_request, format_kwarg=None, kwargs={}, args=())
+
+        if drf_request.query_params.get('search'):
+            # one-off introspection, every later call is answered from memory
+            await sync_to_async(search.is_available)(Product.objects.db)
+
+        queryset = view.get_queryset()
+        for backend in view.filter_backends:
+            queryset = backend().filter_queryset(drf_request, queryset, view)
+
+        paginator = KeysetPagination()
+        page = await paginator.apaginate_queryset(product_values(queryset), drf_request, view)
+        data = paginator.get_paginated_data(product_rows(page))
+        return self.renderer.render(data)
+
+
+class AsyncProductDetailView(AsyncReadView):
+    fallback_view = staticmethod(ProductDetailAPIView.as_view())
+
+    async def get(self, request, product_id):
+        product = await product_cache.aget(product_id)
+        if product is None:
+            raise exceptions.NotFound('No Product matches the given query.')
+
+        etag = f'"product-{product.pk}-{product.updated_at.timestamp()}"'
+        not_modified = _conditional(request, etag, _timestamp(product.updated_at))
+        if not_modified is not None:
+            return not_modified
+
+        response = self.render(ProductSerializer(product).data)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(product.updated_at.timestamp())
+        return response
+
+
+class AsyncProductInfoView(AsyncReadView):
+    fallback_view = staticmethod(ProductInfoAPIView.as_view())
+
+    async def get(self, request):
+        data = dict(await aget_catalog_stats())
+
+        drf_request = self.drf_request(request)
+        include_products = drf_request.query_params.get('include_products', 'true').lower()
+        if include_products not in ('0', 'false', 'no'):
+            products = Product.objects.order_by('pk')
+            paginator = KeysetPagination()
+            if {paginator.cursor_query_param, paginator.page_size_query_param} & set(drf_request.query_params):
+                data['products'] = await paginator.apaginate_queryset(products, drf_request, view=self)
+                data['next'] = paginator.get_next_link()
+                data['previous'] = paginator.get_previous_link()
+            else:
+                data['products'] = [product async for product in products]
+
+        return self.render(ProductInfoSerializer(data).data)
+
+
+class AsyncOrderListView(AsyncReadView):
+    fallback_view = staticmethod(OrderViewSets.as_view({'get': 'list', 'post': 'create'}))
+    throttle_classes = OrderViewSets.throttle_classes
+    throttle_scope = OrderViewSets.throttle_scope
+    authentication_required = True
+
+    def get_queryset(self, request):
+        queryset = Order.objects.with_totals()
+        if not request.user.is_staff:
+            queryset = queryset.filter(user=request.user)
+        return queryset
+
+    async def get(self, request):
+        drf_request = self.drf_request(request)
+        drf_request.user = request.user
+
+        generation, modified = await aget_order_list_version(request.user)
+        etag = f'W/"{order_list_namespace(request.user)}-{generation}"'
+        not_modified = _conditional(request, etag, int(modified))
+        if not_modified is not None:
+            return not_modified
+
+        # same entries as the sync OrderViewSets.list
+        key = await aorder_list_cache_key(drf_request)
+        data = await cache.aget(key)
+        if data is None:
+            filterset = OrderFilter(drf_request.query_params, queryset=self.get_queryset(request), request=drf_request)
+            if not filterset.is_valid():
+                raise exceptions.ValidationError(filterset.errors)
+            data = await aorder_rows(filterset.qs)
+            await cache.aset(key, data, ORDER_LIST_CACHE_TIMEOUT)
+
+        response = self.render(data)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(modified)
+        return response
+
+
+class AsyncOrderDetailView(AsyncOrderListView):
+    fallback_view = staticmethod(OrderViewSets.as_view({
+        'get': 'retrieve',
+        'put': 'update',
+        'patch': 'partial_update',
+        'delete': 'destroy',
+    }))
+
+    async def get(self, request, pk):
+        try:
+            order = await self.get_queryset(request).aget(pk=pk)
+        except (Order.DoesNotExist, DjangoValidationError):
+            raise exceptions.NotFound('No Order matches the given query.')
+
+        etag = f'"order-{order.pk}-{order.updated_at.timestamp()}"'
+        not_modified = _conditional(request, etag, _timestamp(order.updated_at))
+        if not_modified is not None:
+            return not_modified
+
+        response = self.render(OrderSerializer(order).data)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(order.updated_at.timestamp())
+        return response
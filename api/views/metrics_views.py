@@ -0,0 +1,18 @@
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+
+from api.metrics import collect, get_options, metrics, render
+
+# the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@require_GET
+def prometheus_metrics(request):
+    token = get_options()['TOKEN']
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('Invalid token.', status=401, content_type='text/plain')
+    # this worker's counters as they are now, the others' as of their last flush
+    metrics.flush()
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
@@ -1,37 +1,80 @@
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
 from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
-from django.views.decorators.vary import vary_on_headers
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from api.caching import ORDER_LIST_CACHE_TIMEOUT, order_list_cache_key
+from api.conditional import order_condition, order_list_condition
+from api.export import EXPORT_FORMATS
+from api.fast_serializers import order_rows
 from api.filter import OrderFilter
 from api.models import Order
 from api.serializers import (OrderCreateSerializer, OrderSerializer)
-from rest_framework.throttling import ScopedRateThrottle
+from api.stock import delete_order
+from api.throttles import ScopedSlidingWindowThrottle
+
+# most orders accepted by a single batch request
+ORDER_BATCH_LIMIT = 1000
 
 
 class OrderViewSets(viewsets.ModelViewSet):
     throttle_scope = 'orders'
-    throttle_classes = [ScopedRateThrottle]
-    queryset = Order.objects.prefetch_related('items__product')
+    throttle_classes = [ScopedSlidingWindowThrottle]
+    # totals and item subtotals are computed in SQL
+    queryset = Order.objects.with_totals()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
     pagination_class = None
     filterset_class = OrderFilter
     filter_backends = [DjangoFilterBackend]
+    # per action, authentication included (api/query_budget.py)
+    query_budget = {
+        'list': 4,
+        'retrieve': 5,
+        'create': 8,
+        'update': 13,
+        'partial_update': 10,
+        'destroy': 11,
+        'export': 4,
+        'batch': 10,
+    }
+    read_from_replica = True
 
-    # cache decorator for api endpoint
-    @method_decorator(cache_page(60 * 15, key_prefix='order_list'))
-    @method_decorator(vary_on_headers('Authorization'))
+    # cached per user and filter set, order writes invalidate only that user's entries
+    @method_decorator(order_list_condition)
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        key = order_list_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        # rows straight from values_list(), same output as OrderSerializer
+        data = order_rows(self.filter_queryset(self.get_queryset()))
+        cache.set(key, data, ORDER_LIST_CACHE_TIMEOUT)
+        return Response(data)
+
+    @method_decorator(order_condition)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer):
+        serializer.save()
+        # DRF drops the prefetched items after a save, read the order back with its
+        # items, products and total rather than one product query per item
+        serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
+    def perform_destroy(self, instance):
+        delete_order(instance)
+
     def get_serializer_class(self):
-        if self.action == 'create' or self.action == 'update':
+        if self.action in ('create', 'update', 'batch'):
             return OrderCreateSerializer
         return super().get_serializer_class()
 
@@ -46,3 +89,25 @@ class OrderViewSets(viewsets.ModelViewSet):
         serializer = self.get_serializer(orders, many=True)
 
         return Response(serializer.data)
+
+    # streams every order the user can see, filters apply, memory stays flat
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request):
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError({'export_format': f'Choose one of: {", ".join(EXPORT_FORMATS)}'})
+
+        stream, content_type = EXPORT_FORMATS[export_format]
+        orders = self.filter_queryset(self.get_queryset()).order_by('created_at', 'pk')
+
+        response = StreamingHttpResponse(stream(orders), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="orders.{export_format}"'
+        return response
+
+    # many orders in one request, validated together and saved with bulk inserts
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        serializer = self.get_serializer(data=request.data, many=True, max_length=ORDER_BATCH_LIMIT)
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -1,15 +1,19 @@
-from django.db.models.aggregates import Max
+from django.http import Http404
 from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters, generics
-from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.permissions import SAFE_METHODS, AllowAny, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from api.filter import InStockFilterBackend, ProductFilter
+from api.caching import (PRODUCT_LIST_CACHE_TIMEOUT, PRODUCT_LIST_NAMESPACE, get_catalog_stats, product_cache,
+                         versioned_cache_page)
+from api.conditional import product_condition, product_list_condition
+from api.fast_serializers import product_rows, product_values
+from api.filter import FullTextSearchFilter, InStockFilterBackend, ProductFilter
 from api.models import Product
+from api.pagination import KeysetPagination
 from api.serializers import (ProductInfoSerializer, ProductSerializer)
 
 
@@ -23,26 +27,29 @@ class ProductListCreateAPIView(generics.ListCreateAPIView):
 
     filter_backends = [
         DjangoFilterBackend,
-        filters.SearchFilter,
+        FullTextSearchFilter,
         filters.OrderingFilter,
         InStockFilterBackend
     ]
 
-    # =name search an exact match of the word
+    # full-text index on SQLite, otherwise =name search an exact match of the word
     search_fields = ["=name", "description"]
     ordering_fields = ["name", "price", "stock"]
-    pagination_class = None
-
-    # cache decorator for api endpoint
-    @method_decorator(cache_page(60 * 15, key_prefix='product_list'))
+    # cursor pagination, deep pages cost the same as the first one
+    pagination_class = KeysetPagination
+    # most SQL queries per request, authentication included (api/query_budget.py)
+    query_budget = {'get': 3, 'post': 4}
+    read_from_replica = True
+
+    # cache decorator for api endpoint, product writes bump the namespace generation
+    # conditional GETs are answered with a 304 before the cache or the query
+    @method_decorator(product_list_condition)
+    @method_decorator(versioned_cache_page(PRODUCT_LIST_CACHE_TIMEOUT, PRODUCT_LIST_NAMESPACE))
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
-
-    #
-    def get_queryset(self):
-        import time
-        time.sleep(2)
-        return super().get_queryset()
+        # rows straight from values(), same output as ProductSerializer
+        queryset = product_values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(product_rows(page))
 
     def get_permissions(self):
         self.permission_classes = [AllowAny]
@@ -56,6 +63,8 @@ class ProductListViewHTML(ListView):
     model = Product
     template_name = 'products/product_list.html'
     context_object_name = 'products'
+    query_budget = 2
+    read_from_replica = True
 
     ordering = ['pk']
 
@@ -69,6 +78,22 @@ class ProductDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Product.objects
     serializer_class = ProductSerializer
     lookup_url_kwarg = 'product_id'
+    query_budget = {'get': 3, 'put': 4, 'patch': 4, 'delete': 5}
+    read_from_replica = True
+
+    # reads come from the two-tier product cache, writes load the row from the database
+    def get_object(self):
+        if self.request.method not in SAFE_METHODS:
+            return super().get_object()
+        product = product_cache.get(self.kwargs[self.lookup_url_kwarg])
+        if product is None:
+            raise Http404
+        self.check_object_permissions(self.request, product)
+        return product
+
+    @method_decorator(product_condition)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def get_permissions(self):
         self.permission_classes = [AllowAny]
@@ -82,15 +107,36 @@ class ProductDetailViewHTML(DetailView):
     pk_url_kwarg = 'product_id'
     template_name = 'products/product_detail.html'
     context_object_name = 'product'
+    query_budget = 2
+    read_from_replica = True
+
+    def get_object(self, queryset=None):
+        product = product_cache.get(self.kwargs[self.pk_url_kwarg])
+        if product is None:
+            raise Http404
+        return product
 
 
 class ProductInfoAPIView(APIView):
+    # ?include_products=false for the summary only, ?page_size= / ?cursor= to page the products
+    pagination_class = KeysetPagination
+    query_budget = 4
+    read_from_replica = True
+
     def get(self, request):
-        products = Product.objects.all()
-        serializer = ProductInfoSerializer({
-            'products': products,
-            'count': len(products),
-            'max_price': products.aggregate(max_price=Max('price'))['max_price'],
-        })
+        data = dict(get_catalog_stats())
+
+        include_products = request.query_params.get('include_products', 'true').lower()
+        if include_products not in ('0', 'false', 'no'):
+            products = Product.objects.order_by('pk')
+            paginator = self.pagination_class()
+            if {paginator.cursor_query_param, paginator.page_size_query_param} & set(request.query_params):
+                data['products'] = paginator.paginate_queryset(products, request, view=self)
+                data['next'] = paginator.get_next_link()
+                data['previous'] = paginator.get_previous_link()
+            else:
+                data['products'] = products
+
+        serializer = ProductInfoSerializer(data)
 
         return Response(serializer.data)
@@ -1,18 +1,74 @@
+from functools import cached_property
+
+from django.db.models import Count, OuterRef, Prefetch, Subquery, Value
 from django.db.models.aggregates import Max
+from django.db.models.functions import Coalesce
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
 from django.views.decorators.vary import vary_on_headers
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters, generics, viewsets
 from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from api.filter import InStockFilterBackend, OrderFilter, ProductFilter
 from api.models import Order, Product, User
+from api.pagination import KeysetPagination
 from api.serializers import (OrderCreateSerializer, OrderSerializer,
                              ProductInfoSerializer, ProductSerializer,
                              UserSerializer)
+# user columns each UserSerializer field reads
+USER_FIELD_COLUMNS = {
+    'email': ('email',),
+    'username': ('username',),
+    'get_full_name': ('first_name', 'last_name'),
+    'orders': (),
+    'order_count': (),
+}
+
+
 class UserListView(generics.ListAPIView):
-    queryset = User.objects.all()
+    """
+    Users in pk order, a page at a time.
+
+    ?fields=username,order_count serializes only those fields, and only loads the
+    columns and order data they need.
+    """
     serializer_class = UserSerializer
-    pagination_class = None
\ No newline at end of file
+    # cursor pagination, ?page_size= / ?cursor=
+    pagination_class = KeysetPagination
+    query_budget = 4
+
+    @cached_property
+    def selected_fields(self):
+        value = self.request.query_params.get('fields')
+        if not value:
+            return list(USER_FIELD_COLUMNS)
+        fields = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in USER_FIELD_COLUMNS]
+        if unknown:
+            raise ValidationError({'fields': [f'Unknown fields: {", ".join(unknown)}']})
+        return fields
+
+    def get_queryset(self):
+        fields = self.selected_fields
+        columns = {column for name in fields for column in USER_FIELD_COLUMNS[name]}
+        queryset = User.objects.only('pk', *columns).order_by('pk')
+        if 'orders' in fields:
+            # one query for the order ids of the whole page
+            queryset = queryset.prefetch_related(Prefetch('orders', queryset=Order.objects.only('pk', 'user')))
+        if 'order_count' in fields:
+            # a correlated count, only evaluated for the rows of the page
+            order_count = (
+                Order.objects.filter(user=OuterRef('pk'))
+                .values('user')
+                .annotate(count=Count('pk'))
+                .values('count')
+            )
+            queryset = queryset.annotate(order_count=Coalesce(Subquery(order_count), Value(0)))
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.selected_fields)
+        return super().get_serializer(*args, **kwargs)
@@ -0,0 +1,14 @@
+from django.urls import path
+
+from api.views import async_views
+from config.urls import urlpatterns as sync_urlpatterns
+
+# under ASGI the read-heavy endpoints are async views, writes fall through to DRF
+urlpatterns = [
+    path('api/products/', async_views.AsyncProductListView.as_view()),
+    path('api/products/info/', async_views.AsyncProductInfoView.as_view()),
+    path('api/products/<int:product_id>/', async_views.AsyncProductDetailView.as_view()),
+    path('products/info/', async_views.AsyncProductInfoView.as_view()),
+    path('orders/', async_views.AsyncOrderListView.as_view()),
+    path('orders/<uuid:pk>/', async_views.AsyncOrderDetailView.as_view()),
+] + sync_urlpatterns
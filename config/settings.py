@@ -1,3 +1,4 @@
+import sys
 from datetime import timedelta
 from pathlib import Path
 
@@ -7,11 +8,15 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'django-insecure--s+9^x!iboa!n^p(9s=j)6*mc2&+ae==ekh4r7-k()qm$st4y('
 
-MEDIA_URL = '/products/'
-MEDIA_ROOT = BASE_DIR / 'products'
+# '/products/' is taken by the HTML product pages, uploads live in media/products/
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# `manage.py test`
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = []
 
 # Application definition
@@ -32,17 +37,27 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so the latency it records is the whole chain's
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'api.middleware.ASGIURLConfMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'silk.middleware.SilkyMiddleware',
+    # after authentication, a user's own writes keep their reads on the primary
+    'api.middleware.DatabaseRoutingMiddleware',
+    # silk for a sample of the requests (SILK_SAMPLING), under ASGI only the sampled ones
+    # leave the event loop
+    'api.middleware.SilkyMiddleware',
+    'api.middleware.QueryBudgetMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
+# async read views in front of config.urls, used for requests served by config.asgi
+ASGI_ROOT_URLCONF = 'config.asgi_urls'
 
 TEMPLATES = [
     {
@@ -68,7 +83,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {
+            # WAL lets reads run next to a write, IMMEDIATE takes the write lock at BEGIN
+            # so concurrent stock reservations wait their turn instead of failing
+            'init_command': 'PRAGMA journal_mode=WAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    },
+    # a stand-in read replica, SQLite doesn't replicate, reads only go there once
+    # DATABASE_ROUTING['REPLICAS'] lists it
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.replica.sqlite3',
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL;',
+            'timeout': 20,
+        },
+    },
+}
+
+DATABASE_ROUTERS = ['api.routers.ReplicaRouter']
+
+# GET requests to views with read_from_replica (api/routers.py)
+DATABASE_ROUTING = {
+    # {alias: weight}, picked by weighted round-robin, empty reads from the primary
+    'REPLICAS': {},
+    # seconds a user's reads stay on the primary after they wrote
+    'STICKY_SECONDS': 5,
+    # seconds after a write that cached entries are invalidated again
+    'REPLICA_LAG': 2,
 }
 
 # Password validation
@@ -114,16 +158,29 @@ AUTH_USER_MODEL = 'api.User'
 # custom authentication configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
+    # orjson first, it is the default for clients that don't ask for a format
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.ORJSONParser',
+        'api.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 5,
+    # sliding-window counters, O(1) cache state per client (api/throttles.py)
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        # 'rest_framework.throttling.ScopedRateThrottle',
+        'api.throttles.AnonSlidingWindowThrottle',
+        # 'api.throttles.ScopedSlidingWindowThrottle',
  
     ],
     'DEFAULT_THROTTLE_RATES': {
@@ -142,7 +199,8 @@ SPECTACULAR_SETTINGS = {
 
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        # django_redis with hit / miss counts for /metrics
+        "BACKEND": "api.metrics.RedisCache",
         "LOCATION": "redis://127.0.0.1:6379/1",
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
@@ -150,7 +208,71 @@ CACHES = {
     }
 }
 
+# per-view query_budget and N+1 checks (api/query_budget.py), off unless DEBUG
+QUERY_BUDGET = {
+    'ENABLED': DEBUG,
+    'REPEATED_QUERY_THRESHOLD': 3,
+}
+
+# silk_profile and dynamic profiling look for silk's middleware under this name
+SILKY_MIDDLEWARE_CLASS = 'api.middleware.SilkyMiddleware'
+
+# requests captured by silk (api/profiling.py), all of them while DEBUG
+SILK_SAMPLING = {
+    'RATE': 1.0 if DEBUG else 0.01,
+    # path prefixes and user ids always captured
+    'PATHS': [],
+    'USER_IDS': [],
+}
+
+# per-view latency, query and cache counters, served at /metrics (api/metrics.py)
+METRICS = {
+    # seconds between copies of each worker's counters to CACHES['default'], a worker's
+    # copy expires three intervals after it stops
+    'FLUSH_INTERVAL': 10,
+    # scrapes send "Authorization: Bearer <token>" when set
+    'TOKEN': None,
+    # the test databases and caches come and go, nothing to copy the counters to
+    'FLUSH_THREAD': not TESTING,
+}
+
+# product detail reads, a per-process LRU in front of CACHES['default'] (api/caching.py)
+PRODUCT_CACHE = {
+    'LOCAL_MAX_ENTRIES': 1024,
+    # seconds a worker trusts its own copy before checking the shared version
+    'LOCAL_TIMEOUT': 5,
+    'TIMEOUT': 60 * 15,
+    # +/- fraction applied to both timeouts
+    'JITTER': 0.1,
+}
+
+# resized copies of Product.image (api/images.py)
+PRODUCT_IMAGES = {
+    # background threads, 0 makes them inline on commit
+    'WORKERS': 2,
+}
+
+# local copies of Product.external_image_url (api/mirror.py, manage.py mirror_images)
+EXTERNAL_IMAGE_MIRROR = {
+    # requests in flight at once
+    'CONCURRENCY': 8,
+    'TIMEOUT': 10,
+    # seconds before a copy is revalidated
+    'MAX_AGE': 24 * 60 * 60,
+    'WORKERS': 2,
+}
+
+# the user of JWT requests, read through CACHES['default'] (api/authentication.py)
+JWT_USER_CACHE = {
+    'TIMEOUT': 60,
+    # read-only requests trust the username / is_staff claims, no lookup at all
+    'TRUST_TOKEN_CLAIMS': False,
+}
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    "TOKEN_OBTAIN_SERIALIZER": "api.authentication.ClaimsTokenObtainPairSerializer",
+    # refreshed access tokens read the claims from the user, not from the refresh token
+    "TOKEN_REFRESH_SERIALIZER": "api.authentication.ClaimsTokenRefreshSerializer",
 }